@@ -0,0 +1,56 @@
+"""Benchmark of the choice lookups of ``ChoicesField``.
+
+Run it from the root of the repository::
+
+    python benchmarks/choices.py [number of choices]
+
+It validates every choice of a field and a value that isn't a choice, and
+reports how many values per second are validated by the field, which looks
+them up in a set, and by a lookup in the list of choices.
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from docar import fields
+from docar.exceptions import ValidationError
+
+
+def validate_all(to_python, values):
+    for value in values:
+        try:
+            to_python(value)
+        except ValidationError:
+            pass
+
+
+def list_lookup(choices):
+    def to_python(value):
+        if value in choices:
+            return value
+        raise ValidationError('%s is not a valid choice.' % (value,))
+    return to_python
+
+
+def bench(name, stmt, values, number=5):
+    elapsed = min(timeit.repeat(stmt, number=number, repeat=3))
+    print("%-8s %12.0f values/s" % (name, number * len(values) / elapsed))
+
+
+def main(number=500):
+    choices = ['status%d' % i for i in range(number)]
+    values = choices + ['unknown']
+    field = fields.ChoicesField(choices=choices)
+
+    bench('set', lambda: validate_all(field.to_python, values), values)
+    bench('list', lambda: validate_all(list_lookup(choices), values), values)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,98 @@
+"""Throughput benchmark for the document conversion paths.
+
+Run it from the root of the repository::
+
+    python benchmarks/documents.py
+
+It declares a document with 40 fields, a related document and a collection,
+and reports how many documents per second can be rendered, rendered with the
+compiled render function, turned into a save state and rebuilt from a fetch
+state.
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from docar import Document, Collection, fields
+
+
+NUMBER_OF_FIELDS = 40
+
+
+class Tag(Document):
+    slug = fields.StringField()
+
+    class Meta:
+        identifier = 'slug'
+
+    def uri(self):
+        return "http://localhost/tags/%s/" % self.slug
+
+
+class TagCloud(Collection):
+    document = Tag
+
+
+class Editor(Document):
+    id = fields.NumberField()
+    name = fields.StringField()
+
+    def uri(self):
+        return "http://localhost/editors/%s/" % self.id
+
+
+def make_document_class(compiled=False):
+    class Meta:
+        pass
+
+    Meta.compiled = compiled
+    attrs = {
+        'Meta': Meta,
+        'id': fields.NumberField(),
+        'editor': fields.ForeignDocument(Editor),
+        'tags': fields.CollectionField(TagCloud),
+        'uri': lambda self: "http://localhost/articles/%s/" % self.id,
+        }
+    for i in range(NUMBER_OF_FIELDS):
+        attrs['field%d' % i] = fields.StringField()
+
+    return type('Article', (Document,), attrs)
+
+
+Article = make_document_class()
+CompiledArticle = make_document_class(compiled=True)
+
+
+def make_data():
+    data = {
+        'id': 1,
+        'editor': {'id': 1, 'name': 'Editor'},
+        'tags': [{'slug': 'tag%d' % i} for i in range(5)],
+        }
+    for i in range(NUMBER_OF_FIELDS):
+        data['field%d' % i] = 'value %d' % i
+
+    return data
+
+
+def bench(name, stmt, number):
+    elapsed = min(timeit.repeat(stmt, number=number, repeat=3))
+    print("%-8s %10.0f docs/s" % (name, number / elapsed))
+
+
+def main(number=2000):
+    data = make_data()
+    article = Article(data)
+
+    bench('render', article.render, number)
+    bench('compiled', CompiledArticle(data).render, number)
+    bench('save', article._save, number)
+    bench('fetch', lambda: Article()._from_dict(article._fetch(data)),
+            number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Compare the available json codecs on representative documents.
+
+Run it from the root of the repository::
+
+    python benchmarks/json_codecs.py
+
+It renders a collection of the documents used by ``benchmarks/documents.py``
+and reports, for every json library that is installed, how many documents per
+second can be encoded and decoded.
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from docar import Collection, codec
+
+from documents import Article, make_data
+
+
+class Articles(Collection):
+    document = Article
+
+
+def main(number=20, size=200):
+    data = make_data()
+    rendered = Articles([Article(data) for i in range(size)]).to_python()
+    message = codec.get_codec('json').dumps(rendered)
+    docs = number * size
+
+    for name in codec.available_codecs():
+        json_codec = codec.get_codec(name)
+        encode = min(timeit.repeat(lambda: json_codec.dumps(rendered),
+            number=number, repeat=3))
+        decode = min(timeit.repeat(lambda: json_codec.loads(message),
+            number=number, repeat=3))
+        print("%-12s encode %10.0f docs/s   decode %10.0f docs/s" % (
+            name, docs / encode, docs / decode))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Memory benchmark for regular and compact documents.
+
+Run it from the root of the repository::
+
+    python benchmarks/memory.py [number of rows]
+
+It loads the same rows of a fake queryset into a collection of regular
+documents and into a collection of compact documents, without a backend and
+bound to the django backend, and reports the memory used by each document. With ``tracemalloc`` (python 3.4 or newer) it reports
+all memory allocated while the documents are built. Without it, it adds up
+the size of the document objects and their instance dictionaries with
+``sys.getsizeof``, with the backend manager and the reference to the model
+instance of a document. The field values are shared with the rows and are not
+counted then.
+
+"""
+import os
+import sys
+
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from docar import Document, Collection, fields
+
+
+NUMBER_OF_FIELDS = 20
+
+Row = namedtuple('Row', ['id'] + ['field%d' % i
+    for i in range(NUMBER_OF_FIELDS)])
+
+
+class ModelRow(object):
+    """A row of a queryset of a django backend. Like django model instances,
+    it can be weakly referenced."""
+    DoesNotExist = Exception
+
+    def __init__(self, row):
+        for name, value in zip(Row._fields, row):
+            setattr(self, name, value)
+
+    def get_absolute_url(self):
+        return '/article/%s/' % self.id
+
+
+def make_collection_class(compact=False, backend=False):
+    class Meta:
+        pass
+
+    Meta.compact = compact
+    if backend:
+        Meta.backend_type = 'django'
+        Meta.model = ModelRow
+    attrs = {
+        'Meta': Meta,
+        'id': fields.NumberField(),
+        }
+    for i in range(NUMBER_OF_FIELDS):
+        attrs['field%d' % i] = fields.StringField()
+
+    Article = type('Article', (Document,), attrs)
+
+    return type('Articles', (Collection,), {'document': Article})
+
+
+def make_rows(number):
+    return [Row(i, *['value %d' % j for j in range(NUMBER_OF_FIELDS)])
+            for i in range(number)]
+
+
+def object_size(obj):
+    if obj is None:
+        return 0
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def document_size(document):
+    return (object_size(document) +
+            object_size(getattr(document, '_manager', None)) +
+            object_size(getattr(document, '_model_ref', None)))
+
+
+def measure(Articles, rows):
+    if tracemalloc is None:
+        articles = Articles()
+        articles._from_queryset(rows)
+        return sum(document_size(document)
+                for document in articles.collection_set)
+
+    tracemalloc.start()
+    try:
+        articles = Articles()
+        articles._from_queryset(rows)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return size
+
+
+def main(number=100000):
+    if tracemalloc is None:
+        print("tracemalloc isn't available, counting the document objects "
+                "with sys.getsizeof")
+
+    rows = make_rows(number)
+    model_rows = [ModelRow(row) for row in rows]
+    for name, compact, backend in (
+            ('regular', False, False),
+            ('compact', True, False),
+            ('regular, django backend', False, True),
+            ('compact, django backend', True, True)):
+        size = measure(make_collection_class(compact, backend),
+                model_rows if backend else rows)
+        print("%-24s %8.0f bytes/doc %10.1f MB" % (name,
+            float(size) / number, size / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -1,3 +1,4 @@
+import copy
 import sys
 
 from .django import DjangoBackendManager
@@ -10,8 +11,41 @@ __all__ = ['DjangoBackendManager', 'HttpBackendManager']
 class BackendManager(object):
     def __new__(self, backend_type='django'):
         # create the specific backend manager
+        if backend_type == 'http_async':
+            # The asynchronous http backend requires python 3 and aiohttp, so
+            # it is only imported when it is used.
+            from .http_async import HttpAsyncBackendManager
+            return HttpAsyncBackendManager()
+
         mod = sys.modules[__name__]
         Manager = getattr(mod, "%sBackendManager" %
                 backend_type.capitalize())
 
         return Manager()
+
+
+class BackendManagerDescriptor(object):
+    """Give each document its own backend manager.
+
+    The backend managers remember the state of the last fetch or save, like
+    the fetched model instance or the http response. To use different
+    documents of the same class at the same time, for example in threads,
+    every document gets a copy of the backend manager of its class the first
+    time it is used. Accessed on the document class, the descriptor returns
+    the backend manager of the class itself, which is used for operations on
+    many documents like ``fetch_all``.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+
+    def __get__(self, document, cls):
+        if document is None:
+            return self.manager
+        manager = getattr(document, '_manager', None)
+        if manager is None:
+            manager = copy.copy(self.manager)
+            document._manager = manager
+        return manager
+
+    def __set__(self, document, manager):
+        document._manager = manager
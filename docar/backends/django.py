@@ -1,24 +1,174 @@
-from docar.exceptions import BackendDoesNotExist
+from __future__ import absolute_import
+
+import operator
+import weakref
+
+from contextlib import contextmanager
+from functools import partial
+
+from docar import identity
+from docar.exceptions import BackendDoesNotExist, ValidationError
 from docar.fields import ForeignDocument, CollectionField
 
+
+# django is imported where it is used. Without configured settings django
+# before 1.7 can't even import ``django.db``, and docar is used without django
+# as well.
+
+@contextmanager
+def atomic():
+    """Run the block in a database transaction, if django supports it."""
+    try:
+        from django.db import transaction
+    except ImportError:
+        transaction = None
+    if transaction is None or not hasattr(transaction, 'atomic'):
+        yield
+    else:
+        with transaction.atomic():
+            yield
+
+
+def _returns_created_pks(model):
+    """Return whether ``bulk_create`` sets the primary keys of the new
+    instances of ``model``. Only databases that return the inserted rows do,
+    like PostgreSQL."""
+    try:
+        from django.db import connections, router
+    except ImportError:
+        return False
+    features = connections[router.db_for_write(model)].features
+    # The feature is called can_return_ids_from_bulk_insert before django
+    # 3.0, django before 1.10 doesn't set the primary keys at all
+    return bool(getattr(features, 'can_return_rows_from_bulk_insert',
+        getattr(features, 'can_return_ids_from_bulk_insert', False)))
+
+
+def _reverse_foreign_key(relation):
+    """Return the foreign key of the items of ``relation`` if it is the
+    reverse side of a foreign key, ``None`` for a m2m relation."""
+    if getattr(relation, 'through', None) is not None:
+        return None
+    return getattr(relation, 'field', None)
+
+
+# The query plans of the document classes, keyed by their options.
+_query_plans = weakref.WeakKeyDictionary()
+
+
+def query_plan(document):
+    """Return the ``select_related`` and ``prefetch_related`` lookups that
+    fetch the relations of ``document`` together with its model instance.
+
+    Foreign documents are selected with a join, collections are prefetched.
+    The relations of related documents are followed recursively. Fields that
+    are not a relation of the model, like properties, are left out. The plan
+    is computed once for each document class.
+    """
+    try:
+        return _query_plans[document._meta]
+    except KeyError:
+        plan = _plan_relations(document, set([type(document)]))
+        _query_plans[document._meta] = plan
+        return plan
+
+
+def _is_relation(model, name):
+    """Return whether ``name`` is a relation field of the django ``model``,
+    or the accessor of a reverse relation, like ``comment_set``."""
+    try:
+        field = model._meta.get_field(name)
+    except Exception:
+        # FieldDoesNotExist, its module depends on the django version, or a
+        # model without ``_meta``
+        return name in _accessor_names(model)
+
+    if hasattr(field, 'is_relation'):
+        return bool(field.is_relation)
+    # django before 1.8
+    return getattr(field, 'rel', None) is not None
+
+
+def _accessor_names(model):
+    """Return the accessor names of the reverse relations of the django
+    ``model``. ``get_field`` knows them by their query names only."""
+    try:
+        if hasattr(model._meta, 'get_fields'):
+            relations = model._meta.get_fields()
+        else:
+            # django before 1.8
+            relations = (model._meta.get_all_related_objects()
+                    + model._meta.get_all_related_many_to_many_objects())
+        return set(relation.get_accessor_name() for relation in relations
+                if hasattr(relation, 'get_accessor_name'))
+    except Exception:
+        return set()
+
+
+def _plan_relations(document, visited):
+    select = []
+    prefetch = []
+    map_hooks = document._meta.map_hooks
+    model = document._meta.model
+
+    for field in document._meta.local_fields:
+        if isinstance(field, ForeignDocument):
+            Document = field.Document
+        elif isinstance(field, CollectionField):
+            Document = field.Collection.document
+        else:
+            continue
+
+        name = field.name
+        if field.name in map_hooks:
+            # The relation is stored under another name on the model
+            name = map_hooks[field.name](document)
+
+        if not _is_relation(model, name):
+            # The document field isn't a relation of the model, the backend
+            # reads it from the model instance like any other attribute
+            continue
+
+        if Document in visited:
+            # Don't follow recursive relations any further
+            nested_select, nested_prefetch = [], []
+        else:
+            nested_select, nested_prefetch = _plan_relations(Document(),
+                    visited | set([Document]))
+
+        if isinstance(field, ForeignDocument):
+            select.append(name)
+            select.extend(["%s__%s" % (name, lookup)
+                for lookup in nested_select])
+            prefetch.extend(["%s__%s" % (name, lookup)
+                for lookup in nested_prefetch])
+        else:
+            # Everything below a collection has to be prefetched as well
+            prefetch.append(name)
+            prefetch.extend(["%s__%s" % (name, lookup)
+                for lookup in nested_select + nested_prefetch])
+
+    return select, prefetch
+
+
 class DjangoBackendManager(object):
     backend_type = 'django'
 
-    def _to_dict(self, document):
-        if not self.instance:
+    def _to_dict(self, document, instance=None):
+        if instance is None:
+            instance = self.instance
+        if not instance:
             #FIXME: Handle not fetched instances better
             return {}
         data = {}
-        instance = self.instance
+        map_hooks = document._meta.map_hooks
         for field in document._meta.local_fields:
             # copy to field name to be able to map it in the process
             instance_field_name = field.name
-            if hasattr(document, "map_%s_field" % field.name):
+            if field.name in map_hooks:
                 # We map the fieldname of the backend instance to the fieldname
                 # of the document.
-                map_field = getattr(document, "map_%s_field" % field.name)
-                # just create a new field on the instance itself
-                instance_field_name = map_field()
+                instance_field_name = map_hooks[field.name](document)
             if not hasattr(instance, instance_field_name):
                 # The instance has no value for this field
                 data[field.name] = None
@@ -37,11 +187,12 @@ class DjangoBackendManager(object):
                 for identifier in Document._meta.identifier:
                     kwargs[identifier] = getattr(related_instance, identifier)
                 doc = Document(kwargs, document._context)
-                # To avoid a new fetch, set the instance manualy, needed for
-                # the uri method
-                doc._backend_manager.instance = related_instance
                 doc.bound = True
-                data[field.name] = doc._backend_manager._to_dict(doc)
+                identity.remember_object(doc, related_instance)
+                # The related document is turned into a dict only once per
+                # identity map scope
+                data[field.name] = identity.fetch_state(doc,
+                        partial(self._related_to_dict, doc, related_instance))
             elif isinstance(field, CollectionField):
                 data[field.name] = self._get_collection(field, instance_field_name,
                         context=document._get_context())
@@ -62,16 +213,18 @@ class DjangoBackendManager(object):
         # create a document for each item in the m2m relation
         relation = getattr(instance, instance_field_name)
 
+        Document = collection.document
         for item in relation.all():
             # we first create an empty document
-            doc = collection.document({}, context=context)
-
-            # We dont need to fetch the object again
-            doc._backend_manager.instance = item
+            doc = Document({}, context=context)
 
             # we shortcut here the fetch mechanism, turn it into a dict
             # representation on set the attributes correctly
-            obj = doc._backend_manager._to_dict(doc)
+            identifier = dict((name, getattr(item, name))
+                    for name in Document._meta.identifier)
+            identity.remember_object(doc, item, identifier)
+            obj = identity.fetch_state(doc,
+                    partial(self._related_to_dict, doc, item), identifier)
             obj = doc._fetch(obj)
             doc._from_dict(obj)
 
@@ -79,20 +232,258 @@ class DjangoBackendManager(object):
 
         return collection._to_dict()
 
+    def _related_to_dict(self, document, instance):
+        """Turn the model instance of a related document into a dict."""
+        # To avoid a new fetch, set the instance manualy, needed for the uri
+        # method
+        document._backend_manager.instance = instance
+        return document._backend_manager._to_dict(document)
+
+    def _get_queryset(self, document):
+        """Return the queryset to fetch ``document`` from. It joins and
+        prefetches the relations of the document, see ``query_plan``."""
+        select, prefetch = query_plan(document)
+        queryset = self._model.objects
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+
+        return queryset
+
     def fetch(self, document, *args, **kwargs):
         select_dict = document._identifier_state()
         select_dict.update(document._get_context())
 
         try:
-            instance = self._model.objects.get(**select_dict)
+            instance = self._get_queryset(document).get(**select_dict)
         except self._model.DoesNotExist:
             raise BackendDoesNotExist("Fetch failed for %s" % str(self._model))
 
         self.instance = instance
+        identity.remember_object(document, instance)
 
         return self._to_dict(document)
 
+    def fetch_all(self, documents, *args, **kwargs):
+        """Fetch the model instances of all ``documents`` with one query,
+        or one for each context if the documents have different contexts.
+
+        Documents with a single identifier are selected with an ``__in``
+        lookup, otherwise with an OR of the identifiers of each document.
+        Return a list with the state of each document in the same order, the
+        state of a document without a model instance is ``None``.
+        """
+        if len(documents) < 1:
+            return []
+
+        instances = self._find_instances(self._get_queryset(documents[0]),
+                documents)
+
+        states = []
+        for document, instance in zip(documents, instances):
+            if instance is None:
+                states.append(None)
+                continue
+            manager = document._backend_manager
+            manager.instance = instance
+            states.append(manager._to_dict(document, instance))
+
+        return states
+
+    def _find_instances(self, queryset, documents):
+        """Select the model instances of ``documents`` from ``queryset`` with
+        one query for each context of the documents. Return a list with the
+        model instance of each document in the same order, ``None`` for
+        documents without a model instance."""
+        groups = []
+        for index, document in enumerate(documents):
+            context = document._get_context()
+            for group_context, indexes in groups:
+                if group_context == context:
+                    indexes.append(index)
+                    break
+            else:
+                groups.append((context, [index]))
+
+        instances = [None] * len(documents)
+        for context, indexes in groups:
+            found = self._find_context_instances(queryset,
+                    [documents[index] for index in indexes], context)
+            for index, instance in zip(indexes, found):
+                instances[index] = instance
+
+        return instances
+
+    def _find_context_instances(self, queryset, documents, context):
+        """Select the model instances of ``documents`` with the same
+        ``context`` from ``queryset`` with one query, see
+        ``_find_instances``."""
+        document = documents[0]
+        identifier = document._meta.identifier
+        names = self._map_names(document, identifier)
+        states = [doc._identifier_state() for doc in documents]
+        values = [[state[name] for name in identifier] for state in states]
+
+        if len(names) == 1:
+            lookup = {'%s__in' % names[0]: [value[0] for value in values]}
+            lookup.update(context)
+            instances = queryset.filter(**lookup)
+        else:
+            from django.db.models import Q
+            query = reduce(operator.or_, [Q(**dict(zip(names, value)))
+                for value in values])
+            instances = queryset.filter(query, **context)
+
+        # Map the model instances back to the documents by their identifier
+        found = {}
+        for instance in instances:
+            key = self._identifier_key(document,
+                    [getattr(instance, name) for name in names])
+            found[key] = instance
+
+        return [found.get(self._identifier_key(document, value))
+                for value in values]
+
+    def _identifier_key(self, document, values):
+        """Return a key to match the identifier ``values`` of a document and
+        of a model instance with. The values are converted by the identifier
+        fields, and compared as text, as a number field leaves a string
+        identifier like ``'1'`` as it is."""
+        field_map = document._meta.field_map
+        key = []
+        for name, value in zip(document._meta.identifier, values):
+            field = field_map.get(name)
+            if field is not None:
+                try:
+                    value = field.to_python(value)
+                except ValidationError:
+                    pass
+            key.append(unicode(value))
+
+        return tuple(key)
+
     def save(self, document, *args, **kwargs):
+        # The names of the changed fields, all fields are saved without them
+        update_fields = kwargs.pop('update_fields', None)
+        doc_state, m2m_relations = self._save_state(document, *args, **kwargs)
+
+        select_dict = document._identifier_state()
+        select_dict.update(document._get_context())
+
+        # Use the model instance if it has been loaded already while saving
+        # or updating the document, otherwise try to retrieve the existing
+        # model if it exists
+        instance = identity.loaded_object(document)
+        created = False
+        if instance is None:
+            try:
+                instance = self._model.objects.get(**select_dict)
+            except self._model.DoesNotExist:
+                # We create a new model instance
+                instance = self._model(**select_dict)
+                created = True
+
+        # Set the new state for the model instance
+        for k, v in doc_state.iteritems():
+            setattr(instance, k, v)
+
+        if update_fields is not None and not created:
+            # Write only the columns and m2m relations of the changed fields
+            kwargs['update_fields'] = self._update_fields(document,
+                    doc_state, update_fields)
+            m2m_relations = [relation for relation in m2m_relations
+                    if relation[0].name in update_fields]
+
+        # save the model to the backend
+        #FIXME: Do some exception handling, maybe a full_clean first
+
+        # The model instance and its m2m relations are saved in one
+        # transaction
+        with atomic():
+            instance.save(*args, **kwargs)
+
+            self.instance = instance
+
+            # Save the m2m relations
+            self._save_m2m_relations(instance, m2m_relations)
+
+    def _update_fields(self, document, doc_state, names):
+        """Return the names of the model fields to save for the changed
+        document fields ``names``. Collections are saved as m2m relations
+        and are left out."""
+        field_map = document._meta.field_map
+        names = [name for name in names
+                if not isinstance(field_map[name], CollectionField)]
+
+        return [name for name in self._map_names(document, names)
+                if name in doc_state]
+
+    def bulk_save(self, documents, batch_size=None, *args, **kwargs):
+        """Save all ``documents`` at once.
+
+        The existing model instances of all documents are selected with one
+        query. New model instances are created with ``bulk_create`` and
+        existing ones updated with ``bulk_update``, ``batch_size`` instances
+        per query. The collections of the documents are synchronized
+        afterwards, everything in one transaction. Like ``bulk_create`` and
+        ``bulk_update`` themselves, this doesn't call ``save()`` on the model
+        instances.
+        """
+        if len(documents) < 1:
+            return
+
+        states = [self._save_state(document, *args, **kwargs)
+                for document in documents]
+        instances = self._find_instances(self._model.objects, documents)
+
+        created = []
+        updated = []
+        update_fields = set()
+        for document, instance, (doc_state, m2m_relations) in zip(documents,
+                instances, states):
+            select_dict = document._identifier_state()
+            select_dict.update(document._get_context())
+            if instance is None:
+                # We create a new model instance
+                instance = self._model(**select_dict)
+                created.append(instance)
+            else:
+                updated.append(instance)
+                update_fields.update(doc_state.keys())
+                update_fields.difference_update(select_dict.keys())
+
+            # Set the new state for the model instance
+            for k, v in doc_state.iteritems():
+                setattr(instance, k, v)
+            document._backend_manager.instance = instance
+
+        with atomic():
+            if created:
+                self._model.objects.bulk_create(created,
+                        batch_size=batch_size)
+                # The relations need the primary keys of the new instances
+                names = sorted(select_dict.keys())
+                loaded = dict(zip(map(id, created), self._load_created(
+                    self._model, created, names)))
+                for document in documents:
+                    manager = document._backend_manager
+                    manager.instance = loaded.get(id(manager.instance),
+                            manager.instance)
+            if updated and update_fields:
+                self._bulk_update(self._model, updated, sorted(update_fields),
+                        batch_size)
+
+            for document, (doc_state, m2m_relations) in zip(documents,
+                    states):
+                self._save_m2m_relations(document._backend_manager.instance,
+                        m2m_relations)
+
+    def _save_state(self, document, *args, **kwargs):
+        """Return the state of ``document`` to set on its model instance, and
+        the collections to save as m2m relations afterwards. Foreign
+        documents are saved if they don't exist yet and replaced by their
+        model instances."""
         m2m_relations = []
 
         # we call this method to make sure we run all save_FIELD_field methods
@@ -100,21 +491,20 @@ class DjangoBackendManager(object):
 
         # we defere the collections to later and replace foreign documents with
         # foreign related model instances
+        map_hooks = document._meta.map_hooks
         for field in document._meta.local_fields:
             # we make a copy of the name, to not interfere with other documents
             # when saving them
             name = field.name
-            if hasattr(document, "map_%s_field" % field.name):
+            if field.name in map_hooks:
                 # we map the attribute name
-                map_field = getattr(document, "map_%s_field" % field.name)
-                doc_state[map_field()] = getattr(document, field.name)
-                name = map_field()
-                setattr(document, name, doc_state[name])
+                name = map_hooks[field.name](document)
+                doc_state[name] = getattr(document, field.name)
             if hasattr(field, 'Collection'):
                 # we defer m2m relationships to later, we need the field, the
                 # name of the field (after the map() method) and the actual m2m
                 # relation
-                collection = getattr(document, name)
+                collection = getattr(document, field.name)
                 collection._context = document._context
                 m2m_relations.append((field, name, collection))
 
@@ -123,7 +513,7 @@ class DjangoBackendManager(object):
             elif hasattr(field, 'Document'):
                 # a foreign document means we have to retrieve it from the
                 # model
-                doc = getattr(document, name)
+                doc = getattr(document, field.name)
                 # Don't try to save or fetch if the document isn't bound,
                 # won't do us any good.
                 try:
@@ -135,49 +525,32 @@ class DjangoBackendManager(object):
                     else:
                         doc.save(*args, **kwargs)
 
-                instance = doc._backend_manager.instance
+                # The fetch doesn't load the model instance again if the
+                # document has been fetched before in this scope
+                instance = identity.loaded_object(doc)
+                if instance is None:
+                    instance = doc._backend_manager.instance
                 doc_state[name] = instance
 
         # add the additional context in retrieving the model instance
         doc_state.update(document._get_context())
-        select_dict = document._identifier_state()
-        select_dict.update(document._get_context())
 
-        # First try to retrieve the existing model if it exists
-        try:
-            instance = self._model.objects.get(**select_dict)
-        except self._model.DoesNotExist:
-            # We create a new model instance
-            instance = self._model(**select_dict)
-
-        # Set the new state for the model instance
-        for k, v in doc_state.iteritems():
-            setattr(instance, k, v)
-
-        # save the model to the backend
-        #FIXME: Do some exception handling, maybe a full_clean first
-
-        instance.save(*args, **kwargs)
-
-        self.instance = instance
-
-        # Save the m2m relations
-        self._save_m2m_relations(instance, m2m_relations)
+        return doc_state, m2m_relations
 
     def _save_m2m_relations(self, instance, m2m_relations):
-        # set the m2m relations
-        defered_m2m = []
-
+        """Synchronize the m2m relations of ``instance`` with collections.
+
+        The current items of a relation are loaded once and compared to the
+        documents of the collection by their identifier. Changed items are
+        updated in bulk, new items are created and added to the relation, see
+        ``_create_items``, and items that are not part of the collection
+        anymore are deleted with a single query.
+        """
         for field, local_name, collection in m2m_relations:
             m2m = getattr(instance, local_name)
-            # We store all current m2m items so that we can match it against
-            # the current collection and remove any excess items at the end
-            # Querysets are evaluated lazy. So by accesing the first element
-            # we force the actual db lookup.
-            current_m2m_items = m2m.all()
-
-            if len(current_m2m_items) > 0:
-                current_m2m_items[0]
+            model = m2m.__dict__['model']
+            # Load the current items of the relation once
+            current_m2m_items = list(m2m.all())
 
             # We dont bother about this collection if its empty and has no
             # existing instances
@@ -185,61 +558,201 @@ class DjangoBackendManager(object):
                     and len(current_m2m_items) < 1):
                 continue
 
-            m2m = getattr(instance, local_name)
+            # The names of the identifier fields on the model
+            document = collection.document()
+            identifier = document._meta.identifier
+            id_names = self._map_names(document, identifier)
+            existing = {}
+            for item in current_m2m_items:
+                key = self._identifier_key(document,
+                        [getattr(item, name) for name in id_names])
+                existing[key] = item
+
+            created = []
+            updated = []
+            update_fields = set()
+            defered = []
+
             for doc in collection.collection_set:
                 if hasattr(collection, '_context'):
                     doc._context = collection._context
                 else:
                     doc._context = {}
-                doc_state = doc._save()
-
-                # Iterate all fields of this doc, to defere collections
-                for field in doc._meta.local_fields:
-                    defered_name = field.name
-                    if hasattr(doc, "map_%s_field" % defered_name):
-                        # we map the attribute name
-                        map_field = getattr(doc,
-                                "map_%s_field" % defered_name)
-                        doc_state[map_field()] = getattr(doc, defered_name)
-                        del(doc_state[defered_name])
-                        defered_name = map_field()
-                        setattr(doc, defered_name, doc_state[defered_name])
-                    if hasattr(field, 'Collection'):
-                        # we defere nested m2m relationships to later, filter
-                        # them out here to deal with it on a later point
-                        defered_m2m.append((field, defered_name, getattr(doc,
-                            defered_name)))
-                        del(doc_state[defered_name])
-                    elif (hasattr(field, 'Document')
-                            and defered_name in doc_state):
-                        document = field.Document(doc_state[defered_name])
-                        document._context = collection._context
-                        document.save()
-                        doc_state[defered_name] = document._backend_manager.instance
+                doc_state, defered_m2m = self._collection_item_state(doc,
+                        collection)
 
                 # create or update the relation object
-                model = m2m.__dict__['model']
-                try:
-                    inst = m2m.get(**doc._identifier_state())
-                    for k, v in doc_state.items():
-                        setattr(inst, k, v)
-                    inst.save()
-                except model.DoesNotExist:
-                    inst = m2m.create(**doc_state)
-                    # I have to add this otherwise the newly created model
-                    # instance gets deleted below again.
-                    current_m2m_items = current_m2m_items.exclude(
-                            **doc._identifier_state())
-
-                # now recursively add the nested collections
+                identifier_state = doc._identifier_state()
+                key = self._identifier_key(doc,
+                        [identifier_state[name] for name in identifier])
+                inst = existing.pop(key, None)
+                if inst is None:
+                    created.append((doc_state, defered_m2m))
+                    continue
+
+                for k, v in doc_state.items():
+                    setattr(inst, k, v)
+                updated.append(inst)
+                update_fields.update(doc_state.keys())
                 if len(defered_m2m) > 0:
-                    self._save_m2m_relations(inst, defered_m2m)
+                    defered.append((inst, defered_m2m))
+
+            update_fields.difference_update(id_names)
+            if updated and update_fields:
+                self._bulk_update(model, updated, sorted(update_fields))
+            if created:
+                instances = self._create_items(m2m, model,
+                        [doc_state for doc_state, defered_m2m in created])
+                defered.extend((inst, defered_m2m) for inst, (doc_state,
+                    defered_m2m) in zip(instances, created) if defered_m2m)
+
+            # We delete any leftover item, only the items of this relation
+            remaining = set(map(id, existing.values()))
+            leftover = [item for item in current_m2m_items
+                    if id(item) in remaining]
+            if leftover:
+                model._default_manager.filter(
+                        pk__in=[item.pk for item in leftover]).delete()
+
+            # now recursively add the nested collections
+            for inst, defered_m2m in defered:
+                self._save_m2m_relations(inst, defered_m2m)
+
+    def _create_items(self, m2m, model, states):
+        """Create the model instances of the new items of the relation
+        ``m2m`` with the states ``states`` and return them.
+
+        The relation needs the primary keys of the new items. If the database
+        returns them, the items are inserted with one ``bulk_create`` and
+        added to the relation at once, the items of a reverse foreign key get
+        the foreign key set instead. Otherwise each item is created through
+        the relation.
+        """
+        if not _returns_created_pks(model):
+            return [m2m.create(**state) for state in states]
+
+        foreign_key = _reverse_foreign_key(m2m)
+        instances = []
+        for state in states:
+            inst = model(**state)
+            if foreign_key is not None:
+                setattr(inst, foreign_key.name, m2m.instance)
+            instances.append(inst)
+
+        model._default_manager.bulk_create(instances)
+        if foreign_key is None:
+            m2m.add(*instances)
+
+        return instances
+
+    def _select_keys(self, queryset, names, keys):
+        """Filter ``queryset`` for the rows with the values ``keys`` of the
+        model fields ``names``, each key is a tuple of the values."""
+        if len(names) == 1:
+            return queryset.filter(**{'%s__in' % names[0]:
+                [key[0] for key in keys]})
+
+        from django.db.models import Q
+        query = reduce(operator.or_, [Q(**dict(zip(names, key)))
+            for key in keys])
+        return queryset.filter(query)
+
+    def _load_created(self, model, instances, names):
+        """Return the model instances created with ``bulk_create`` with
+        their primary keys. Not every database sets the primary keys of the
+        created instances, the others are selected again by the values of the
+        model fields ``names`` in one query. The values must identify the
+        new rows, like the identifier and the context of a document."""
+        missing = [inst for inst in instances if inst.pk is None]
+        if not missing:
+            return instances
+
+        def key(inst):
+            # The values are compared as text, the instances have the values
+            # of the documents, the rows the ones of the database
+            return tuple(unicode(getattr(inst, name)) for name in names)
+
+        keys = [tuple(getattr(inst, name) for name in names)
+                for inst in missing]
+        found = {}
+        for row in self._select_keys(model._default_manager, names, keys):
+            found[key(row)] = row
+
+        return [inst if inst.pk is not None else found.get(key(inst), inst)
+                for inst in instances]
+
+    def _map_names(self, document, names):
+        """Return the model attribute names of the fields ``names``."""
+        map_hooks = document._meta.map_hooks
+        mapped = []
+        for name in names:
+            if name in map_hooks:
+                name = map_hooks[name](document)
+            mapped.append(name)
+
+        return mapped
+
+    def _collection_item_state(self, doc, collection):
+        """Return the state of a collection item to save on its model
+        instance, and the nested collections that are saved afterwards."""
+        doc_state = doc._save()
+        defered_m2m = []
 
-            # We delete any leftover item
-            if len(current_m2m_items) > 1:
-                for item in current_m2m_items:
-                    item.delete()
+        # Iterate all fields of this doc, to defere collections
+        map_hooks = doc._meta.map_hooks
+        for field in doc._meta.local_fields:
+            defered_name = field.name
+            if defered_name in map_hooks:
+                # we map the attribute name
+                mapped_name = map_hooks[defered_name](doc)
+                doc_state[mapped_name] = getattr(doc, defered_name)
+                del(doc_state[defered_name])
+                defered_name = mapped_name
+            if hasattr(field, 'Collection'):
+                # we defere nested m2m relationships to later, filter
+                # them out here to deal with it on a later point
+                defered_m2m.append((field, defered_name, getattr(doc,
+                    field.name)))
+                del(doc_state[defered_name])
+            elif (hasattr(field, 'Document')
+                    and defered_name in doc_state):
+                document = field.Document(doc_state[defered_name])
+                document._context = collection._context
+                document.save()
+                doc_state[defered_name] = document._backend_manager.instance
+
+        return doc_state, defered_m2m
+
+    def _bulk_update(self, model, instances, fields, batch_size=None):
+        """Update the model fields ``fields`` of ``instances``, with one
+        query per ``batch_size`` instances."""
+        manager = model._default_manager
+        if hasattr(manager, 'bulk_update'):
+            manager.bulk_update(instances, fields, batch_size=batch_size)
+            return
 
+        try:
+            from django.db.models import Case, When, Value
+        except ImportError:
+            # Django versions before 1.8 can't update in bulk
+            for inst in instances:
+                inst.save()
+            return
+
+        # Django versions before 2.2 have no ``bulk_update``, update each
+        # column with a CASE expression over the primary keys like it does
+        batch_size = batch_size or len(instances)
+        for start in xrange(0, len(instances), batch_size):
+            batch = instances[start:start + batch_size]
+            values = {}
+            for name in fields:
+                field = model._meta.get_field(name)
+                whens = [When(pk=inst.pk, then=Value(
+                    getattr(inst, field.attname), output_field=field))
+                    for inst in batch]
+                values[field.attname] = Case(*whens, output_field=field)
+            manager.filter(pk__in=[inst.pk for inst in batch]).update(
+                    **values)
 
     def delete(self, document, **kwargs):
         try:
@@ -250,6 +763,33 @@ class DjangoBackendManager(object):
             return
 
         self.instance.delete()
-
-    def uri(self):
-        return self.instance.get_absolute_url()
+        identity.forget_object(document)
+
+    def uri(self, document=None):
+        """Return the absolute url of the model instance. If the instance
+        hasn't been loaded, like for a document from the document cache, it
+        is loaded for ``document``."""
+        instance = getattr(self, 'instance', None)
+        if instance is None and document is not None:
+            instance = self._load_instance(document)
+        if instance is None:
+            return None
+        return instance.get_absolute_url()
+
+    def _load_instance(self, document):
+        """Load and return the model instance of ``document``, or ``None``
+        if it doesn't exist. The model a document was built from is used if
+        it is still alive."""
+        ref = getattr(document, '_model_ref', None)
+        instance = ref() if ref is not None else None
+        if instance is None:
+            instance = identity.loaded_object(document)
+        if instance is None:
+            select_dict = document._identifier_state()
+            select_dict.update(document._get_context())
+            try:
+                instance = self._model.objects.get(**select_dict)
+            except self._model.DoesNotExist:
+                return None
+        self.instance = instance
+        return instance
@@ -7,34 +7,165 @@ document send from the server to the client with document.to_json() should have
 the right format to be understood by this backend.
 
 """
-import json
+import sys
+import weakref
 import requests
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
 
+from docar import codec
+from docar import identity
+from docar.cache import CacheEntry, credentials_key
 from docar.fields import ForeignDocument, CollectionField
 from docar.exceptions import HttpBackendError, BackendDoesNotExist
 
 
+# The ETag of the last response for a document, used by the conditional write
+# strategy.
+_etags = weakref.WeakKeyDictionary()
+
+# The ways to decide whether to create a resource with POST or to update it
+# with PUT when saving a document.
+WRITE_STRATEGIES = ('probe', 'head', 'put', 'post', 'conditional')
+
+
+def create_session(pool_connections=10, pool_maxsize=10, max_retries=0,
+        backoff_factor=0, status_forcelist=None):
+    """Create a ``requests.Session`` that keeps its connections alive and
+    reuses them for further requests.
+
+    :param pool_connections: The number of hosts to keep connection pools for.
+    :param pool_maxsize: The number of connections to keep alive per host.
+    :param max_retries: How often to retry a failed request.
+    :param backoff_factor: Sleep ``backoff_factor * 2 ** retry`` seconds
+                           between retries.
+    :param status_forcelist: A list of HTTP status codes that are retried too.
+
+    """
+    retries = Retry(total=max_retries, backoff_factor=backoff_factor,
+            status_forcelist=status_forcelist, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize, max_retries=retries)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def run_concurrently(jobs, max_workers=1):
+    """Call each function in ``jobs`` and return the results in the same
+    order. At most ``max_workers`` functions are called at the same time.
+
+    If any function raises an exception, the exception of the first failing
+    function in ``jobs`` is raised, no matter in which order they failed.
+    """
+    if max_workers <= 1 or len(jobs) <= 1:
+        return [job() for job in jobs]
+
+    # The threads share the identity map scope of the calling thread
+    scope = identity.current_map()
+
+    def call(job):
+        try:
+            with identity.activate(scope):
+                return True, job()
+        except Exception:
+            return False, sys.exc_info()
+
+    pool = ThreadPool(min(max_workers, len(jobs)))
+    try:
+        outcomes = pool.map(call, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = []
+    for success, value in outcomes:
+        if not success:
+            raise value[0], value[1], value[2]
+        results.append(value)
+
+    return results
+
+
 class HttpBackendManager(object):
     SSL_CERT = None
-
-    def _to_dict(self, document):
-        instance = self.instance
+    # A session used for all requests, set it to share a connection pool
+    # between all documents. Use the ``session`` meta option of a document to
+    # set a session for a single document class.
+    SESSION = None
+    # The number of related documents and collection items that are fetched
+    # at the same time. Use the ``max_workers`` meta option of a document to
+    # set it for a single document class.
+    MAX_WORKERS = 1
+    # How to save documents. Use the ``write_strategy`` meta option of a
+    # document to set it for a single document class.
+    #
+    # ``probe``: Fetch the document first, create it if it isn't found.
+    # ``head``: Make a HEAD request first, create it if it isn't found.
+    # ``put``: Always update or create the document with PUT.
+    # ``post``: Always create the document with POST.
+    # ``conditional``: Like ``head``, but send the ETag of the document as
+    #     ``If-Match`` header, and ``If-None-Match: *`` when creating it. The
+    #     HEAD request is skipped if the document has been fetched before.
+    WRITE_STRATEGY = 'probe'
+    # A cache for the fetched resources, see ``docar.cache``. Use the
+    # ``cache`` meta option of a document to set a cache for a single
+    # document class.
+    CACHE = None
+    # Update existing resources with a PATCH request that contains only the
+    # changed fields, instead of a PUT request with the whole document. Use
+    # the ``partial_updates`` meta option of a document to set it for a
+    # single document class.
+    PARTIAL_UPDATES = False
+
+    def _to_dict(self, document, instance=None, kwargs=None):
+        if instance is None:
+            instance = self.instance
+        if kwargs is None:
+            kwargs = getattr(self, 'kwargs', {})
+
+        data, related, jobs = self._prepare_dict(document, instance, kwargs,
+                self._fetch_related, self._fetch_item)
+        results = run_concurrently(jobs, self._get_max_workers(document))
+
+        return self._finish_dict(data, related, results)
+
+    def _prepare_dict(self, document, instance, kwargs, fetch_related,
+            fetch_item):
+        """Map the fields of ``instance`` to a dict for ``document``.
+
+        Related documents and collection items have to be fetched on their
+        own. For each of them a job is returned, calling ``fetch_related`` or
+        ``fetch_item`` with the document and ``kwargs``. Together with the
+        list of related fields the results of those jobs are passed to
+        ``_finish_dict``.
+        """
         data = {}
+        map_hooks = document._meta.map_hooks
+
+        # Related documents and collection items that have to be fetched,
+        # in the order of the fields. Foreign documents refer to the position
+        # of their fetch in ``jobs``.
+        related = []
+        jobs = []
 
         for field in document._meta.local_fields:
             instance_field_name = field.name
-            if hasattr(document, "map_%s_field" % field.name):
+            if field.name in map_hooks:
                 # We map the fieldname of the backend instance to the fieldname
                 # of the document.
-                map_field = getattr(document, "map_%s_field" % field.name)
-                # just create a new field on the instance itself
-                instance_field_name = map_field()
+                instance_field_name = map_hooks[field.name](document)
             if not field.name in instance:
                 data[field.name] = None
                 continue
             if isinstance(field, ForeignDocument):
-                kwargs = {}
                 related_instance = instance[instance_field_name]
                 if field.inline:
                     # The field is rendered inline, so we dont have to fetch it
@@ -43,58 +174,108 @@ class HttpBackendManager(object):
                     continue
                 # Fetch the document again to create a dict from it
                 Document = field.Document
-                kwargs = related_instance
-                doc = Document(kwargs, context=document._context)
+                doc = Document(related_instance, context=document._context)
                 # To avoid a new fetch, set the instance manualy, needed for
                 # the uri method
                 if self._get_uri('get', doc):
-                    data[field.name] = doc._backend_manager.fetch(doc, **self.kwargs)
+                    related.append((field, len(jobs)))
+                    jobs.append(partial(fetch_related, doc, kwargs))
                 else:
                     data[field.name] = related_instance
             elif isinstance(field, CollectionField):
                 if field.inline:
                     data[field.name] = instance[instance_field_name]
                 else:
-                    data[field.name] = self._get_collection(field,
-                        context=document._context)
+                    collection = field.Collection()
+                    related.append((field, collection))
+                    for doc in self._get_collection(field, instance,
+                            context=document._context):
+                        collection.add(doc)
+                        jobs.append(partial(fetch_item, doc, kwargs))
             elif field.name in instance:
                 # Otherwise set the value of the field from the retrieved model
                 # object
                 data[field.name] = instance[field.name]
 
-        return data
+        return data, related, jobs
 
-    def _get_collection(self, field, context={}):
-        # FIXME: This relies on the fact that fetch has been called already
-        instance = self.instance
+    def _finish_dict(self, data, related, results):
+        """Add the fetched related documents and collections to ``data``."""
+        for field, value in related:
+            if isinstance(field, ForeignDocument):
+                data[field.name] = results[value]
+            else:
+                # The items of the collection have been fetched already
+                data[field.name] = value._to_dict()
+
+        return data
 
-        # create a new collection first
-        collection = field.Collection()
+    def _get_collection(self, field, instance, context={}):
+        """Return a list of unfetched documents, one for each item of the
+        collection ``field`` in ``instance``."""
+        documents = []
+        Document = field.Collection.document
 
         # create a document for each item in the m2m relation
         relation = instance[field.name]
 
         for item in relation:
             select_dict = {}
-            # we first create an empty document, to have access to the fetch
-            # methods
-            doc = collection.document()
-            for elem in collection.document._meta.identifier:
+            for elem in Document._meta.identifier:
                 # if hasattr(doc, "fetch_%s_field" % elem):
                 #     fetch_field = getattr(doc, "fetch_%s_field" % elem)
                 #     select_dict[elem] = fetch_field()
                 # else:
                 select_dict[elem] = item[elem]
             # now we request the actual document, bound to a backend resource
-            doc = collection.document(select_dict, context=context)
-            # # We dont need to fetch the object again
-            doc._backend_manager.instance = item
-            if (hasattr(self, 'username') and hasattr(self, 'password')):
-                doc.fetch(username=self.username, password=self.password)
-            else:
-                doc.fetch()
-            collection.add(doc)
-        return collection._to_dict()
+            documents.append(Document(select_dict, context=context))
+
+        return documents
+
+    def _fetch_related(self, document, kwargs):
+        """Return the fetched state of a related document."""
+        return identity.fetch_state(document,
+                partial(document._backend_manager.fetch, document, **kwargs),
+                credentials=credentials_key(kwargs))
+
+    def _fetch_item(self, document, kwargs):
+        """Fetch an item of a collection, only the credentials are handed on
+        to the fetch."""
+        if 'username' in kwargs and 'password' in kwargs:
+            document.fetch(username=kwargs['username'],
+                    password=kwargs['password'])
+        else:
+            document.fetch()
+
+    def _get_max_workers(self, document):
+        """Return how many related documents of ``document`` can be fetched
+        at the same time."""
+        if document._meta.max_workers is not None:
+            return document._meta.max_workers
+        return self.MAX_WORKERS
+
+    def _get_write_strategy(self, document):
+        """Return the write strategy to save ``document`` with."""
+        strategy = document._meta.write_strategy or self.WRITE_STRATEGY
+        if strategy not in WRITE_STRATEGIES:
+            raise ValueError("Unknown write strategy %s." % strategy)
+        return strategy
+
+    def _get_partial_updates(self, document):
+        """Return whether ``document`` is updated with PATCH requests."""
+        if document._meta.partial_updates is not None:
+            return document._meta.partial_updates
+        return self.PARTIAL_UPDATES
+
+    def _get_client(self, document):
+        """Return the session to make requests for ``document`` with. Without
+        a configured session, the requests are made using the module level
+        functions of ``requests``."""
+        if document._meta.session is not None:
+            return document._meta.session
+        elif self.SESSION is not None:
+            return self.SESSION
+        return requests
 
     def _get_uri(self, verb, document):
         if hasattr(document, "%s_uri" % verb):
@@ -126,11 +307,28 @@ class HttpBackendManager(object):
         if self.SSL_CERT:
             params['verify'] = self.SSL_CERT
 
+        # Send a conditional request if the resource has been cached before
+        url = self._get_uri('get', document)
+        cache = self._get_cache(document)
+        entry = None
+        if cache is not None:
+            entry = cache.get(self._get_cache_key(url, kwargs))
+            if entry is not None:
+                params['headers'] = self._get_conditional_headers(entry)
+
         # Make the http request
         #FIXME: Needs some exception handling probably
-        response = requests.get(url=self._get_uri('get', document), **params)
+        response = self._get_client(document).get(url=url, **params)
         self.response = response
 
+        if response.status_code == 304 and entry is not None:
+            # The resource didn't change, so we use the cached message
+            # instead of parsing it again.
+            _etags[document] = entry.etag
+            instance = entry.payload
+            self.instance = instance
+            return self._to_dict(document, instance, kwargs)
+
         # If the response is a 404, than the resource couldn't be found
         # we define its own exception, cause in save we catch this one to
         # determine whether to create a new or update an existing resource
@@ -144,70 +342,205 @@ class HttpBackendManager(object):
             raise HttpBackendError(response.status_code,
                     response.content)
 
+        _etags[document] = response.headers.get('ETag')
+
         # serialize from json and return a python dict
-        if self.response.content:
+        if response.content:
             #FIXME: Handle a ValueError in case its not valid JSON
-            self.instance = json.loads(self.response.content)
-            return self._to_dict(document)
+            instance = codec.loads(response.content)
+            self.instance = instance
+            if cache is not None:
+                self._cache_response(cache, self._get_cache_key(url, kwargs),
+                        response.headers, instance)
+            return self._to_dict(document, instance, kwargs)
         else:
             return {}
 
-    def save(self, document, *args, **kwargs):
-        params = {}
+    def _get_cache(self, document):
+        """Return the cache for the responses of ``document``, or ``None`` if
+        responses are not cached."""
+        if document._meta.cache is not None:
+            return document._meta.cache
+        return self.CACHE
 
+    def _get_cache_key(self, url, kwargs):
+        """Return the cache key of ``url``. Responses are cached for each
+        user on its own."""
         if 'username' in kwargs and 'password' in kwargs:
-            # we enable authentication
-            auth = HTTPBasicAuth(kwargs['username'], kwargs['password'])
-            params['auth'] = auth
-
+            return '%s %s' % (kwargs['username'], url)
+        return url
+
+    def _get_conditional_headers(self, entry):
+        headers = {}
+        if entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified is not None:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def _cache_response(self, cache, key, headers, payload):
+        """Cache the parsed message ``payload`` if the response can be
+        validated with a conditional request later on."""
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if etag is not None or last_modified is not None:
+            cache.set(key, CacheEntry(etag, last_modified, payload))
+
+    def _invalidate(self, document, kwargs):
+        """Remove the cached response of ``document`` after changing it."""
+        cache = self._get_cache(document)
+        if cache is not None:
+            cache.delete(self._get_cache_key(self._get_uri('get', document),
+                kwargs))
+
+    def _save_state(self, document):
+        """Return the state of ``document`` that is sent to the endpoint."""
         doc_state = document._save()
+        map_hooks = document._meta.map_hooks
 
         for field in document._meta.local_fields:
             name = field.name
             if field.name not in doc_state:
                 continue
-            if hasattr(document, "map_%s_field" % field.name):
+            if field.name in map_hooks:
                 # we map the attribute name
-                map_field = getattr(document, "map_%s_field" % field.name)
-                doc_state[map_field()] = getattr(document, field.name)
-                name = map_field()
-                setattr(document, name, doc_state[name])
+                name = map_hooks[field.name](document)
+                doc_state[name] = getattr(document, field.name)
             if hasattr(field, 'Collection'):
-                coll = getattr(document, name)
+                coll = getattr(document, field.name)
                 doc_state[name] = coll._to_dict()
             elif hasattr(field, 'Document'):
-                doc = getattr(document, name)
+                doc = getattr(document, field.name)
                 doc_state[name] = doc._to_dict()
 
-        data = json.dumps(doc_state)
-        params['data'] = data
+        return doc_state
+
+    def _partial_state(self, document, doc_state, update_fields):
+        """Return the changed fields of ``doc_state`` to send with a PATCH
+        request, or ``None`` if the whole state is sent with a PUT
+        request."""
+        if update_fields is None or not self._get_partial_updates(document):
+            return None
+
+        names = set(update_fields)
+        map_hooks = document._meta.map_hooks
+        for name in update_fields:
+            if name in map_hooks:
+                names.add(map_hooks[name](document))
+
+        return dict((name, value) for name, value in doc_state.iteritems()
+                if name in names)
+
+    def fetch_all(self, documents, *args, **kwargs):
+        """Fetch all ``documents`` concurrently, see ``fetch``. Return a list
+        with the state of each document in the same order, the state of a
+        document that couldn't be found is ``None``."""
+        def fetch(document):
+            try:
+                return identity.fetch_state(document,
+                        partial(document._backend_manager.fetch, document,
+                            *args, **kwargs),
+                        credentials=credentials_key(kwargs))
+            except BackendDoesNotExist:
+                return None
+
+        jobs = [partial(fetch, document) for document in documents]
+        if len(documents) > 0:
+            max_workers = self._get_max_workers(documents[0])
+        else:
+            max_workers = 1
+
+        return run_concurrently(jobs, max_workers)
+
+    def save(self, document, *args, **kwargs):
+        self._save_document(document, hasattr(self, 'response'), *args,
+                **kwargs)
+
+    def bulk_save(self, documents, batch_size=None, *args, **kwargs):
+        """Save all ``documents``, see ``save``. The documents are saved in
+        batches of ``batch_size``, the documents of a batch concurrently.
+        The resources of documents that have been fetched already exist, the
+        others are probed first to decide whether to create or to update
+        them."""
+        if not batch_size:
+            batch_size = max(len(documents), 1)
+
+        for start in range(0, len(documents), batch_size):
+            jobs = [partial(document._backend_manager._save_document,
+                document, hasattr(document._backend_manager, 'response'),
+                *args, **kwargs)
+                for document in documents[start:start + batch_size]]
+            run_concurrently(jobs, self._get_max_workers(documents[start]))
+
+    def _save_document(self, document, fetched, *args, **kwargs):
+        """Save ``document``. Whether its resource is created with a POST or
+        updated with a PUT request depends on the write strategy. If the
+        resource has been ``fetched`` already, it exists. An existing
+        resource is updated with a PATCH request if partial updates are
+        enabled and the changed fields are known."""
+        update_fields = kwargs.pop('update_fields', None)
+        params = {}
+
+        if 'username' in kwargs and 'password' in kwargs:
+            # we enable authentication
+            auth = HTTPBasicAuth(kwargs['username'], kwargs['password'])
+            params['auth'] = auth
 
         if self.SSL_CERT:
             params['verify'] = self.SSL_CERT
 
-        # fetch the resource if its not yet fetched. Catch for a backend error,
-        # but do create the resource if the error is a 404 NOT FOUND return
-        # code.
-        if not hasattr(self, 'response'):
+        # The state is serialized before the resource is probed, a probe
+        # with a fetch updates the document.
+        doc_state = self._save_state(document)
+        data = codec.dumps(doc_state)
+        partial_state = self._partial_state(document, doc_state,
+                update_fields)
+
+        probe = self._get_probe(document, fetched)
+        if probe == 'head':
+            exists = self._head(document, params)
+        elif probe == 'fetch':
+            # fetch the resource if its not yet fetched. Catch for a backend
+            # error, but do create the resource if the error is a 404 NOT
+            # FOUND return code.
             try:
                 document.fetch(*args, **kwargs)
+                exists = True
             except BackendDoesNotExist:
-                # If the resource hasn't been found, we assume we create a new
-                # one, and make a post request. Otherwise we skip to a put
-                # request.
-                response = requests.post(
-                    url=self._get_uri('post', document),
-                    **params)
-                if response.status_code > 399 and \
-                        response.status_code < 599:
-                    # we catch an error
-                    raise HttpBackendError(response.status_code,
-                            response.content)
-                return
-        # We update an existing resource
-        response = requests.put(
-                url=self._get_uri('put', document),
+                exists = False
+        else:
+            exists = probe == 'put'
+
+        params['data'] = data
+        headers = self._get_write_headers(document, exists)
+        if headers:
+            params['headers'] = headers
+
+        if not exists:
+            # If the resource hasn't been found, we assume we create a new
+            # one, and make a post request.
+            response = self._get_client(document).post(
+                url=self._get_uri('post', document),
                 **params)
+            if response.status_code > 399 and \
+                    response.status_code < 599:
+                # we catch an error
+                raise HttpBackendError(response.status_code,
+                        response.content)
+            _etags[document] = response.headers.get('ETag')
+            self._invalidate(document, kwargs)
+            return
+
+        # We update an existing resource
+        if partial_state is not None:
+            params['data'] = codec.dumps(partial_state)
+            response = self._get_client(document).patch(
+                    url=self._get_uri('put', document),
+                    **params)
+        else:
+            response = self._get_client(document).put(
+                    url=self._get_uri('put', document),
+                    **params)
 
         if response.status_code > 399 and \
                 response.status_code < 599:
@@ -215,8 +548,52 @@ class HttpBackendManager(object):
             raise HttpBackendError(response.status_code,
                     response.content)
 
+        _etags[document] = response.headers.get('ETag')
+        self._invalidate(document, kwargs)
         self.response = response
 
+    def _get_probe(self, document, fetched):
+        """Return how to find out whether the resource of ``document``
+        exists: ``'head'`` or ``'fetch'`` to make a request, or ``'put'`` and
+        ``'post'`` if it is known already."""
+        strategy = self._get_write_strategy(document)
+        if strategy in ('put', 'post'):
+            return strategy
+        elif strategy == 'conditional':
+            if _etags.get(document) is not None:
+                return 'put'
+            return 'head'
+        elif fetched:
+            return 'put'
+        elif strategy == 'head':
+            return 'head'
+        return 'fetch'
+
+    def _get_write_headers(self, document, exists):
+        """Return the precondition headers of the conditional write
+        strategy."""
+        if self._get_write_strategy(document) != 'conditional':
+            return {}
+        if not exists:
+            return {'If-None-Match': '*'}
+        if _etags.get(document) is not None:
+            return {'If-Match': _etags[document]}
+        return {}
+
+    def _head(self, document, params):
+        """Check with a HEAD request whether the resource of ``document``
+        exists, and remember its ETag."""
+        response = self._get_client(document).head(
+                url=self._get_uri('get', document), **params)
+
+        if response.status_code == 404:
+            return False
+        if response.status_code > 399 and response.status_code < 599:
+            raise HttpBackendError(response.status_code, response.content)
+
+        _etags[document] = response.headers.get('ETag')
+        return True
+
     def delete(self, document, *args, **kwargs):
         params = {}
         if 'username' in kwargs and 'password' in kwargs:
@@ -230,7 +607,7 @@ class HttpBackendManager(object):
         # first make a GET request to see if the resource exists
         #if not hasattr(self, 'response'):
         #    self.fetch(document, *args, **kwargs)
-        response = requests.delete(
+        response = self._get_client(document).delete(
                 url=self._get_uri('delete', document), **params)
 
         if response.status_code > 399 and \
@@ -239,4 +616,5 @@ class HttpBackendManager(object):
             raise HttpBackendError(response.status_code,
                     response.content)
 
+        self._invalidate(document, kwargs)
         self.response = response
@@ -0,0 +1,382 @@
+""" asynchronous http backend for docar
+
+The asynchronous http backend speaks the same JSON messages as the http
+backend, but makes its requests with ``aiohttp`` on an asyncio event loop.
+Related documents and the items of collections are fetched concurrently, at
+most ``max_workers`` at the same time. Documents of this backend are used with
+the coroutines ``afetch``, ``asave`` and ``adelete``::
+
+    class Article(Document):
+        id = fields.NumberField()
+
+        class Meta:
+            backend_type = 'http_async'
+
+    article = Article({'id': 1})
+    await article.afetch()
+
+The blocking methods ``fetch``, ``save`` and ``delete`` still work like for
+the http backend. This backend requires python 3.7 and ``aiohttp``, which is
+installed with the ``async`` extra of docar.
+
+"""
+import asyncio
+import ssl
+import weakref
+
+import aiohttp
+import requests
+
+from functools import partial
+
+from docar import codec
+from docar import identity
+from docar.cache import credentials_key
+from docar.documents import Document
+from docar.exceptions import (HttpBackendError, BackendDoesNotExist,
+        ValidationError)
+
+from .http import HttpBackendManager, _etags
+
+
+# The futures of the fetches that are running in an identity map scope, so
+# that concurrent coroutines wait for the same fetch.
+_pending = weakref.WeakKeyDictionary()
+
+
+async def gather_concurrently(jobs, max_workers=1):
+    """Await the coroutines returned by the functions in ``jobs`` and return
+    their results in the same order. At most ``max_workers`` coroutines run at
+    the same time.
+
+    If any coroutine raises an exception, the exception of the first failing
+    function in ``jobs`` is raised, no matter in which order they failed.
+    """
+    semaphore = asyncio.Semaphore(max(max_workers, 1))
+
+    async def call(job):
+        async with semaphore:
+            return await job()
+
+    outcomes = await asyncio.gather(*[call(job) for job in jobs],
+            return_exceptions=True)
+
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+
+    return outcomes
+
+
+class HttpAsyncBackendManager(HttpBackendManager):
+    # An ``aiohttp.ClientSession`` used for all requests. Without a session,
+    # every request opens its own. Use the ``session`` meta option of a
+    # document to set a session for a single document class.
+    SESSION = None
+    # The number of related documents and collection items that are fetched
+    # at the same time. Use the ``max_workers`` meta option of a document to
+    # set it for a single document class.
+    MAX_WORKERS = 10
+
+    def _get_client(self, document):
+        """The blocking methods make their requests using ``requests``, the
+        session of this backend is only used by the coroutines."""
+        return requests
+
+    def _get_params(self, kwargs):
+        params = {}
+        if 'username' in kwargs and 'password' in kwargs:
+            # we enable authentication
+            params['auth'] = aiohttp.BasicAuth(kwargs['username'],
+                    kwargs['password'])
+        if self.SSL_CERT:
+            params['ssl'] = ssl.create_default_context(cafile=self.SSL_CERT)
+
+        return params
+
+    async def _request(self, method, document, url, **params):
+        """Make a request and return the response together with its
+        content."""
+        session = document._meta.session or self.SESSION
+        if session is not None:
+            async with session.request(method, url, **params) as response:
+                return response, await response.read()
+
+        async with aiohttp.ClientSession() as session:
+            async with session.request(method, url, **params) as response:
+                return response, await response.read()
+
+    async def _afetch_related(self, document, kwargs):
+        """Return the fetched state of a related document. Related documents
+        of a blocking backend are fetched in a thread."""
+        manager = document._backend_manager
+        if hasattr(manager, 'afetch'):
+            return await self._afetch_state(document,
+                    partial(manager.afetch, document, **kwargs), kwargs)
+
+        loop = asyncio.get_running_loop()
+        return await self._afetch_state(document,
+                partial(loop.run_in_executor, None,
+                    partial(identity.call_in_scope, identity.current_map(),
+                        manager.fetch, document, **kwargs)), kwargs)
+
+    async def _afetch_state(self, document, fetch, kwargs):
+        """Return the state of ``document`` awaited from ``fetch``, only once
+        per identity map scope, see ``docar.identity``."""
+        scope = identity.current_map()
+        key = None
+        if scope is not None and scope.share_states:
+            key = identity.identity_key(document,
+                    credentials=credentials_key(kwargs))
+        if key is None:
+            return await fetch()
+
+        found, state = scope.lookup(key)
+        if found:
+            return state
+
+        pending = _pending.setdefault(scope, {})
+        if key in pending:
+            return await asyncio.shield(pending[key])
+
+        future = pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            state = await fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            # The waiting coroutines get the error, nobody else needs it
+            future.exception()
+            raise
+        else:
+            scope.store(key, state)
+            future.set_result(state)
+        finally:
+            del pending[key]
+
+        return state
+
+    async def _afetch_item(self, document, kwargs):
+        """Fetch an item of a collection, only the credentials are handed on
+        to the fetch."""
+        if 'username' in kwargs and 'password' in kwargs:
+            kwargs = {'username': kwargs['username'],
+                    'password': kwargs['password']}
+        else:
+            kwargs = {}
+
+        if hasattr(document._backend_manager, 'afetch'):
+            await document.afetch(**kwargs)
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None,
+                    partial(identity.call_in_scope, identity.current_map(),
+                        document.fetch, **kwargs))
+
+    async def afetch(self, document, *args, **kwargs):
+        """Fetch the resource as a JSON message from an HTTP endpoint and
+        return it as a python dict, see ``fetch``."""
+        params = self._get_params(kwargs)
+
+        # Send a conditional request if the resource has been cached before
+        url = self._get_uri('get', document)
+        cache = self._get_cache(document)
+        entry = None
+        if cache is not None:
+            entry = cache.get(self._get_cache_key(url, kwargs))
+            if entry is not None:
+                params['headers'] = self._get_conditional_headers(entry)
+
+        response, content = await self._request('GET', document, url,
+                **params)
+        self.response = response
+
+        if response.status == 304 and entry is not None:
+            # The resource didn't change, use the cached message
+            _etags[document] = entry.etag
+            return await self._afinish_fetch(document, entry.payload, kwargs)
+
+        # If the response is a 404, than the resource couldn't be found
+        if response.status == 404:
+            raise BackendDoesNotExist(response.status, content)
+
+        # Responses with a code of 4XX or 5XX are raising an error
+        if (response.status > 399) and (response.status < 599):
+            raise HttpBackendError(response.status, content)
+
+        _etags[document] = response.headers.get('ETag')
+
+        if not content:
+            return {}
+
+        instance = codec.loads(content)
+        if cache is not None:
+            self._cache_response(cache, self._get_cache_key(url, kwargs),
+                    response.headers, instance)
+
+        return await self._afinish_fetch(document, instance, kwargs)
+
+    async def _afinish_fetch(self, document, instance, kwargs):
+        """Return the state of ``document`` from its parsed message and its
+        fetched related documents."""
+        self.instance = instance
+
+        data, related, jobs = self._prepare_dict(document, instance, kwargs,
+                self._afetch_related, self._afetch_item)
+        results = await gather_concurrently(jobs,
+                self._get_max_workers(document))
+
+        return self._finish_dict(data, related, results)
+
+    async def afetch_document(self, document, *args, **kwargs):
+        """Fetch the resource and build ``document`` from it."""
+        state = document._cached_state(kwargs)
+        if state is not None:
+            document._from_fetched(state)
+            return
+
+        document._from_backend(await self._afetch_state(document,
+                partial(self.afetch, document, *args, **kwargs), kwargs),
+                kwargs)
+
+    async def afetch_all(self, collection, documents, *args, **kwargs):
+        """Fetch ``documents`` concurrently and add them to ``collection`` in
+        their order, once all of them are fetched."""
+        document_class = collection.document
+        jobs = [partial(doc._backend_manager.afetch_document, doc, *args,
+            **kwargs) for doc in documents]
+        await gather_concurrently(jobs, self._get_max_workers(document_class))
+
+        for doc in documents:
+            collection.add(doc)
+
+    async def avalidate(self, document, *args, **kwargs):
+        """Validate ``document`` like ``Document.validate``. Foreign documents
+        that might only reference an existing document by their identifier
+        are fetched concurrently, with ``afetch`` if their backend has it.
+        Documents that override ``validate`` are validated in a thread."""
+        loop = asyncio.get_running_loop()
+        if type(document).validate is not Document.validate:
+            return await loop.run_in_executor(None,
+                    partial(identity.call_in_scope, identity.current_map(),
+                        document.validate, *args, **kwargs))
+
+        errors, references = document._meta.validator.check(document)
+        jobs = [partial(self._afetch_reference, value, args, kwargs)
+                for name, value, message in references]
+        found = await gather_concurrently(jobs,
+                self._get_max_workers(document))
+        for (name, value, message), exists in zip(references, found):
+            if not exists:
+                errors[name] = message
+
+        if errors:
+            raise ValidationError(errors)
+
+        return True
+
+    async def _afetch_reference(self, document, args, kwargs):
+        """Fetch a foreign document to validate it and return whether it
+        exists."""
+        try:
+            if hasattr(document._backend_manager, 'afetch_document'):
+                await document.afetch(*args, **kwargs)
+            else:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None,
+                        partial(identity.call_in_scope,
+                            identity.current_map(), document.fetch, *args,
+                            **kwargs))
+        except BackendDoesNotExist:
+            return False
+
+        return True
+
+    async def asave(self, document, *args, **kwargs):
+        """Save the resource to an HTTP endpoint, see ``save``."""
+        update_fields = kwargs.pop('update_fields', None)
+        if update_fields is not None and len(update_fields) < 1:
+            # Nothing changed, nothing to save
+            return
+
+        await self.avalidate(document, *args, **kwargs)
+
+        params = self._get_params(kwargs)
+        state = document._to_dict()
+        doc_state = self._save_state(document)
+        data = codec.dumps(doc_state)
+        partial_state = self._partial_state(document, doc_state,
+                update_fields)
+
+        probe = self._get_probe(document, hasattr(self, 'response'))
+        if probe == 'head':
+            exists = await self._ahead(document, params)
+        elif probe == 'fetch':
+            try:
+                await self.afetch_document(document, *args, **kwargs)
+                exists = True
+            except BackendDoesNotExist:
+                exists = False
+        else:
+            exists = probe == 'put'
+
+        params['data'] = data
+        headers = self._get_write_headers(document, exists)
+        if headers:
+            params['headers'] = headers
+
+        if not exists:
+            # The resource doesn't exist, we create a new one
+            response, content = await self._request('POST', document,
+                    self._get_uri('post', document), **params)
+            if response.status > 399 and response.status < 599:
+                raise HttpBackendError(response.status, content)
+            _etags[document] = response.headers.get('ETag')
+            self._invalidate(document, kwargs)
+            document._forget(kwargs)
+            document._fetched_state = state
+            return
+
+        # We update an existing resource
+        method = 'PUT'
+        if partial_state is not None:
+            method = 'PATCH'
+            params['data'] = codec.dumps(partial_state)
+        response, content = await self._request(method, document,
+                self._get_uri('put', document), **params)
+
+        if response.status > 399 and response.status < 599:
+            raise HttpBackendError(response.status, content)
+
+        _etags[document] = response.headers.get('ETag')
+        self._invalidate(document, kwargs)
+        document._forget(kwargs)
+        document._fetched_state = state
+        self.response = response
+
+    async def _ahead(self, document, params):
+        """Check with a HEAD request whether the resource of ``document``
+        exists, and remember its ETag."""
+        response, content = await self._request('HEAD', document,
+                self._get_uri('get', document), **params)
+
+        if response.status == 404:
+            return False
+        if response.status > 399 and response.status < 599:
+            raise HttpBackendError(response.status, content)
+
+        _etags[document] = response.headers.get('ETag')
+        return True
+
+    async def adelete(self, document, *args, **kwargs):
+        """Delete the resource on an HTTP endpoint."""
+        params = self._get_params(kwargs)
+
+        response, content = await self._request('DELETE', document,
+                self._get_uri('delete', document), **params)
+
+        if response.status > 399 and response.status < 599:
+            raise HttpBackendError(response.status, content)
+
+        self._invalidate(document, kwargs)
+        document._forget(kwargs)
+        self.response = response
@@ -0,0 +1,252 @@
+"""Caches for HTTP responses and fetched documents.
+
+The http backend can remember the ``ETag`` and ``Last-Modified`` headers of
+the resources it fetches, together with the parsed JSON message. On the next
+fetch it sends a conditional request, and if the endpoint answers with ``304
+Not Modified``, the document is built from the cached message again without
+downloading and parsing it::
+
+    from docar.backends.http import HttpBackendManager
+    from docar.cache import LRUCache
+
+    HttpBackendManager.CACHE = LRUCache(maxsize=10000)
+
+A cache maps keys to values with the methods ``get``, ``set`` and
+``delete``. ``LRUCache`` keeps the entries in memory, ``FileCache`` stores
+them on disk, ``MemcacheCache`` and ``RedisCache`` store them on a memcached
+or redis server. Any object with those methods can be used as a cache.
+
+Documents can be cached as well. Set the ``document_cache`` meta option, and
+``fetch`` looks up the fetched state of the document in the cache before it
+asks the backend::
+
+    class Article(Document):
+        id = fields.NumberField()
+
+        class Meta:
+            backend_type = 'http'
+            document_cache = LRUCache(maxsize=500, ttl=60)
+
+Saving or deleting a document removes it from the cache, for all users. How
+often the cache was used is counted in ``Article._meta.cache_stats``.
+
+"""
+from __future__ import absolute_import
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+
+from collections import namedtuple, OrderedDict
+
+
+# A cached response, ``payload`` is the parsed JSON message.
+CacheEntry = namedtuple('CacheEntry', 'etag last_modified payload')
+
+
+class LRUCache(object):
+    """Keep the ``maxsize`` most recently used entries in memory. If ``ttl``
+    is set, entries expire ``ttl`` seconds after they were set."""
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Map the keys to the time the entry expires and the value
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires <= time.time():
+                return None
+            # Mark the entry as the most recently used one
+            self.entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FileCache(object):
+    """Store the entries as files in ``directory``, one file per key."""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as fd:
+                stored_key, value = pickle.load(fd)
+        except Exception:
+            # A missing or broken entry is a cache miss
+            return None
+        if stored_key != key:
+            return None
+        return value
+
+    def set(self, key, value):
+        # Write to a temporary file first, so that a reader never sees a
+        # partially written entry.
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                pickle.dump((key, value), tmp, pickle.HIGHEST_PROTOCOL)
+            os.rename(path, self._path(key))
+        except Exception:
+            os.remove(path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+
+
+class MemcacheCache(object):
+    """Store the entries on a memcached server. ``client`` is a memcached
+    client like ``memcache.Client`` or ``pymemcache.Client``, with the methods
+    ``get``, ``set`` and ``delete``. The entries expire after ``ttl`` seconds,
+    never if it is ``0``."""
+    def __init__(self, client, ttl=0, prefix='docar:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        # memcached keys are limited in length and must not contain spaces
+        return self.prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        data = self.client.get(self._key(key))
+        if data is None:
+            return None
+        stored_key, value = pickle.loads(data)
+        if stored_key != key:
+            return None
+        return value
+
+    def set(self, key, value):
+        self.client.set(self._key(key),
+                pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL), self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+class RedisCache(MemcacheCache):
+    """Store the entries on a redis server. ``client`` is a redis client like
+    ``redis.StrictRedis``. The entries expire after ``ttl`` seconds, never if
+    it is ``None``."""
+    def __init__(self, client, ttl=None, prefix='docar:'):
+        super(RedisCache, self).__init__(client, ttl, prefix)
+
+    def set(self, key, value):
+        data = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+        if self.ttl is None:
+            self.client.set(self._key(key), data)
+        else:
+            self.client.setex(self._key(key), self.ttl, data)
+
+
+class CacheStats(object):
+    """Count how often documents were found in their cache."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __repr__(self):
+        return '<CacheStats hits=%s misses=%s invalidations=%s>' % (
+                self.hits, self.misses, self.invalidations)
+
+
+def document_key(document, credentials=None):
+    """Return the cache key of ``document``, made of its class, identifier and
+    context. ``credentials`` tells apart documents fetched by different
+    users."""
+    cls = type(document)
+    return '%s.%s:%r:%r:%r' % (cls.__module__, cls.__name__,
+            sorted(document._identifier_state().items()),
+            sorted(document._get_context().items()), credentials)
+
+
+def credentials_key(kwargs):
+    """Return a digest of the credentials among the arguments ``kwargs`` of
+    a fetch, or ``None`` without credentials. The password is part of it, a
+    fetch with a wrong password doesn't find the state fetched with the
+    right one, and the password itself isn't stored in the cache keys."""
+    username = kwargs.get('username')
+    password = kwargs.get('password')
+    if username is None and password is None:
+        return None
+    credentials = repr((username, password)).encode('utf-8')
+    return hashlib.sha256(credentials).hexdigest()
+
+
+def state_key(cache, document, credentials=None, create=False):
+    """Return the key of the cached state of ``document`` fetched with
+    ``credentials``, see ``credentials_key``.
+
+    The states of a resource fetched by different users are cached under
+    keys with the same version, which is stored in ``cache`` under the
+    ``document_key`` of the resource. ``forget_document`` removes the
+    version, so the states of all users are gone at once, also for other
+    processes using the same cache. If the resource has no version yet, a
+    new one is set if ``create`` is set, otherwise ``None`` is returned."""
+    version_key = document_key(document)
+    version = cache.get(version_key)
+    if version is None:
+        if not create:
+            return None
+        version = uuid.uuid4().hex
+        cache.set(version_key, version)
+
+    return '%s#%s:%r' % (version_key, version, credentials)
+
+
+def forget_document(cache, document):
+    """Remove the cached states of ``document`` for all users."""
+    cache.delete(document_key(document))
@@ -0,0 +1,114 @@
+"""Pluggable json codecs.
+
+Documents, collections and the http backend serialize to and from json using
+the current codec of this module. The json module of the python standard
+library is the default. Adapters for faster json libraries are registered if
+those libraries can be imported::
+
+    from docar import codec
+
+    codec.available_codecs()  # eg. ['json', 'simplejson', 'ujson']
+    codec.set_codec('ujson')
+
+"""
+import json
+
+
+class JsonCodec(object):
+    """The json module of the python standard library."""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class SimplejsonCodec(JsonCodec):
+    """An adapter for the ``simplejson`` library."""
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.module = simplejson
+
+    def dumps(self, obj):
+        return self.module.dumps(obj)
+
+    def loads(self, data):
+        return self.module.loads(data)
+
+
+class UjsonCodec(SimplejsonCodec):
+    """An adapter for the ``ujson`` library."""
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.module = ujson
+
+
+class OrjsonCodec(SimplejsonCodec):
+    """An adapter for the ``orjson`` library. ``orjson`` serializes to bytes,
+    the adapter returns strings like the other codecs."""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.module = orjson
+
+    def dumps(self, obj):
+        return self.module.dumps(obj).decode('utf-8')
+
+
+_codecs = {}
+_codec = None
+
+
+def register_codec(codec):
+    """Make ``codec`` available by its name."""
+    _codecs[codec.name] = codec
+
+
+def available_codecs():
+    """Return a list of the names of all registered codecs."""
+    return sorted(_codecs.keys())
+
+
+def get_codec(name=None):
+    """Return the codec registered as ``name``, or the current codec if no
+    name is given."""
+    if name is None:
+        return _codec
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("The json codec %s is not available." % name)
+
+
+def set_codec(name):
+    """Use the codec registered as ``name`` from now on."""
+    global _codec
+    _codec = get_codec(name)
+
+
+def dumps(obj):
+    """Serialize ``obj`` to json using the current codec."""
+    return _codec.dumps(obj)
+
+
+def loads(data):
+    """Deserialize the json string ``data`` using the current codec."""
+    return _codec.loads(data)
+
+
+# Register the codecs of all json libraries that can be imported
+register_codec(JsonCodec())
+for Codec in (SimplejsonCodec, UjsonCodec, OrjsonCodec):
+    try:
+        register_codec(Codec())
+    except ImportError:
+        pass
+
+set_codec('json')
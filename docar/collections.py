@@ -1,7 +1,27 @@
-import json
-
+from . import codec
+from . import identity
+from .columns import ColumnBatch, clean_columns
 from .documents import Document
-from .exceptions import CollectionNotBound
+from .exceptions import (CollectionNotBound, BackendDoesNotExist,
+        ValidationError)
+
+
+def _get_validator(cls):
+    """Return a function that returns the errors of a document of the class
+    ``cls``. Document classes that don't override ``validate`` use their
+    compiled validator directly, without raising and catching an error for
+    each invalid document."""
+    if cls.validate == Document.validate:
+        return cls._meta.validator
+
+    def validate(document, *args, **kwargs):
+        try:
+            document.validate(*args, **kwargs)
+        except ValidationError, e:
+            return e.message
+        return {}
+
+    return validate
 
 
 class Collection(object):
@@ -22,6 +42,9 @@ class Collection(object):
     document = None
     bound = False
     _context = {}
+    # A queryset and its chunk size, streamed when the collection is
+    # rendered, see ``_from_queryset``.
+    _stream = None
 
     def __init__(self, documents=None):
         if not self.document:
@@ -57,36 +80,194 @@ class Collection(object):
         if len(self.collection_set) < 1:
             self.bound=False
 
-    def fetch_all(self, query_list=[]):
-        # FIXME: Make this a method to run a fetch command on all documents in
-        # the collection set
-        for item in query_list:
-            doc = self.document(item)
-            doc.fetch()
-            self.add(doc)
+    def fetch_all(self, query_list=[], *args, **kwargs):
+        """Fetch a document for each item of ``query_list`` and add them to
+        the collection in the same order. The backend fetches all documents
+        at once.
+
+        If documents couldn't be found, the found documents are added and a
+        ``BackendDoesNotExist`` error is raised afterwards. Its second
+        argument is the list of identifiers of the missing documents.
+        """
+        documents = [self.document(item) for item in query_list]
+
+        # Only documents that are not in the document cache are fetched
+        cached = [doc._cached_state(kwargs) for doc in documents]
+        fetched = [doc for doc, state in zip(documents, cached)
+                if state is None]
+
+        missing = []
+        # The scope keeps the backend objects of the related documents until
+        # the documents are built
+        with identity.object_scope():
+            states = iter(self.document._backend_manager.fetch_all(fetched,
+                    *args, **kwargs))
+
+            for doc, state in zip(documents, cached):
+                if state is not None:
+                    doc._from_fetched(state)
+                    self.add(doc)
+                    continue
+                state = next(states)
+                if state is None:
+                    missing.append(doc._identifier_state())
+                    continue
+                doc._from_backend(state, kwargs)
+                self.add(doc)
+
+        if missing:
+            raise BackendDoesNotExist("Fetch failed for %s documents" %
+                    len(missing), missing)
+
+    def validate_all(self, *args, **kwargs):
+        """Validate all documents of the collection and return their errors.
+        The errors are a dictionary that maps the position of each invalid
+        document in the collection to the errors of its fields, it is empty
+        if all documents are valid. Related documents that have to be fetched
+        to validate the documents are fetched once for all documents."""
+        errors = {}
+        validators = {}
+        with identity.identity_map():
+            for position, doc in enumerate(self.collection_set):
+                cls = type(doc)
+                validator = validators.get(cls)
+                if validator is None:
+                    validator = validators[cls] = _get_validator(cls)
+                doc_errors = validator(doc, *args, **kwargs)
+                if doc_errors:
+                    errors[position] = doc_errors
+
+        return errors
+
+    def validate_columns(self, columns):
+        """Validate documents stored as columns, a dictionary of the field
+        names and a list or numpy array of values for each field. Return the
+        errors of the rows like ``validate_all``, without building the
+        documents. See ``docar.columns``."""
+        return clean_columns(self.document, columns)[2]
+
+    def from_columns(self, columns):
+        """Clean documents stored as columns, see ``validate_columns``, and
+        return a ``ColumnBatch`` with the converted columns and the errors of
+        the rows. The documents are built from the converted values, only when
+        they are asked for::
+
+            batch = articles.from_columns(columns)
+            articles = batch.collection()
+
+        """
+        return ColumnBatch(type(self), columns)
+
+    def save_all(self, batch_size=None, *args, **kwargs):
+        """Validate all documents of the collection and save them with one
+        call to the backend. Nothing is saved if a document doesn't validate.
+        The backend writes ``batch_size`` documents at a time, all at once if
+        it is not set."""
+        # Related documents are fetched once for all documents
+        with identity.identity_map():
+            for doc in self.collection_set:
+                doc.validate(*args, **kwargs)
+
+            if len(self.collection_set) > 0:
+                self.document._backend_manager.bulk_save(self.collection_set,
+                        batch_size, *args, **kwargs)
+
+        for doc in self.collection_set:
+            doc._forget(kwargs)
+
+    def afetch_all(self, query_list=[], *args, **kwargs):
+        """Return a coroutine that fetches a document for each item of
+        ``query_list`` concurrently and adds them to the collection in the
+        same order. The document has to use an asynchronous backend like
+        ``http_async``."""
+        documents = [self.document(item) for item in query_list]
+
+        return self.document._backend_manager.afetch_all(self, documents,
+                *args, **kwargs)
+
+    def _from_queryset(self, qs, chunk_size=None, stream=False):
+        """Add a document for each model instance of ``qs``.
+
+        With a ``chunk_size``, the instances are read with ``qs.iterator``
+        in chunks, without filling the result cache of the queryset. If
+        ``stream`` is set, the documents are not built now, but each time the
+        collection is rendered, one chunk at a time.
+        """
+        if stream:
+            self._stream = (qs, chunk_size or 2000)
+            self.bound = True
+            return
+
+        if chunk_size is None:
+            for model in qs:
+                doc = self.document()
+                doc._from_model(model)
+                self.add(doc)
+            return
+
+        for chunk in self.iter_queryset(qs, chunk_size):
+            for doc in chunk:
+                self.add(doc)
 
-    def _from_queryset(self, qs):
-        for model in qs:
+    def iter_queryset(self, qs, chunk_size=2000):
+        """Yield lists of at most ``chunk_size`` documents, built from the
+        model instances of ``qs``. The instances are read with
+        ``qs.iterator``, so neither the queryset nor the collection keeps
+        them."""
+        if hasattr(qs, 'iterator'):
+            try:
+                models = qs.iterator(chunk_size=chunk_size)
+            except TypeError:
+                # django before 2.0 doesn't know the chunk size
+                models = qs.iterator()
+        else:
+            models = iter(qs)
+
+        chunk = []
+        for model in models:
             doc = self.document()
             doc._from_model(model)
-            self.add(doc)
+            chunk.append(doc)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def iter_rendered(self, qs, chunk_size=2000):
+        """Yield lists of at most ``chunk_size`` rendered documents, built
+        from the model instances of ``qs``, see ``iter_queryset``."""
+        for chunk in self.iter_queryset(qs, chunk_size):
+            yield [self._render_item(document) for document in chunk]
+
+    def _iter_chunks(self):
+        """Yield the documents of the collection in lists, the added
+        documents first, then the documents streamed from a queryset."""
+        if self.collection_set:
+            yield self.collection_set
+        if self._stream is not None:
+            qs, chunk_size = self._stream
+            for chunk in self.iter_queryset(qs, chunk_size):
+                yield chunk
 
     def render(self):
-        data = {
-                'size': len(self.collection_set),
-                }
         items = []
+        for chunk in self._iter_chunks():
+            for document in chunk:
+                items.append(self._render_item(document))
 
-        for document in self.collection_set:
-            item = document.to_python()
-            #we change the relation attribute of this document
-            if 'link' in item:
-                item['link']['rel'] = 'item'
-            items.append(item)
+        return {
+                'size': len(items),
+                'items': items,
+                }
 
-        data['items'] = items
+    def _render_item(self, document):
+        item = document.to_python()
+        #we change the relation attribute of this document
+        if 'link' in item:
+            item['link']['rel'] = 'item'
 
-        return data
+        return item
 
     def _to_dict(self):
         data = []
@@ -108,4 +289,65 @@ class Collection(object):
         return data
 
     def to_json(self):
-        return json.dumps(self.to_python())
+        if self._stream is not None:
+            # Don't keep the rendered documents of the stream in memory
+            return ''.join(self.iter_json())
+        return codec.dumps(self.to_python())
+
+    def iter_json(self):
+        """Render the collection as json, one document at a time.
+
+        This yields the json message in chunks, the envelope first and then
+        each document of the collection. Only one document is rendered at a
+        time, so big collections can be streamed, eg. as the body of a WSGI
+        response, without building the whole message in memory.
+
+        A collection streaming a queryset yields a chunk of documents at a
+        time. Its size isn't known before all documents are rendered, so it
+        comes after the items.
+        """
+        if self._stream is not None:
+            for chunk in self._iter_streamed_json():
+                yield chunk
+            return
+
+        yield '{"size": %s, "items": [' % codec.dumps(len(self.collection_set))
+
+        separator = ''
+        for document in self.collection_set:
+            yield separator + codec.dumps(self._render_item(document))
+            separator = ', '
+
+        yield ']'
+        for chunk in self._iter_json_end():
+            yield chunk
+
+    def _iter_streamed_json(self):
+        yield '{"items": ['
+
+        size = 0
+        separator = ''
+        for chunk in self._iter_chunks():
+            yield separator + ', '.join(codec.dumps(self._render_item(doc))
+                    for doc in chunk)
+            separator = ', '
+            size += len(chunk)
+
+        yield '], "size": %s' % codec.dumps(size)
+        for chunk in self._iter_json_end():
+            yield chunk
+
+    def _iter_json_end(self):
+        """Yield the end of the json message, with the link of the
+        collection."""
+        if hasattr(self, 'uri'):
+            yield ', "link": %s' % codec.dumps({
+                'rel': 'self',
+                'href': self.uri()
+                })
+        yield '}'
+
+    def write_json(self, fp):
+        """Write the collection as json to the file like object ``fp``."""
+        for chunk in self.iter_json():
+            fp.write(chunk)
@@ -0,0 +1,301 @@
+"""Clean documents that are stored as columns.
+
+Bulk imports often come as columns, a list of values for each field, like a
+parsed CSV file or a set of numpy arrays. Building a document for each row and
+validating it converts every value on its own. ``Collection.validate_columns``
+and ``Collection.from_columns`` convert and check a whole column at a time
+instead, and build documents only for the rows that are used::
+
+    batch = Articles().from_columns({
+        'id': [1, 2, 'three'],
+        'title': ['one', 'two', 'three'],
+        })
+
+    batch.errors  # {2: {'id': 'Must be an integer.'}}
+    articles = batch.collection()  # The documents of the valid rows
+
+The columns are cleaned with the same rules as ``Document.validate``, the
+errors of a row are the errors its document would raise. Foreign documents
+and collections are not validated, their columns are handed on to the
+documents as they are.
+
+Columns can be lists or numpy arrays. numpy is optional, if it is installed,
+arrays of integers and booleans are converted and choices are looked up
+without looking at each value in python.
+
+"""
+from .compiler import validation_plan, VALUE, CLEAN
+from .exceptions import ValidationError
+from .fields import (NumberField, StringField, BooleanField, ChoicesField,
+        ForeignDocument, CollectionField, NOT_PROVIDED)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+TRUE_VALUES = ('t', 'True', 'true', 1)
+FALSE_VALUES = ('f', 'False', 'false', 0)
+BOOLEANS = dict([(value, True) for value in TRUE_VALUES] +
+        [(value, False) for value in FALSE_VALUES])
+
+
+def _is_array(values):
+    return numpy is not None and isinstance(values, numpy.ndarray)
+
+
+def _to_list(values):
+    """Return a new list of the values of a column."""
+    if _is_array(values):
+        return values.tolist()
+    return list(values)
+
+
+def _number_column(field, values):
+    if _is_array(values) and values.dtype.kind in 'biu':
+        # Booleans are integers in python too
+        return values.tolist(), {}
+
+    cleaned = _to_list(values)
+    default = field.default
+    errors = {}
+    for row, value in enumerate(cleaned):
+        if isinstance(value, int):
+            continue
+        elif value is None and default is not NOT_PROVIDED:
+            cleaned[row] = default
+        else:
+            errors[row] = 'Must be an integer.'
+
+    return cleaned, errors
+
+
+def _string_column(field, values):
+    cleaned = _to_list(values)
+    for row, value in enumerate(cleaned):
+        if value is not None and not isinstance(value, str):
+            cleaned[row] = str(value)
+
+    return cleaned, {}
+
+
+def _boolean_column(field, values):
+    if _is_array(values) and values.dtype.kind == 'b':
+        return values.tolist(), {}
+    if _is_array(values) and values.dtype.kind in 'iu':
+        invalid = numpy.flatnonzero((values != 0) & (values != 1))
+        return (values != 0).tolist(), dict((row, 'Must be either True or '
+            'False') for row in invalid.tolist())
+
+    cleaned = _to_list(values)
+    errors = {}
+    for row, value in enumerate(cleaned):
+        if value is True or value is False:
+            continue
+        try:
+            cleaned[row] = BOOLEANS[value]
+        except (KeyError, TypeError):
+            errors[row] = 'Must be either True or False'
+
+    return cleaned, errors
+
+
+def _same_kind(values, choices):
+    """Return whether numpy can compare the array ``values`` with
+    ``choices``, without converting them to another type."""
+    if values.dtype.kind in 'iu':
+        return all(isinstance(choice, (int, long))
+                and not isinstance(choice, bool) for choice in choices)
+    if values.dtype.kind in 'SU':
+        return all(isinstance(choice, basestring) for choice in choices)
+    return False
+
+
+def _choices_column(field, values):
+    choices = field.choices
+    if (_is_array(values) and len(choices) > 0
+            and _same_kind(values, choices)):
+        invalid = numpy.flatnonzero(~numpy.isin(values, list(choices)))
+        cleaned = values.tolist()
+        return cleaned, dict((row, '%s is not a valid choice.' % (cleaned[row],))
+                for row in invalid.tolist())
+
+    cleaned = _to_list(values)
+    is_choice = field.is_choice
+    errors = {}
+    for row, value in enumerate(cleaned):
+        if not is_choice(value):
+            errors[row] = '%s is not a valid choice.' % (value,)
+
+    return cleaned, errors
+
+
+# The column converters of the fields, by the ``to_python`` method they
+# replace
+CONVERTERS = (
+        (NumberField.to_python, _number_column),
+        (StringField.to_python, _string_column),
+        (BooleanField.to_python, _boolean_column),
+        (ChoicesField.to_python, _choices_column),
+        )
+
+
+def _get_converter(field):
+    to_python = type(field).to_python
+    for method, converter in CONVERTERS:
+        if to_python == method:
+            return converter
+
+    return None
+
+
+def _convert_each(field, values):
+    """Convert the values of a column one at a time, for fields without a
+    column converter."""
+    cleaned = _to_list(values)
+    errors = {}
+    for row, value in enumerate(cleaned):
+        try:
+            cleaned[row] = field.to_python(value)
+        except ValidationError, e:
+            errors[row] = e.message
+
+    return cleaned, errors
+
+
+def _clean_each(field, values, optional):
+    """Clean the values of a column with the ``clean`` method of a field
+    that validates in its own way."""
+    values = _to_list(values)
+    errors = {}
+    for row, value in enumerate(values):
+        if optional and (value is None
+                or (isinstance(value, str) and not value)):
+            continue
+        try:
+            field.clean(value)
+        except ValidationError, e:
+            errors[row] = e.message
+
+    return values, errors
+
+
+def clean_column(field, values, step):
+    """Return the converted values of a column of ``field`` and the errors of
+    its rows. ``step`` is the step of the field in the validation plan of its
+    document, see ``docar.compiler.validation_plan``."""
+    kind, name, optional, arguments = step
+    if kind == CLEAN:
+        return _clean_each(field, values, optional)
+
+    to_python, validators, required = arguments
+    raw = values
+    converter = _get_converter(field)
+    if converter is None:
+        cleaned, errors = _convert_each(field, values)
+    else:
+        cleaned, errors = converter(field, values)
+
+    skipped = set()
+    if optional:
+        # we don't validate optional fields that are not set
+        if _is_array(raw):
+            raw = raw.tolist()
+        for row, value in enumerate(raw):
+            if value is None or (isinstance(value, str) and not value):
+                skipped.add(row)
+                cleaned[row] = value
+                errors.pop(row, None)
+
+    if required or validators:
+        for row, value in enumerate(cleaned):
+            if row in errors or row in skipped:
+                continue
+            if required and (value is None
+                    or (isinstance(value, str) and not value)
+                    or isinstance(value, (ForeignDocument, CollectionField))):
+                errors[row] = "Field must be set."
+                continue
+            try:
+                for validator in validators:
+                    validator(value)
+            except ValidationError, e:
+                errors[row] = e.message
+
+    return cleaned, errors
+
+
+def clean_columns(document, columns):
+    """Clean the dictionary ``columns`` of the fields of documents of the
+    class ``document``. Return the cleaned columns, the number of rows and
+    the errors of each invalid row."""
+    lengths = set(len(column) for column in columns.values())
+    if len(lengths) > 1:
+        raise ValueError("All columns must have the same length.")
+    length = lengths.pop() if lengths else 0
+
+    cleaned = {}
+    for name, column in columns.iteritems():
+        if _is_array(column):
+            column = column.tolist()
+        cleaned[name] = column
+
+    field_map = document._meta.field_map
+    errors = {}
+    for step in validation_plan(document):
+        kind, name = step[:2]
+        if kind not in (VALUE, CLEAN):
+            # Foreign documents and collections are not validated
+            continue
+        field = field_map[name]
+        if name in columns:
+            cleaned[name], column_errors = clean_column(field, columns[name],
+                    step)
+        else:
+            # Every row has the default value of the field, check it once
+            values, default_errors = clean_column(field,
+                    [getattr(document, name)], step)
+            column_errors = {}
+            if default_errors:
+                column_errors = dict.fromkeys(xrange(length),
+                        default_errors[0])
+        for row, message in column_errors.iteritems():
+            errors.setdefault(row, {})[name] = message
+
+    return cleaned, length, errors
+
+
+class ColumnBatch(object):
+    """A batch of documents stored as cleaned columns, see
+    ``Collection.from_columns``. ``errors`` maps the position of each invalid
+    row to the errors of its fields. Documents are built only when they are
+    asked for."""
+    def __init__(self, collection, columns):
+        self.Collection = collection
+        self.columns, self.length, self.errors = clean_columns(
+                collection.document, columns)
+
+    def __len__(self):
+        return self.length
+
+    def valid_rows(self):
+        """Return the positions of the rows without errors."""
+        return [row for row in xrange(self.length) if row not in self.errors]
+
+    def document(self, row):
+        """Build the document of the row at position ``row``."""
+        return self.Collection.document(dict((name, column[row])
+            for name, column in self.columns.iteritems()))
+
+    def documents(self, rows=None):
+        """Yield the documents of ``rows``, of the valid rows by default."""
+        if rows is None:
+            rows = self.valid_rows()
+        for row in rows:
+            yield self.document(row)
+
+    def collection(self, rows=None):
+        """Return a collection with the documents of ``rows``, of the valid
+        rows by default."""
+        return self.Collection(list(self.documents(rows)))
@@ -0,0 +1,257 @@
+"""Compile specialized render and validate functions for documents.
+
+A document renders itself by first turning itself into a dictionary with
+``_to_dict`` and then interpreting that dictionary field by field in
+``_render``. For documents that declare the ``compiled`` meta option,
+``DocumentBase`` generates a render function once for the document class. It
+renders a document in one straight pass over the fields that are rendered at
+all, and produces the same output as the generic path.
+
+Every document class also gets a validate function, built from a plan of the
+fields to validate. The plan leaves out fields that are never validated, and
+knows up front which fields are optional or required, and how to convert and
+check their values.
+
+"""
+import keyword
+import re
+
+from .exceptions import ValidationError, BackendDoesNotExist
+from .fields import (Field, ForeignDocument, CollectionField, StaticField,
+        NOT_PROVIDED)
+
+
+IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _attr(obj, name):
+    """Return the source code to access the attribute ``name`` of ``obj``."""
+    if IDENTIFIER_RE.match(name) and not keyword.iskeyword(name):
+        return "%s.%s" % (obj, name)
+    return "getattr(%s, %r)" % (obj, name)
+
+
+class RenderCompiler(object):
+    """Generate the source code of a render function for a document class."""
+    def __init__(self, cls):
+        self.cls = cls
+        self.namespace = {
+                'isinstance': isinstance,
+                'STRUCTURED': (dict, list),
+                }
+        self.lines = []
+        self.counter = 0
+
+    def bind(self, obj):
+        """Make ``obj`` available in the namespace of the generated function
+        and return the name it is bound to."""
+        name = "_c%d" % self.counter
+        self.counter += 1
+        self.namespace[name] = obj
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def compile(self):
+        """Return the compiled render function."""
+        meta = self.cls._meta
+        function_name = "render_%s" % self.cls.__name__
+        self.emit(0, "def %s(document):" % function_name)
+        self.emit(1, "data = {}")
+        for field in meta.local_fields:
+            if meta.field_map[field.name] is not field or not field.render:
+                # fields that are not rendered are skipped completely
+                continue
+            self.emit_field(field, meta.render_hooks.get(field.name))
+        self.emit(1, "return data")
+
+        source = "\n".join(self.lines) + "\n"
+        code = compile(source, "<docar render %s>" % self.cls.__name__,
+                "exec")
+        exec code in self.namespace
+
+        return self.namespace[function_name]
+
+    def emit_field(self, field, hook):
+        name = field.name
+        indent = 1
+
+        if isinstance(field, StaticField):
+            value = self.bind(field.value)
+        else:
+            value = "value"
+            self.emit(indent, "value = %s" % _attr('document', name))
+
+        if field.optional:
+            # The field is optional and none, ignore it
+            if value == "value":
+                self.emit(indent, "if value:")
+            else:
+                self.emit(indent, "if %s:" % _attr('document', name))
+            indent += 1
+            if (isinstance(field, ForeignDocument)
+                    or isinstance(field, CollectionField)):
+                # The related document or collection is not bound, so it is
+                # not part of the representation.
+                self.emit(indent, "if value.bound is not False:")
+                indent += 1
+
+        if isinstance(field, ForeignDocument):
+            self.emit_foreign_document(indent, field, hook)
+        elif isinstance(field, CollectionField):
+            self.emit_collection(indent, field, hook)
+        else:
+            self.emit_value(indent, field, hook, value)
+
+    def emit_value(self, indent, field, hook, value):
+        if hook is not None:
+            self.emit(indent, "value = %s(document, %s)" % (self.bind(hook),
+                value))
+            value = "value"
+        if not isinstance(field, StaticField) or hook is not None:
+            # Dictionaries and lists are interpreted as relations by the
+            # generic render path, so we handle them the same way.
+            self.emit(indent, "if isinstance(%s, STRUCTURED):" % value)
+            self.emit(indent + 1, "%s = document._render_value(%s, %s)" % (
+                value, self.bind(field), value))
+        self.emit(indent, "data[%r] = %s" % (field.name, value))
+
+    def emit_foreign_document(self, indent, field, hook):
+        if hook is not None:
+            self.emit(indent, "value = %s(document, value._to_dict())" % (
+                self.bind(hook)))
+            self.emit(indent, "data[%r] = document._render_value(%s, value)" %
+                    (field.name, self.bind(field)))
+        elif field.inline:
+            self.emit(indent, "data[%r] = value.render()" % field.name)
+        else:
+            self.emit(indent, "data[%r] = {" % field.name)
+            self.emit(indent + 2, "'rel': 'related',")
+            self.emit(indent + 2, "'href': value.uri()}")
+            # Also add the identifier fields into the rendered output
+            for id_field in field.Document._meta.identifier:
+                self.emit(indent, "data[%r][%r] = %s" % (field.name, id_field,
+                    _attr('value', id_field)))
+
+    def emit_collection(self, indent, field, hook):
+        if hook is not None:
+            self.emit(indent, "value = %s(document, [item._to_dict() "
+                    "for item in value.collection_set])" % self.bind(hook))
+            self.emit(indent, "data[%r] = document._render_value(%s, value)" %
+                    (field.name, self.bind(field)))
+        else:
+            self.emit(indent, "data[%r] = value.render()" % field.name)
+
+
+def compile_renderer(cls):
+    """Return a function that renders documents of the class ``cls``."""
+    return RenderCompiler(cls).compile()
+
+
+# The kinds of steps of a validation plan
+VALUE, CLEAN, FOREIGN, COLLECTION = range(4)
+
+
+def _overrides(field, name):
+    """Return whether the field class of ``field`` overrides the method
+    ``name`` of ``Field``."""
+    return getattr(type(field), name) != getattr(Field, name)
+
+
+def validation_plan(cls):
+    """Return the steps to validate documents of the class ``cls``, one tuple
+    of the kind of step, the field name, whether the field is optional, and
+    the arguments of the step for each field that is validated at all."""
+    steps = []
+    for field in cls._meta.local_fields:
+        if isinstance(field, ForeignDocument):
+            steps.append((FOREIGN, field.name, field.optional, None))
+        elif isinstance(field, CollectionField):
+            steps.append((COLLECTION, field.name, field.optional, None))
+        elif _overrides(field, 'clean') or _overrides(field, 'validate_field'):
+            # The field validates in its own way
+            steps.append((CLEAN, field.name, field.optional, field.clean))
+        elif not field.validate:
+            continue
+        elif isinstance(field, StaticField) and not field.validators:
+            # The value of a static field is set anyway
+            continue
+        else:
+            # A static field must not be set, see ``Field.validate_field``
+            required = (not field.optional
+                    and field.default is NOT_PROVIDED
+                    and not hasattr(field, 'value'))
+            steps.append((VALUE, field.name, field.optional,
+                (field.to_python, tuple(field.validators), required)))
+
+    return steps
+
+
+def compile_validator(cls):
+    """Return a function that validates a document of the class ``cls`` the
+    same way as ``Document.validate``, but returns a dictionary of the errors
+    instead of raising them.
+
+    The function ``check`` of the returned function validates a document
+    without fetching anything. It returns the errors and a list of the foreign
+    documents that don't validate, with their field names and errors. Such a
+    document might only reference an existing document by its identifier,
+    which is seen by fetching it."""
+    steps = validation_plan(cls)
+
+    def check(document):
+        errors = {}
+        references = []
+        for kind, name, optional, arguments in steps:
+            try:
+                value = getattr(document, name)
+                if value is None and optional:
+                    continue
+                elif kind is VALUE:
+                    if optional and isinstance(value, str) and not value:
+                        # we don't validate optional fields that are not set
+                        continue
+                    to_python, validators, required = arguments
+                    value = to_python(value)
+                    if required and (value is None
+                            or (isinstance(value, str) and not value)
+                            or isinstance(value, (ForeignDocument,
+                                CollectionField))):
+                        errors[name] = "Field must be set."
+                        continue
+                    for validator in validators:
+                        validator(value)
+                elif kind is CLEAN:
+                    if optional and isinstance(value, str) and not value:
+                        continue
+                    arguments(value)
+                elif kind is FOREIGN:
+                    try:
+                        value.validate()
+                    except ValidationError, e:
+                        if optional and not value.bound:
+                            continue
+                        references.append((name, value, e.message))
+                else:
+                    for item in value.collection_set:
+                        item.validate()
+            except ValidationError, e:
+                errors[name] = e.message
+
+        return errors, references
+
+    def validate(document, *args, **kwargs):
+        errors, references = check(document)
+        for name, value, message in references:
+            try:
+                value.fetch(*args, **kwargs)
+            except BackendDoesNotExist:
+                errors[name] = message
+            except ValidationError, e:
+                errors[name] = e.message
+
+        return errors
+
+    validate.check = check
+    return validate
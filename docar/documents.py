@@ -1,19 +1,30 @@
-import json
+import re
 import types
+import weakref
 
 from bisect import bisect
+from functools import partial
 
-from .fields import (ForeignDocument,
+from .fields import (Field,
+        ForeignDocument,
         CollectionField,
         StaticField,
         NOT_PROVIDED)
 
-from .backends import BackendManager
-from .exceptions import ValidationError, BackendDoesNotExist
+from . import codec
+from . import identity
+from .cache import CacheStats, credentials_key, state_key, forget_document
+from .backends import BackendManager, BackendManagerDescriptor
+from .compiler import compile_renderer, compile_validator
+from .exceptions import ValidationError
 
 
 DEFAULT_NAMES = ('identifier', 'model', 'excludes', 'backend_type', 'context',
-        'render')
+        'render', 'compiled', 'session', 'max_workers', 'write_strategy',
+        'cache', 'document_cache', 'compact', 'lazy', 'partial_updates')
+
+# Matches the names of field hooks like ``map_FIELD_field``.
+HOOK_RE = re.compile(r'^(map|render|save|fetch)_(.+)_field$')
 
 
 def clean_meta(Meta):
@@ -42,6 +53,38 @@ class Options(object):
         self.related_fields = []
         self.collection_fields = []
         self.render = True
+        self.compiled = False
+        self.compact = False
+        self.lazy = False
+        self.session = None
+        self.max_workers = None
+        self.write_strategy = None
+        self.cache = None
+        self.document_cache = None
+        self.partial_updates = None
+
+        # How often the documents of this class were found in the document
+        # cache
+        self.cache_stats = CacheStats()
+
+        # The compiled render function, only set for compiled documents
+        self.renderer = None
+        # The validate function of the document class, see
+        # ``compile_validator``
+        self.validator = None
+
+        # Lookup tables, they are built once all fields are added to the
+        # document class, see ``_prepare``.
+        self.field_map = {}
+        self.related_field_map = {}
+        self.collection_field_map = {}
+        self.fields_by_type = {}
+
+        # Field hooks, mapping a field name to the hook method of the document
+        self.map_hooks = {}
+        self.render_hooks = {}
+        self.save_hooks = {}
+        self.fetch_hooks = {}
 
         self.meta = meta
 
@@ -58,6 +101,49 @@ class Options(object):
         self.collection_fields.insert(bisect(self.collection_fields, field),
                 field)
 
+    def _prepare(self, cls):
+        """Build the lookup tables for the fields and field hooks of this
+        document. The conversion methods of the document and the backend
+        managers use them, instead of searching the lists of fields or probing
+        the document for hook methods every time."""
+        self.field_map = {}
+        self.related_field_map = {}
+        self.collection_field_map = {}
+        self.fields_by_type = {}
+
+        # The first declared field wins if two fields share the same name,
+        # the same as searching the sorted list of fields would do.
+        for field in self.local_fields:
+            self.field_map.setdefault(field.name, field)
+            field_type = getattr(field, 'field_type', None)
+            self.fields_by_type.setdefault(field_type, []).append(field)
+        for field in self.related_fields:
+            self.related_field_map.setdefault(field.name, field)
+        for field in self.collection_fields:
+            self.collection_field_map.setdefault(field.name, field)
+
+        self._prepare_hooks(cls)
+
+    def _prepare_hooks(self, cls):
+        """Build the tables of the field hooks of this document. Hooks set on
+        the class after it was created are added by ``DocumentBase``, hooks
+        set on a document instance are not used."""
+        self.map_hooks.clear()
+        self.render_hooks.clear()
+        self.save_hooks.clear()
+        self.fetch_hooks.clear()
+        hooks = {
+                'map': self.map_hooks,
+                'render': self.render_hooks,
+                'save': self.save_hooks,
+                'fetch': self.fetch_hooks,
+                }
+        for attr_name in dir(cls):
+            match = HOOK_RE.match(attr_name)
+            if match:
+                hook_type, name = match.groups()
+                hooks[hook_type][name] = getattr(cls, attr_name)
+
     def contribute_to_class(self, cls, name):
         # This is bluntly stolen from the django orm
         # Set first the default values
@@ -80,10 +166,104 @@ class Options(object):
                 #    setattr(self, attr_name, getattr(self.meta, attr_name))
 
 
+class SlotValue(object):
+    """An attribute of a compact document, stored in the slot ``slot``. If
+    the slot isn't set, ``default`` is returned, like an attribute of a
+    regular document falls back to the class attribute."""
+    def __init__(self, slot, default):
+        self.slot = slot
+        self.default = default
+
+    def __get__(self, document, cls):
+        if document is None:
+            return self.default
+        try:
+            return self.slot.__get__(document, cls)
+        except AttributeError:
+            return self.default
+
+    def __set__(self, document, value):
+        self.slot.__set__(document, value)
+
+    def __delete__(self, document):
+        self.slot.__delete__(document)
+
+
+class Pending(object):
+    """A relation of a lazy document that hasn't been built yet. ``load``
+    builds it."""
+    def __init__(self, load):
+        self.load = load
+
+
+class LazyValue(object):
+    """A foreign document or collection of a lazy document. If the attribute
+    holds a ``Pending`` relation, the relation is built the first time the
+    attribute is read. ``default`` is the default value of the attribute, or
+    the ``SlotValue`` of a compact document."""
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def __get__(self, document, cls):
+        if isinstance(self.default, SlotValue):
+            value = self.default.__get__(document, cls)
+        elif document is None:
+            return self.default
+        else:
+            value = document.__dict__.get(self.name, self.default)
+
+        if isinstance(value, Pending):
+            value = value.load()
+            self.__set__(document, value)
+
+        return value
+
+    def __set__(self, document, value):
+        if isinstance(self.default, SlotValue):
+            self.default.__set__(document, value)
+        else:
+            document.__dict__[self.name] = value
+
+
+# The attributes every document instance can have besides its fields, with
+# their defaults.
+INSTANCE_ATTRIBUTES = (('_context', {}), ('bound', False), ('_manager', None),
+        ('_fetched_state', None), ('_model_ref', None))
+
+
+def compact_slots(bases, attrs):
+    """Return the ``__slots__`` of a compact document class. Every field and
+    instance attribute is stored in a slot named ``_slot_NAME``, unless a base
+    class has a slot for it already."""
+    names = [name for name, _ in INSTANCE_ATTRIBUTES]
+    names.extend(name for name, obj in attrs.items()
+            if isinstance(obj, Field))
+    for base in bases:
+        if isinstance(base, DocumentBase):
+            names.extend(field.name for field in base._meta.local_fields)
+
+    slots = []
+    for name in names:
+        slot = '_slot_%s' % name
+        if slot not in slots and not any(hasattr(b, slot) for b in bases):
+            slots.append(slot)
+    if not any(hasattr(b, '__weakref__') for b in bases):
+        # Documents are used as keys of weak dictionaries
+        slots.append('__weakref__')
+
+    return tuple(slots)
+
+
 class DocumentBase(type):
     """Metaclass for the Document class."""
 
     def __new__(cls, name, bases, attrs):
+        compact = getattr(attrs.get('Meta'), 'compact', False)
+        if compact:
+            # Store the fields in slots instead of an instance dictionary
+            attrs['__slots__'] = compact_slots(bases, attrs)
+
         new_class = super(DocumentBase, cls).__new__(cls, name, bases, attrs)
         parents = [b for b in bases if isinstance(b, DocumentBase)]
 
@@ -101,34 +281,79 @@ class DocumentBase(type):
             for field in base._meta.local_fields:
                 new_class.add_to_class(field.name, field)
 
+        new_class._meta._prepare(new_class)
+
         # create the fields on the instance document
         for field in new_class._meta.local_fields:
             if isinstance(field, CollectionField):
-                collection = field.Collection()
-                collection.bound = False
-                setattr(new_class, field.name, collection)
+                default = field.Collection()
+                default.bound = False
             elif isinstance(field, ForeignDocument):
-                document = field.Document()
-                document.bound = False
-                setattr(new_class, field.name, document)
+                default = field.Document()
+                default.bound = False
             elif field.default == NOT_PROVIDED:
-                setattr(new_class, field.name, None)
+                default = None
             elif isinstance(field, StaticField):
-                setattr(new_class, field.name, field.value)
+                default = field.value
             else:
-                setattr(new_class, field.name, field.default)
+                default = field.default
+            new_class.add_default(field.name, default,
+                    isinstance(field, (ForeignDocument, CollectionField)))
+
+        if compact:
+            for attr_name, default in INSTANCE_ATTRIBUTES:
+                new_class.add_default(attr_name, default)
+
+        if new_class._meta.compiled:
+            new_class._meta.renderer = compile_renderer(new_class)
+        new_class._meta.validator = compile_validator(new_class)
 
-        # Add the model manager if a model is set
+        # Add the model manager if a model is set, each document uses its
+        # own copy of it
         if not new_class._meta.backend_type:
             new_class._backend_manager = None
         else:
-            new_class._backend_manager = BackendManager(
-                new_class._meta.backend_type)
+            manager = BackendManager(new_class._meta.backend_type)
             if new_class._meta.backend_type in 'django':
-                new_class._backend_manager._model = new_class._meta.model
+                manager._model = new_class._meta.model
+            new_class._backend_manager = BackendManagerDescriptor(manager)
 
         return new_class
 
+    def __setattr__(cls, name, value):
+        super(DocumentBase, cls).__setattr__(name, value)
+        if HOOK_RE.match(name):
+            cls._refresh_hooks()
+
+    def __delattr__(cls, name):
+        super(DocumentBase, cls).__delattr__(name)
+        if HOOK_RE.match(name):
+            cls._refresh_hooks()
+
+    def _refresh_hooks(cls):
+        """Rebuild the hook tables of ``cls`` and its subclasses, after a
+        hook method was set or removed on the class."""
+        meta = cls.__dict__.get('_meta')
+        if meta is None:
+            # The class is still being created
+            return
+        meta._prepare_hooks(cls)
+        if meta.renderer is not None:
+            # The compiled render function calls the render hooks directly
+            meta.renderer = compile_renderer(cls)
+        for subclass in cls.__subclasses__():
+            subclass._refresh_hooks()
+
+    def add_default(cls, name, default, relation=False):
+        """Set the default value of the attribute ``name``. Compact documents
+        read the attribute from its slot and fall back to the default. Lazy
+        documents build their ``relation`` attributes on first access."""
+        if cls._meta.compact:
+            default = SlotValue(getattr(cls, '_slot_%s' % name), default)
+        if relation and cls._meta.lazy:
+            default = LazyValue(name, default)
+        setattr(cls, name, default)
+
     def add_to_class(cls, name, obj):
         """If the obj provides its own contribute method, call it, otherwise
         attach this object to the class."""
@@ -141,9 +366,15 @@ class DocumentBase(type):
 class Document(object):
     """A document is a representation."""
     __metaclass__ = DocumentBase
+    # Documents without the ``compact`` meta option have an instance
+    # dictionary, compact documents only have slots.
+    __slots__ = ()
 
     _context = {}
     bound = False
+    # The state of the document when it was fetched or saved the last time,
+    # see ``changed_fields``
+    _fetched_state = None
 
     def __init__(self, data=None, context={}):
         """Create a new document presentation of a resource.
@@ -166,13 +397,16 @@ class Document(object):
         self._from_dict(data)
         self.bound = True
 
-    def _to_dict(self):
+    def _to_dict(self, rendered_only=False):
         """Return the document as a python dictionary. This method recursively
         turns related documents and items of collections into dictionaries
-        too."""
+        too. If ``rendered_only`` is set, fields that are not rendered are
+        left out."""
         data = {}
 
         for field in self._meta.local_fields:
+            if rendered_only and not field.render:
+                continue
             if field.optional and not getattr(self, field.name):
                 # The field is optional and none, ignore it
                 continue
@@ -200,124 +434,182 @@ class Document(object):
 
         return data
 
-    def _from_dict(self, obj):
+    def _from_dict(self, obj, shared=False):
         """Create the document from a dict structure. It recursively builds
-        also related documents and collections from a dictionary input."""
+        also related documents and collections from a dictionary input. If
+        ``shared`` is set, ``obj`` is a fetched state, and the related
+        documents are shared inside an identity map scope."""
         for item, value in obj.iteritems():
             if isinstance(value, dict):
-                fields = [f for f in self._meta.related_fields
-                        if f.name == item]
-                if len(fields) > 0:
-                    field = fields[0]
-                else:
+                field = self._meta.related_field_map.get(item)
+                if field is None:
                     continue
-                Document = field.Document
                 # Lets create a new relation
-                document = Document(value, context=self._context)
+                document = self._build_related(field.Document, value,
+                        shared)
                 setattr(self, item, document)
             elif isinstance(value, list):
                 # a collection
-                field = [f for f in self._meta.local_fields
-                        if f.name == item][0]
+                field = self._meta.field_map[item]
                 collection = field.Collection()
                 collection.collection_set = []
                 Document = collection.document
                 for elem in value:
-                    document = Document(elem, context=self._context)
-                    collection.add(document)
+                    collection.add(self._build_related(Document, elem,
+                        shared))
                 if len(collection.collection_set) > 0:
                     # If we have at least one member in the collection, we
                     # regard it as bound
                     collection.bound = True
                 setattr(self, item, collection)
+            elif self._meta.compact and item not in self._meta.field_map:
+                # Compact documents can only store their fields
+                continue
             else:
                 setattr(self, item, value)
 
+    def _build_related(self, Document, obj, shared=False):
+        """Return the related document of class ``Document`` built from
+        ``obj``. If ``shared`` is set, the documents that refer to the same
+        resource share one document inside an identity map scope, see
+        ``docar.identity``."""
+        def build():
+            if not shared or not obj:
+                document = Document(obj, context=self._context)
+            else:
+                # Like the constructor, but the related documents of the
+                # document are shared as well
+                document = Document()
+                document._context = self._context
+                document._from_dict(obj, shared=True)
+                document.bound = True
+            document._adopt_object()
+            return document
+
+        if not shared:
+            return build()
+        return identity.build('document', Document, obj, self._context,
+                build)
+
     def _from_model(self, model):
         """Fill the document from a django model."""
         #FIXME: Add some type checking whether `model` truly is a django model
+        if type(self)._backend_manager is not None:
+            # ``uri`` needs the model instance. A weak reference keeps it
+            # without copying the backend manager for every document built
+            # from a queryset, and without keeping every row alive.
+            try:
+                self._model_ref = weakref.ref(model)
+            except TypeError:
+                pass
+        map_hooks = self._meta.map_hooks
+        lazy = self._meta.lazy
         for field in self._meta.local_fields:
             name = field.name
             mapped_name = name
 
             # We map document field names to names of fields on the backend
             # models.
-            if hasattr(self, "map_%s_field" % name):
-                map_method = getattr(self, "map_%s_field" % name)
-                mapped_name = map_method()
+            if name in map_hooks:
+                mapped_name = map_hooks[name](self)
+
+            is_relation = (isinstance(field, ForeignDocument) or
+                    isinstance(field, CollectionField))
+            if is_relation and lazy:
+                # Don't touch the relation of the model before the attribute
+                # is used, accessing it can cost a query.
+                setattr(self, name, Pending(partial(self._relation_from_model,
+                    field, model, mapped_name)))
+                continue
 
             # skip fields that are not set on the model
             if not hasattr(model, mapped_name):
                 continue
 
-            if isinstance(field, ForeignDocument):
-                related_model = getattr(model, mapped_name)
-                foreign_document = field.Document({},
-                        context=self._get_context())
-                foreign_document._from_model(related_model)
-                setattr(self, name, foreign_document)
+            if is_relation:
+                setattr(self, name, self._relation_from_model(field, model,
+                    mapped_name))
 
-            elif isinstance(field, CollectionField):
-                m2m = getattr(model, mapped_name)
-                collection = field.Collection()
-                collection._from_queryset(m2m.all())
-                setattr(self, name, collection)
-
-            elif hasattr(model, mapped_name):
+            else:
                 setattr(self, name, getattr(model, mapped_name))
 
         self.bound = True
 
+    def _relation_from_model(self, field, model, mapped_name):
+        """Build the foreign document or collection of ``field`` from the
+        relation ``mapped_name`` of ``model``."""
+        try:
+            related = getattr(model, mapped_name)
+        except AttributeError:
+            # The relation is not set on the model, use the default
+            return getattr(type(self), field.name)
+
+        if isinstance(field, ForeignDocument):
+            foreign_document = field.Document({},
+                    context=self._get_context())
+            foreign_document._from_model(related)
+            return foreign_document
+
+        collection = field.Collection()
+        collection._from_queryset(related.all())
+        return collection
+
     def _render(self, obj):
         data = {}
+        field_map = self._meta.field_map
+        render_hooks = self._meta.render_hooks
 
         for item, value in obj.iteritems():
-            field = [f for f in self._meta.local_fields 
-                        if f.name == item][0]
+            field = field_map[item]
             if not field.render:
                 continue
-            if hasattr(self, "render_%s_field" % item):
-                render_field = getattr(self, "render_%s_field" % item)
-                value = render_field(value)
-            if isinstance(value, dict):
-                # Lets create a new relation
-                document = getattr(self, item)
-                #value = document._fetch(value)
-                #data[item] = value
-                if field.inline:
-                    # we render the field inline
-                    data[item] = document.render()
-                else:
-                    data[item] = {
-                            'rel': 'related',
-                            'href': document.uri()}
-                    # Also add the identifier fields into the rendered output
-                    identifiers = {}
-                    for id_field in document._meta.identifier:
-                        identifiers[id_field] = getattr(document, id_field)
-                    data[item].update(identifiers)
-            elif isinstance(value, list):
-                # we render a collection
-                collection = getattr(self, item)
-                data[item] = collection.render()
-            else:
-                data[item] = value
+            if item in render_hooks:
+                value = render_hooks[item](self, value)
+            data[item] = self._render_value(field, value)
 
         return data
 
+    def _render_value(self, field, value):
+        """Render the value of a single field, ``value`` is taken from the
+        dictionary representation of this document."""
+        if isinstance(value, dict):
+            # Lets create a new relation
+            document = getattr(self, field.name)
+            #value = document._fetch(value)
+            #data[item] = value
+            if field.inline:
+                # we render the field inline
+                return document.render()
+            else:
+                data = {
+                        'rel': 'related',
+                        'href': document.uri()}
+                # Also add the identifier fields into the rendered output
+                identifiers = {}
+                for id_field in document._meta.identifier:
+                    identifiers[id_field] = getattr(document, id_field)
+                data.update(identifiers)
+                return data
+        elif isinstance(value, list):
+            # we render a collection
+            collection = getattr(self, field.name)
+            return collection.render()
+        else:
+            return value
+
     def _save(self):
         data = {}
         obj = self._to_dict()
+        field_map = self._meta.field_map
+        save_hooks = self._meta.save_hooks
 
         for item, value in obj.iteritems():
-            field = [f for f in self._meta.local_fields 
-                        if f.name == item][0]
+            field = field_map[item]
             if field.read_only:
                 continue
-            if hasattr(self, "save_%s_field" % item):
+            if item in save_hooks:
                 # We apply a save field
-                save_field = getattr(self, "save_%s_field" % item)
-                data[item] = save_field()
+                data[item] = save_hooks[item](self)
                 continue
             if isinstance(value, dict):
                 # Lets follow a relation
@@ -336,42 +628,47 @@ class Document(object):
 
     def _fetch(self, obj):
         data = {}
+        fetch_hooks = self._meta.fetch_hooks
 
         for item, value in obj.iteritems():
-            if hasattr(self, "fetch_%s_field" % item):
-                fetch_field = getattr(self, "fetch_%s_field" % item)
-                value = fetch_field(value)
+            if item in fetch_hooks:
+                value = fetch_hooks[item](self, value)
                 # obj[item] = value
             if isinstance(value, dict):
-                field = [f for f in self._meta.related_fields
-                        if f.name == item][0]
+                field = self._meta.related_field_map[item]
                 # Lets create a new relation
-                document = field.Document(value, context=self._context)
-                data[item] = document._fetch(value)
+                data[item] = self._fetch_related(field.Document, value)
             elif isinstance(value, list):
                 # we fetch a collection
-                field = [f for f in self._meta.local_fields
-                        if f.name == item][0]
+                field = self._meta.field_map[item]
                 collection = field.Collection()
-                data[item] = []
                 Document = collection.document
-                for elem in value:
-                    document = Document(elem, context=self._context)
-                    data[item].append(document._fetch(elem))
+                data[item] = [self._fetch_related(Document, elem)
+                        for elem in value]
             else:
                 data[item] = value
 
         return data
 
+    def _fetch_related(self, Document, obj):
+        """Return the fetched state of the related document of class
+        ``Document`` with the state ``obj``, once per resource inside an
+        identity map scope."""
+        def fetch():
+            document = Document(obj, context=self._context)
+            return document._fetch(obj)
+
+        return identity.build('fetched', Document, obj, self._context, fetch)
+
     def _identifier_state(self):
         data = {}
+        save_hooks = self._meta.save_hooks
         for elem in self._meta.identifier:
             # if hasattr(self, "fetch_%s_field" % elem):
             #     fetch_field = getattr(self, "fetch_%s_field" % elem)
             #     data[elem] = fetch_field(getattr(self, elem))
-            if hasattr(self, "save_%s_field" % elem):
-                save_field = getattr(self, "save_%s_field" % elem)
-                data[elem] = save_field()
+            if elem in save_hooks:
+                data[elem] = save_hooks[elem](self)
             else:
                 data[elem] = getattr(self, elem)
         return data
@@ -390,13 +687,17 @@ class Document(object):
     def render(self):
         """Return the document in render state. This includes URI links to
         related resources and the document itself."""
-        obj = self._render(self._to_dict())
+        if self._meta.renderer is not None:
+            # This document class has a compiled render function
+            return self._meta.renderer(self)
+
+        obj = self._render(self._to_dict(rendered_only=True))
 
         return obj
 
     def to_json(self):
         """Render this document as json."""
-        return json.dumps(self.to_python())
+        return codec.dumps(self.to_python())
 
     def to_python(self):
         """Render this document to a python dictionary."""
@@ -411,46 +712,11 @@ class Document(object):
     def validate(self, *args, **kwargs):
         """Validate the state of the document and throw a ``ValidationError``
         if validation fails."""
-        errors = {}
-
-        for field in self._meta.local_fields:
-            try:
-                if (isinstance(getattr(self, field.name), type(None))
-                        and field.optional):
-                    continue
-                elif isinstance(field, ForeignDocument):
-                    document = getattr(self, field.name)
-                    try:
-                        document.validate()
-                    except ValidationError, e:
-                        if field.optional and not document.bound:
-                            continue
-                        else:
-                            # In cases were want to reference already existing
-                            # documents, we will raise an validation error if
-                            # we reference the document only by identifier. So
-                            # lets fetch it to see if this is the case
-                            try:
-                                document.fetch(*args, **kwargs)
-                                #TODO: I blindly assume now that if a document
-                                # is retrieved from the backend it will
-                                # validate, so no need to do that again here.
-                            except BackendDoesNotExist:
-                                raise e
-                elif isinstance(field, CollectionField):
-                    collection = getattr(self, field.name)
-                    for document in collection.collection_set:
-                        document.validate()
-                else:
-                    value = getattr(self, field.name)
-                    if ((isinstance(value, type(None))
-                            or (isinstance(value, str) and value in ""))
-                            and field.optional):
-                        # we don't validate optional fields that are not set
-                        continue
-                    field.clean(value)
-            except ValidationError, e:
-                errors[field.name] = e.message
+        # In cases were want to reference already existing documents, we will
+        # raise an validation error if we reference the document only by
+        # identifier. So the validator fetches foreign documents that don't
+        # validate, to see if this is the case.
+        errors = self._meta.validator(self, *args, **kwargs)
 
         if errors:
             raise ValidationError(errors)
@@ -459,33 +725,173 @@ class Document(object):
 
     def save(self, *args, **kwargs):
         """Save the document to a backend. Any arguments given to this method
-        is used when calling the underlying backend method."""
-        self.validate(*args, **kwargs)
+        is used when calling the underlying backend method.
+
+        Only the fields that changed since the document was fetched or saved
+        are written, see ``changed_fields``. Pass ``update_fields`` to choose
+        them yourself. If no field changed, the backend is not called at
+        all."""
+        state = self._to_dict()
+        update_fields = self._set_update_fields(kwargs, state)
+        if update_fields is not None and len(update_fields) < 1:
+            # Nothing changed, nothing to save
+            return
+
+        # Related documents fetched to validate the document are not fetched
+        # again to save it
+        with identity.identity_map():
+            self.validate(*args, **kwargs)
 
-        self._backend_manager.save(self, *args, **kwargs)
+            self._backend_manager.save(self, *args, **kwargs)
+        self._forget(kwargs)
+        self._fetched_state = state
+
+    def _set_update_fields(self, kwargs, state=None):
+        """Set ``update_fields`` in ``kwargs`` to the changed fields of the
+        document, unless they are set already, and return them. Return
+        ``None`` if all fields have to be saved."""
+        if kwargs.get('update_fields') is None:
+            changed = self.changed_fields(state)
+            if changed is None:
+                return None
+            kwargs['update_fields'] = changed
+
+        return kwargs['update_fields']
 
     def update(self, data, *args, **kwargs):
         """Update a document from a dictionary. This is a convenience
         method."""
-        self.fetch(*args, **kwargs)
+        # Don't update a cached state of the document
+        self._forget(kwargs)
+        # The backend reuses what it loaded for the fetch to save the document
+        with identity.identity_map():
+            self.fetch(*args, **kwargs)
 
-        # First update the own document state with the new values
-        self._from_dict(data)
+            # First update the own document state with the new values
+            self._from_dict(data)
 
-        # save the representation to the model
-        self.save(*args, **kwargs)
+            # save the representation to the model
+            self.save(*args, **kwargs)
 
     def fetch(self, *args, **kwargs):
         """Fetch the model from the backend to create the representation of
         this resource."""
-        # Retrieve the object from the backend
-        obj = self._backend_manager.fetch(self, *args, **kwargs)
+        obj = self._cached_state(kwargs)
+        if obj is not None:
+            self._from_fetched(obj)
+            return
+
+        # Retrieve the object from the backend, only once per identity map
+        # scope. The scope keeps the backend objects loaded for the related
+        # documents until they are rebuilt from the fetched state.
+        with identity.object_scope():
+            obj = identity.fetch_state(self,
+                    partial(self._backend_manager.fetch, self, *args,
+                        **kwargs),
+                    credentials=credentials_key(kwargs))
+            self._adopt_object()
+            self._from_backend(obj, kwargs)
+
+    def _adopt_object(self):
+        """Hand the backend object that was loaded for this document in the
+        current identity map scope, like a django model instance, to the
+        backend manager of the document."""
+        if self._backend_manager is None:
+            return
+        obj = identity.loaded_object(self)
+        if obj is not None:
+            self._backend_manager.instance = obj
+
+    def _from_backend(self, obj, kwargs={}):
+        """Build the document from the state fetched from the backend, and
+        store it in the document cache."""
         obj = self._fetch(obj)
-        self._from_dict(obj)
+        cache = self._meta.document_cache
+        if cache is not None:
+            cache.set(state_key(cache, self, credentials_key(kwargs),
+                create=True), obj)
+        self._from_fetched(obj)
+
+    def _from_fetched(self, obj):
+        """Build the document from its fetched state, and remember the state
+        to find the changed fields later on."""
+        self._from_dict(obj, shared=True)
+        self._fetched_state = obj
+
+    def changed_fields(self, state=None):
+        """Return the names of the fields that changed since the document
+        was fetched or saved the last time, in the order of the fields.
+        Changes of foreign documents and of the items of collections change
+        their field too. Return ``None`` if the document has been neither
+        fetched nor saved, all its fields are new then. ``state`` is the
+        current dictionary representation, if it is known already."""
+        if self._fetched_state is None:
+            return None
+        if state is None:
+            state = self._to_dict()
+
+        # Build the fetched state the same way as the current one, so that
+        # both can be compared
+        fetched = type(self)(self._fetched_state, self._context)._to_dict()
+
+        return [field.name for field in self._meta.local_fields
+                if state.get(field.name) != fetched.get(field.name)]
+
+    def _cached_state(self, kwargs={}):
+        """Return the state of the document from the document cache, or
+        ``None`` if it isn't cached."""
+        cache = self._meta.document_cache
+        if cache is None:
+            return None
+
+        key = state_key(cache, self, credentials_key(kwargs))
+        obj = None
+        if key is not None:
+            obj = cache.get(key)
+        if obj is None:
+            self._meta.cache_stats.count('misses')
+        else:
+            self._meta.cache_stats.count('hits')
+        return obj
+
+    def _forget(self, kwargs={}):
+        """Remove the fetched state of the document from the identity map
+        scope and the document cache, after it has been changed. The states
+        cached for all users are removed."""
+        identity.forget(self)
+
+        cache = self._meta.document_cache
+        if cache is None:
+            return
+        forget_document(cache, self)
+        self._meta.cache_stats.count('invalidations')
 
     def delete(self, *args, **kwargs):
         """Delete a model instance associated with this document."""
         self._backend_manager.delete(self, *args, **kwargs)
+        self._forget(kwargs)
+
+    def afetch(self, *args, **kwargs):
+        """Return a coroutine that fetches the document, like ``fetch``. The
+        document has to use an asynchronous backend like ``http_async``::
+
+            await document.afetch()
+
+        """
+        return self._backend_manager.afetch_document(self, *args, **kwargs)
+
+    def asave(self, *args, **kwargs):
+        """Return a coroutine that saves the document, like ``save``. Only
+        the changed fields are validated and saved, like with ``save``. Foreign
+        documents that have to be fetched to validate the document are fetched
+        by the coroutine."""
+        self._set_update_fields(kwargs)
+
+        return self._backend_manager.asave(self, *args, **kwargs)
+
+    def adelete(self, *args, **kwargs):
+        """Return a coroutine that deletes the document, like ``delete``."""
+        return self._backend_manager.adelete(self, *args, **kwargs)
 
     def uri(self):
         """Return the absolute uri for this resource.
@@ -502,7 +908,7 @@ class Document(object):
 
         """
         if hasattr(self._backend_manager, 'uri'):
-            return self._backend_manager.uri()
+            return self._backend_manager.uri(self)
 
     def scaffold(self):
         """Return a scaffold of this document.
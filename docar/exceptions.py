@@ -21,5 +21,9 @@ class HttpBackendError(Exception):
     pass
 
 class ValidationError(Exception):
-    """This exception is raised if a field couldn't validate."""
-    pass
+    """This exception is raised if a field couldn't validate. The errors are
+    kept in ``message``, also on python 3 where exceptions have no
+    ``message`` anymore."""
+    def __init__(self, *args):
+        Exception.__init__(self, *args)
+        self.message = args[0] if len(args) == 1 else ''
@@ -126,7 +126,8 @@ class StaticField(StringField):
 
 
 class ChoicesField(StringField):
-    """A field that provides a set of choices to choose from."""
+    """A field that provides a set of choices to choose from. The choices are
+    a list of values, or a list of ``(value, label)`` tuples."""
     field_type = "choices"
 
     def __init__(self, *args, **kwargs):
@@ -138,10 +139,58 @@ class ChoicesField(StringField):
 
         super(ChoicesField, self).__init__(*args, **kwargs)
 
+    def _get_choices(self):
+        return self._choices
+
+    def _set_choices(self, choices):
+        choices = list(choices)
+        self._labels = []
+        if choices and all(isinstance(choice, (tuple, list))
+                and len(choice) == 2 for choice in choices):
+            self._labels = [tuple(choice) for choice in choices]
+            choices = [value for value, label in choices]
+        self._choices = choices
+
+        try:
+            self.labels = dict(self._labels)
+        except TypeError:
+            self.labels = None
+
+        # Look up the choices in a set, if they can be hashed
+        try:
+            self.choice_set = frozenset(choices)
+        except TypeError:
+            self.choice_set = None
+
+    choices = property(_get_choices, _set_choices)
+
+    def is_choice(self, value):
+        """Return whether ``value`` is one of the choices."""
+        if self.choice_set is not None:
+            try:
+                return value in self.choice_set
+            except TypeError:
+                # An unhashable value can still equal a choice
+                pass
+        return value in self._choices
+
+    def get_label(self, value):
+        """Return the label of the choice ``value``, or the value itself if
+        the choices have no labels."""
+        if self.labels is not None:
+            try:
+                return self.labels.get(value, value)
+            except TypeError:
+                pass
+        for choice, label in self._labels:
+            if choice == value:
+                return label
+        return value
+
     def to_python(self, value):
-        if value in self.choices:
+        if self.is_choice(value):
             return value
-        raise ValidationError('%s is not a valid choice.' % value)
+        raise ValidationError('%s is not a valid choice.' % (value,))
 
 
 ## Structured Datatypes.
@@ -0,0 +1,325 @@
+"""Identity maps for fetched documents.
+
+Inside an identity map scope every distinct resource is fetched from its
+backend only once. When a document tree refers to the same related document
+many times, like many articles written by the same editor, the first fetch
+stores the state of the editor and all further fetches reuse it::
+
+    from docar.identity import identity_map
+
+    with identity_map():
+        articles.fetch_all([{'id': id} for id in ids])
+
+The related documents built from the fetched states are shared as well. All
+documents that refer to the same resource with the same state get the same
+document object, which is built and run through its ``fetch_FIELD_field``
+methods only once.
+
+Resources are identified by their document class, their identifier and the
+context of the document. The scope belongs to the current thread, threads
+started by the http backend to fetch related documents share the scope of the
+thread that started them. Where ``contextvars`` is available (python 3.7 or
+newer), the scope is a context variable, so that concurrent coroutines on
+the same event loop keep their own scopes, and the coroutines started from a
+scope share it. Saving or deleting a document inside the scope
+forgets its state, so it is fetched again.
+
+A scope also remembers the backend objects that were loaded for a resource,
+like the model instances of the django backend. ``Document.save``,
+``Document.update`` and ``Collection.save_all`` open a scope themselves, so
+that every resource is loaded at most once while a document tree is saved.
+``Document.fetch`` and ``Collection.fetch_all`` open an ``object_scope``,
+which only remembers the backend objects, to hand them on to the related
+documents built from the fetched state.
+
+"""
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import contextvars
+except ImportError:
+    # python 2 and python 3 before 3.7
+    contextvars = None
+
+
+_local = threading.local()
+_scope = None
+if contextvars is not None:
+    _scope = contextvars.ContextVar('docar_identity_map', default=None)
+
+
+class IdentityMap(object):
+    """Map resources to their fetched state. If ``share_states`` is false,
+    only the backend objects are remembered and every fetch is made."""
+    def __init__(self, share_states=True):
+        self.share_states = share_states
+        self.states = {}
+        # The backend objects loaded for the resources
+        self.objects = {}
+        # The documents and fetched states built from the states of the
+        # resources, with the state they were built from
+        self.built = {}
+        self.lock = threading.Lock()
+        # Resources that are being fetched in another thread right now, with
+        # the thread and an event that is set once the fetch is done.
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key, fetch):
+        """Return the state for ``key``, calling ``fetch`` only if it isn't
+        known yet. If another thread is fetching the same resource, wait for
+        it instead of fetching it twice."""
+        if not self.share_states:
+            return fetch()
+        current = threading.current_thread()
+        with self.lock:
+            if key in self.states:
+                self.hits += 1
+                return self.states[key]
+            pending = self.pending.get(key)
+            if pending is None:
+                event = threading.Event()
+                self.pending[key] = (current, event)
+
+        if pending is not None:
+            thread, other = pending
+            if thread is current:
+                # A recursive fetch of the same resource, fetch it again
+                # instead of waiting for ourselves
+                return fetch()
+            other.wait()
+            return self.fetch(key, fetch)
+
+        try:
+            state = fetch()
+            with self.lock:
+                self.states[key] = state
+                self.misses += 1
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+        return state
+
+    def lookup(self, key):
+        """Return a tuple of whether the state for ``key`` is known, and the
+        state."""
+        with self.lock:
+            if key in self.states:
+                self.hits += 1
+                return True, self.states[key]
+        return False, None
+
+    def store(self, key, state):
+        if not self.share_states:
+            return
+        with self.lock:
+            self.states[key] = state
+            self.misses += 1
+
+    def build(self, key, state, build):
+        """Return the object built by ``build`` from ``state`` for ``key``,
+        calling ``build`` only if nothing has been built from an equal state
+        yet."""
+        with self.lock:
+            entry = self.built.get(key)
+        if entry is not None and entry[0] == state:
+            return entry[1]
+
+        obj = build()
+        with self.lock:
+            self.built[key] = (state, obj)
+        return obj
+
+    def discard(self, key):
+        """Remove the state of the resource ``key`` for all credentials."""
+        with self.lock:
+            for other in list(self.states):
+                if other[:3] == key[:3]:
+                    del self.states[other]
+
+    def remember(self, key, obj):
+        """Remember the backend object ``obj`` loaded for ``key``."""
+        with self.lock:
+            self.objects[key] = obj
+
+    def loaded(self, key):
+        """Return the backend object loaded for ``key``, or ``None``."""
+        with self.lock:
+            return self.objects.get(key)
+
+    def discard_object(self, key):
+        with self.lock:
+            self.objects.pop(key, None)
+
+    def __len__(self):
+        return len(self.states)
+
+
+def current_map():
+    """Return the identity map of the current scope, or ``None``."""
+    if _scope is not None:
+        return _scope.get()
+    return getattr(_local, 'identity_map', None)
+
+
+@contextmanager
+def activate(identity_map):
+    """Use ``identity_map`` as the scope of the current thread, or of the
+    current context if ``contextvars`` is available."""
+    if _scope is not None:
+        token = _scope.set(identity_map)
+        try:
+            yield identity_map
+        finally:
+            _scope.reset(token)
+        return
+
+    previous = current_map()
+    _local.identity_map = identity_map
+    try:
+        yield identity_map
+    finally:
+        _local.identity_map = previous
+
+
+def call_in_scope(scope, function, *args, **kwargs):
+    """Call ``function`` with ``scope`` as the identity map scope, to share
+    a scope with another thread."""
+    with activate(scope):
+        return function(*args, **kwargs)
+
+
+@contextmanager
+def identity_map():
+    """Open an identity map scope and yield its ``IdentityMap``. A nested
+    scope uses the map of the outer scope."""
+    outer = current_map()
+    if outer is not None and outer.share_states:
+        yield outer
+        return
+
+    with activate(IdentityMap()) as scope:
+        yield scope
+
+
+@contextmanager
+def object_scope():
+    """Open a scope that only remembers the backend objects of the resources,
+    see ``IdentityMap``. Inside an identity map scope, its map is used."""
+    outer = current_map()
+    if outer is not None:
+        yield outer
+        return
+
+    with activate(IdentityMap(share_states=False)) as scope:
+        yield scope
+
+
+def _freeze(data):
+    return tuple(sorted(data.items()))
+
+
+def identity_key(document, identifier=None, credentials=None):
+    """Return the key of the resource of ``document``, or ``None`` if it
+    can't be identified. ``identifier`` defaults to the identifier state of
+    the document, ``credentials`` tells apart resources fetched by different
+    users."""
+    if identifier is None:
+        identifier = document._identifier_state()
+    key = (type(document), _freeze(identifier),
+            _freeze(document._get_context()), credentials)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+
+    return key
+
+
+def fetch_state(document, fetch, identifier=None, credentials=None):
+    """Return the state of ``document`` returned by ``fetch``. Inside an
+    identity map scope ``fetch`` is called once per resource."""
+    scope = current_map()
+    if scope is None:
+        return fetch()
+
+    key = identity_key(document, identifier, credentials)
+    if key is None:
+        return fetch()
+
+    return scope.fetch(key, fetch)
+
+
+def build(kind, Document, state, context, build):
+    """Return the object of ``kind`` built by ``build`` from the fetched
+    ``state`` of a ``Document`` with ``context``, like the related document
+    itself. Inside an identity map scope it is built once for each resource
+    and state."""
+    scope = current_map()
+    if scope is None or not scope.share_states:
+        return build()
+
+    try:
+        identifier = tuple(state[name] for name in Document._meta.identifier)
+        key = (kind, Document, identifier, _freeze(context))
+        hash(key)
+    except (KeyError, TypeError):
+        # The state doesn't identify its resource
+        return build()
+
+    return scope.build(key, state, build)
+
+
+def forget(document):
+    """Remove the state of ``document`` from the current scope."""
+    scope = current_map()
+    if scope is None:
+        return
+
+    key = identity_key(document)
+    if key is not None:
+        scope.discard(key)
+
+
+def remember_object(document, obj, identifier=None):
+    """Remember ``obj`` as the backend object of ``document`` in the current
+    scope. ``identifier`` defaults to the identifier state of the
+    document."""
+    scope = current_map()
+    if scope is None:
+        return
+
+    key = identity_key(document, identifier)
+    if key is not None:
+        scope.remember(key, obj)
+
+
+def loaded_object(document):
+    """Return the backend object of ``document`` that was loaded in the
+    current scope, or ``None``."""
+    scope = current_map()
+    if scope is None:
+        return None
+
+    key = identity_key(document)
+    if key is None:
+        return None
+
+    return scope.loaded(key)
+
+
+def forget_object(document):
+    """Remove the backend object of ``document`` from the current scope, after
+    it has been deleted."""
+    scope = current_map()
+    if scope is None:
+        return
+
+    key = identity_key(document)
+    if key is not None:
+        scope.discard_object(key)
@@ -1,4 +1,5 @@
 from setuptools import setup
+from setuptools.command.build_py import build_py
 import os
 import sys
 
@@ -10,6 +11,22 @@ def read(fname):
 extra = {}
 requirements = ['distribute', 'docutils', 'requests'],
 tests_require = ['nose', 'coverage', 'Mock']
+# The asynchronous http backend requires python 3 and aiohttp
+async_require = ['aiohttp; python_version >= "3.7"']
+
+# Modules that use python 3 syntax and can't be byte-compiled by python 2
+PY3_MODULES = [('docar.backends', 'http_async')]
+
+
+class BuildPy(build_py):
+    """Leave out the python 3 modules when building with python 2."""
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info >= (3,):
+            return modules
+        return [(pkg, module, path) for pkg, module, path in modules
+                if (pkg, module) not in PY3_MODULES]
+
 
 # In case we use python3
 if sys.version_info >= (3,):
@@ -29,7 +46,8 @@ setup(
     tests_require=tests_require,
     setup_requires='nose',
     test_suite="nose.collector",
-    extras_require={'test': tests_require},
+    extras_require={'test': tests_require, 'async': async_require},
+    cmdclass={'build_py': BuildPy},
 
     author="Christo Buschek",
     author_email="crito@30loops.net",
@@ -1,4 +1,7 @@
+import gc
 import unittest
+import threading
+import time
 
 from nose.tools import eq_, ok_
 from mock import Mock
@@ -6,6 +9,8 @@ from mock import Mock
 from docar.backends import BackendManager, DjangoBackendManager, \
     HttpBackendManager
 from docar import Document, Collection, fields
+from docar.cache import LRUCache
+from docar.identity import identity_map
 
 
 class when_a_backend_manager_gets_instantiated(unittest.TestCase):
@@ -55,3 +60,264 @@ class when_a_backend_manager_gets_instantiated(unittest.TestCase):
         ok_(isinstance(doc._backend_manager, HttpBackendManager))
 
 
+
+    def it_gives_each_document_its_own_backend_manager(self):
+        class Doc(Document):
+            id = fields.NumberField()
+
+            class Meta:
+                backend_type = 'django'
+                model = Mock()
+
+        doc1 = Doc({'id': 1})
+        doc2 = Doc({'id': 2})
+        ok_(doc1._backend_manager is doc1._backend_manager)
+        ok_(doc1._backend_manager is not doc2._backend_manager)
+        ok_(doc1._backend_manager is not Doc._backend_manager)
+        eq_(Doc._meta.model, doc1._backend_manager._model)
+
+        doc1._backend_manager.instance = Mock()
+        ok_(not hasattr(doc2._backend_manager, 'instance'))
+
+    def it_has_no_uri_without_a_model_instance(self):
+        manager = BackendManager('django')
+        eq_(None, manager.uri())
+
+
+class FakeRelatedModel(object):
+    DoesNotExist = Exception
+    loads = []
+
+    def __init__(self, kind, id):
+        self.kind = kind
+        self.id = id
+        self.name = '%s %s' % (kind, id)
+
+    def get_absolute_url(self):
+        return 'http://location/%s/%s/' % (self.kind, self.id)
+
+    class objects(object):
+        @staticmethod
+        def get(id):
+            FakeRelatedModel.loads.append(id)
+            return FakeRelatedModel('loaded', id)
+
+
+class FakeRelation(object):
+    def __init__(self, items):
+        self.items = items
+
+    def all(self):
+        return self.items
+
+
+class FakeArticleModel(object):
+    """A model that takes its time to be fetched, to let threads overlap."""
+    DoesNotExist = Exception
+
+    def __init__(self, id):
+        self.id = id
+        self.name = 'article %s' % id
+        self.editor = FakeRelatedModel('editor', id % 5)
+        self.tags = FakeRelation([FakeRelatedModel('tag', id + i)
+            for i in range(3)])
+
+    def get_absolute_url(self):
+        return 'http://location/article/%s/' % self.id
+
+    class objects(object):
+        @staticmethod
+        def select_related(*lookups):
+            return FakeArticleModel.objects
+
+        @staticmethod
+        def prefetch_related(*lookups):
+            return FakeArticleModel.objects
+
+        @staticmethod
+        def get(id):
+            time.sleep(0.001)
+            return FakeArticleModel(id)
+
+
+def make_related_documents(cache=None):
+    class Editor(Document):
+        id = fields.NumberField()
+        name = fields.StringField()
+
+        class Meta:
+            backend_type = 'django'
+            model = FakeRelatedModel
+
+    class Tag(Document):
+        id = fields.NumberField()
+        name = fields.StringField()
+
+        class Meta:
+            backend_type = 'django'
+            model = FakeRelatedModel
+
+    class Tags(Collection):
+        document = Tag
+
+    class Article(Document):
+        id = fields.NumberField()
+        name = fields.StringField()
+        editor = fields.ForeignDocument(Editor)
+        tags = fields.CollectionField(Tags)
+
+        class Meta:
+            backend_type = 'django'
+            model = FakeArticleModel
+            document_cache = cache
+
+    return Article
+
+
+def rendered_article(id):
+    return {'id': id, 'name': 'article %s' % id,
+            'editor': {'rel': 'related', 'id': id % 5,
+                'href': 'http://location/editor/%s/' % (id % 5)},
+            'tags': {'size': 3, 'items': [{'id': id + i,
+                'name': 'tag %s' % (id + i), 'link': {'rel': 'item',
+                    'href': 'http://location/tag/%s/' % (id + i)}}
+                for i in range(3)]},
+            'link': {'rel': 'self',
+                'href': 'http://location/article/%s/' % id}}
+
+
+class when_documents_are_used_in_threads(unittest.TestCase):
+    def it_fetches_and_renders_distinct_documents_in_parallel(self):
+        class Article(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = FakeArticleModel
+
+        results = {}
+        errors = []
+
+        def work(ids):
+            try:
+                for id in ids:
+                    article = Article({'id': id})
+                    article.fetch()
+                    time.sleep(0.001)
+                    results[id] = article.to_python()
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(range(i, 400, 8),))
+                for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        eq_([], errors)
+        eq_(400, len(results))
+        for id, result in results.items():
+            eq_({'id': id, 'name': 'article %s' % id,
+                'link': {'rel': 'self',
+                    'href': 'http://location/article/%s/' % id}}, result)
+
+    def it_renders_the_relations_of_documents_fetched_in_parallel(self):
+        Article = make_related_documents()
+        results = {}
+        errors = []
+
+        def work(ids):
+            try:
+                for id in ids:
+                    article = Article({'id': id})
+                    article.fetch()
+                    time.sleep(0.001)
+                    results[id] = article.to_python()
+            except Exception, e:
+                errors.append(e)
+
+        FakeRelatedModel.loads = []
+        threads = [threading.Thread(target=work, args=(range(i, 200, 8),))
+                for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        eq_([], errors)
+        eq_(200, len(results))
+        for id, result in results.items():
+            eq_(rendered_article(id), result)
+        # The related documents use the model instances of the fetch
+        eq_([], FakeRelatedModel.loads)
+
+
+class when_a_django_document_is_rebuilt(unittest.TestCase):
+    def it_renders_the_relations_of_a_document_in_an_identity_map(self):
+        Article = make_related_documents()
+
+        FakeRelatedModel.loads = []
+        with identity_map():
+            Article({'id': 1}).fetch()
+            # The second fetch uses the state of the identity map
+            article = Article({'id': 1})
+            article.fetch()
+
+            eq_(rendered_article(1), article.to_python())
+        eq_([], FakeRelatedModel.loads)
+
+    def it_renders_the_relations_of_a_cached_document(self):
+        Article = make_related_documents(LRUCache())
+        Article({'id': 1}).fetch()
+
+        FakeRelatedModel.loads = []
+        article = Article({'id': 1})
+        article.fetch()
+        eq_(1, Article._meta.cache_stats.hits)
+
+        # The model instances are loaded when the uris are rendered
+        result = article.to_python()
+        eq_('http://location/loaded/1/', result['editor']['href'])
+        eq_('http://location/article/1/', result['link']['href'])
+        eq_(['http://location/loaded/%s/' % id for id in (1, 2, 3)],
+                [item['link']['href'] for item in result['tags']['items']])
+        eq_([1, 1, 2, 3], sorted(FakeRelatedModel.loads))
+
+
+class when_django_documents_are_built_from_a_queryset(unittest.TestCase):
+    def setUp(self):
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = FakeRelatedModel
+
+        class Editors(Collection):
+            document = Editor
+
+        self.Editors = Editors
+        FakeRelatedModel.loads = []
+
+    def it_copies_the_backend_manager_only_for_the_uri(self):
+        models = [FakeRelatedModel('editor', id) for id in range(3)]
+        editors = self.Editors()
+        editors._from_queryset(models)
+
+        for editor in editors.collection_set:
+            eq_(None, getattr(editor, '_manager', None))
+        eq_('http://location/editor/1/', editors.collection_set[1].uri())
+        ok_(editors.collection_set[1]._manager is not None)
+        eq_([], FakeRelatedModel.loads)
+
+    def it_does_not_keep_the_model_instances_alive(self):
+        editors = self.Editors()
+        editors._from_queryset([FakeRelatedModel('editor', 1)])
+        gc.collect()
+
+        # The model instance is loaded again for the uri
+        eq_('http://location/loaded/1/', editors.collection_set[0].uri())
+        eq_([1], FakeRelatedModel.loads)
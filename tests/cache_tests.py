@@ -0,0 +1,237 @@
+import unittest
+import json
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+from mock import patch, Mock
+
+from docar import Document, Collection, fields
+from docar.cache import (CacheEntry, LRUCache, FileCache, MemcacheCache,
+        RedisCache, document_key)
+
+
+class when_an_lru_cache_is_used(unittest.TestCase):
+    def it_evicts_the_least_recently_used_entries(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # Using an entry makes it the most recently used one
+        eq_(1, cache.get('a'))
+        cache.set('c', 3)
+
+        eq_(None, cache.get('b'))
+        eq_(1, cache.get('a'))
+        eq_(3, cache.get('c'))
+        eq_(2, len(cache))
+
+    @patch('docar.cache.time')
+    def it_expires_entries_after_their_ttl(self, mock_time):
+        cache = LRUCache(ttl=10)
+        mock_time.time.return_value = 100
+        cache.set('a', 1)
+
+        mock_time.time.return_value = 109
+        eq_(1, cache.get('a'))
+        mock_time.time.return_value = 110
+        eq_(None, cache.get('a'))
+        eq_(0, len(cache))
+
+    def it_can_delete_entries(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('missing')
+
+        eq_(None, cache.get('a'))
+
+
+class when_a_file_cache_is_used(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def it_stores_entries_on_disk(self):
+        entry = CacheEntry('"v1"', None, {'id': 1, 'items': [1, 2]})
+        FileCache(self.directory).set('http://location/', entry)
+
+        # Another cache on the same directory finds the entry
+        cache = FileCache(self.directory)
+        eq_(entry, cache.get('http://location/'))
+        eq_(None, cache.get('http://other/'))
+
+        cache.delete('http://location/')
+        eq_(None, cache.get('http://location/'))
+
+    def it_ignores_broken_entries(self):
+        cache = FileCache(self.directory)
+        cache.set('key', 1)
+        with open(cache._path('key'), 'wb') as fd:
+            fd.write(b'broken')
+
+        eq_(None, cache.get('key'))
+
+
+class FakeMemcacheClient(object):
+    """Keep the entries in a dict, like a memcached or redis server would."""
+    def __init__(self):
+        self.entries = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl=0):
+        self.entries[key] = value
+        self.expiry[key] = ttl
+
+    def setex(self, key, ttl, value):
+        self.set(key, value, ttl)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+
+class when_a_memcached_or_redis_cache_is_used(unittest.TestCase):
+    def it_stores_pickled_entries_on_the_server(self):
+        client = FakeMemcacheClient()
+        cache = MemcacheCache(client, ttl=30)
+        cache.set('a key with spaces', {'id': 1})
+
+        key, = client.entries.keys()
+        ok_(key.startswith('docar:'))
+        ok_(' ' not in key)
+        eq_(30, client.expiry[key])
+        eq_({'id': 1}, cache.get('a key with spaces'))
+
+        cache.delete('a key with spaces')
+        eq_(None, cache.get('a key with spaces'))
+
+    def it_sets_an_expiry_on_redis_only_with_a_ttl(self):
+        client = Mock(name='redis')
+        RedisCache(client).set('key', 1)
+        RedisCache(client, ttl=5).set('key', 1)
+
+        eq_(['set', 'setex'], [call[0] for call in client.method_calls])
+        eq_(5, client.setex.call_args[0][1])
+
+
+class when_documents_are_cached(unittest.TestCase):
+    def setUp(self):
+        self.request_patcher = patch('docar.backends.http.requests')
+        self.mock_request = self.request_patcher.start()
+
+        class Article(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'http'
+                document_cache = MemcacheCache(FakeMemcacheClient())
+
+            def uri(self):
+                return 'http://location/%s/' % self.id
+
+        class Articles(Collection):
+            document = Article
+
+        self.Article = Article
+        self.Articles = Articles
+
+        def get(url, **kwargs):
+            response = Mock(name='mock_http_response')
+            response.status_code = 200
+            id = int(url.split('/')[-2])
+            response.content = json.dumps({'id': id, 'name': 'article %s' % id})
+            return response
+
+        self.mock_request.get.side_effect = get
+        self.mock_request.put.return_value.status_code = 200
+        self.mock_request.delete.return_value.status_code = 204
+
+    def tearDown(self):
+        self.request_patcher.stop()
+
+    def it_fetches_documents_from_the_cache(self):
+        self.Article({'id': 1}).fetch()
+        article = self.Article({'id': 1})
+        article.fetch()
+
+        eq_('article 1', article.name)
+        eq_(1, self.mock_request.get.call_count)
+        stats = self.Article._meta.cache_stats
+        eq_((1, 1), (stats.hits, stats.misses))
+
+        # Other users don't share the cached documents
+        self.Article({'id': 1}).fetch(username='user', password='secret')
+        eq_(2, self.mock_request.get.call_count)
+
+    def it_asks_the_backend_if_the_password_is_different(self):
+        self.Article({'id': 1}).fetch(username='user', password='secret')
+        self.Article({'id': 1}).fetch(username='user', password='secret')
+        eq_(1, self.mock_request.get.call_count)
+
+        # The backend checks the wrong password
+        self.Article({'id': 1}).fetch(username='user', password='wrong')
+        eq_(2, self.mock_request.get.call_count)
+
+    def it_removes_saved_updated_and_deleted_documents_from_the_cache(self):
+        cache = self.Article._meta.document_cache
+        article = self.Article({'id': 1})
+        article.fetch()
+
+        article.name = 'changed'
+        article.save()
+        eq_(None, cache.get(document_key(article)))
+
+        article.fetch()
+        article.update({'name': 'new'})
+        eq_(None, cache.get(document_key(article)))
+        # The update fetched the document from the backend
+        eq_(3, self.mock_request.get.call_count)
+
+        article.fetch()
+        article.delete()
+        eq_(None, cache.get(document_key(article)))
+        # The update invalidates before fetching and after saving
+        eq_(4, self.Article._meta.cache_stats.invalidations)
+
+    def it_removes_the_documents_cached_for_all_users(self):
+        def fetch(username):
+            article = self.Article({'id': 1})
+            article.fetch(username=username, password='secret')
+            return article
+
+        fetch('alice')
+        fetch('bob')
+        eq_(2, self.mock_request.get.call_count)
+        fetch('alice')
+        fetch('bob')
+        eq_(2, self.mock_request.get.call_count)
+
+        # Alice changes the article, bob doesn't get the old one anymore
+        article = fetch('alice')
+        article.name = 'changed'
+        article.save(username='alice', password='secret')
+
+        fetch('bob')
+        eq_(3, self.mock_request.get.call_count)
+        eq_('http://location/1/',
+                self.mock_request.get.call_args[1]['url'])
+        fetch('alice')
+        eq_(4, self.mock_request.get.call_count)
+
+    def it_fetches_only_uncached_documents_of_a_collection(self):
+        self.Article({'id': 2}).fetch()
+
+        articles = self.Articles()
+        articles.fetch_all([{'id': i} for i in range(1, 4)])
+
+        eq_(['article 1', 'article 2', 'article 3'],
+                [article.name for article in articles.collection_set])
+        eq_(['http://location/%s/' % i for i in (2, 1, 3)],
+                [call[1]['url']
+                    for call in self.mock_request.get.call_args_list])
@@ -0,0 +1,86 @@
+import unittest
+import json
+
+from nose.tools import eq_, ok_, assert_raises
+from mock import patch, Mock
+
+from docar import codec
+from docar import Document, Collection, fields
+
+
+class FakeCodec(codec.JsonCodec):
+    name = 'fake'
+
+    def dumps(self, obj):
+        return 'fake:' + json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data[len('fake:'):])
+
+
+class Doc(Document):
+    id = fields.NumberField()
+
+    class Meta:
+        backend_type = 'http'
+
+    def uri(self):
+        return 'http://location'
+
+
+class Col(Collection):
+    document = Doc
+
+
+class when_a_json_codec_is_used(unittest.TestCase):
+    def setUp(self):
+        codec.register_codec(FakeCodec())
+
+    def tearDown(self):
+        codec.set_codec('json')
+
+    def it_uses_the_standard_library_by_default(self):
+        eq_('json', codec.get_codec().name)
+        ok_('json' in codec.available_codecs())
+        eq_('{"id": 1}', codec.dumps({'id': 1}))
+        eq_({'id': 1}, codec.loads('{"id": 1}'))
+
+    def it_raises_an_error_for_unknown_codecs(self):
+        assert_raises(ValueError, codec.set_codec, 'unknown')
+        eq_('json', codec.get_codec().name)
+
+    def it_is_used_by_documents_and_collections(self):
+        codec.set_codec('fake')
+
+        doc = Doc({'id': 1})
+        eq_(doc.to_python(), codec.loads(doc.to_json()))
+
+        col = Col([doc])
+        eq_(col.to_python(), codec.loads(col.to_json()))
+
+    @patch('docar.backends.http.requests')
+    def it_is_used_by_the_http_backend(self, mock_request):
+        codec.set_codec('fake')
+
+        response = Mock(name='mock_http_response')
+        response.status_code = 200
+        response.content = 'fake:{"id": 1}'
+        mock_request.get.return_value = response
+        mock_request.put.return_value = response
+
+        doc = Doc({'id': 1})
+        eq_({'id': 1}, doc._backend_manager.fetch(doc))
+
+        doc._backend_manager.save(doc)
+        eq_(('put', {'url': 'http://location', 'data': 'fake:{"id": 1}'}),
+                mock_request.method_calls[-1])
+
+    def it_provides_adapters_for_the_installed_json_libraries(self):
+        data = {'id': 1, 'name': u'name', 'items': [1, 2.5, None, True]}
+
+        for name in codec.available_codecs():
+            if name == FakeCodec.name:
+                continue
+            json_codec = codec.get_codec(name)
+            eq_(data, json.loads(json_codec.dumps(data)))
+            eq_(data, json_codec.loads(json.dumps(data)))
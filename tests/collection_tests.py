@@ -1,12 +1,21 @@
 import unittest
+import json
 
+from StringIO import StringIO
 from nose.tools import eq_, assert_raises
-from mock import Mock
+from nose.plugins.skip import SkipTest
+from mock import Mock, patch
 
 from docar import fields
 from docar.documents import Document
 from docar.collections import Collection
-from docar.exceptions import CollectionNotBound
+from docar.exceptions import (CollectionNotBound, BackendDoesNotExist,
+        ValidationError)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # import the sample app
 from app import Article, NewsPaper
@@ -35,12 +44,9 @@ class when_a_collection_gets_instantiated(unittest.TestCase):
                 {'id': 3},
                 ]
         DjangoModel = Mock(name='DjangoModel')
-        model_list = [Mock(), Mock(), Mock()]
-
-        def get_side_effect(*args, **kwargs):
-            return model_list.pop()
+        model_list = [Mock(id=3), Mock(id=1), Mock(id=2)]
 
-        DjangoModel.objects.get.side_effect = get_side_effect
+        DjangoModel.objects.filter.return_value = model_list
 
         class Doc(Document):
             id = fields.NumberField()
@@ -57,18 +63,116 @@ class when_a_collection_gets_instantiated(unittest.TestCase):
         # create a collection with all documents
         c.fetch_all(query_list)
 
-        # The fetch_all must have created a collection with 3 documents
-        eq_(3, len(c.collection_set))
+        # The fetch_all must have created a collection with 3 documents, in
+        # the order of the query list
+        eq_([1, 2, 3], [doc.id for doc in c.collection_set])
 
-        # The fetch_all must have queried 3x the backend model
+        # The fetch_all must have queried the backend model once
         expected_calls = [
-                ('objects.get', {'id': 1}),
-                ('objects.get', {'id': 2}),
-                ('objects.get', {'id': 3}),
+                ('objects.filter', {'id__in': [1, 2, 3]}),
                 ]
 
         eq_(expected_calls, DjangoModel.method_calls)
 
+    def it_fetches_documents_with_several_identifiers_at_once(self):
+        # The backend imports Q from django when it needs it
+        django = Mock(name='django')
+        modules = {'django': django, 'django.db': django.db,
+                'django.db.models': django.db.models}
+        mock_q = django.db.models.Q
+        DjangoModel = Mock(name='DjangoModel')
+        model_b, model_a = Mock(id=2), Mock(id=1)
+        model_b.name, model_a.name = 'b', 'a'
+        DjangoModel.objects.filter.return_value = [model_b, model_a]
+        mock_q.side_effect = lambda **kwargs: set([tuple(kwargs.items())])
+
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = DjangoModel
+                identifier = ['id', 'name']
+
+        class Col(Collection):
+            document = Doc
+
+        c = Col()
+        query_list = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'},
+                {'id': 3, 'name': 'c'}]
+
+        # The missing document is reported
+        with patch.dict('sys.modules', modules):
+            try:
+                c.fetch_all(query_list)
+            except BackendDoesNotExist, e:
+                eq_([{'id': 3, 'name': 'c'}], e.args[1])
+            else:
+                raise AssertionError("BackendDoesNotExist not raised")
+
+        eq_([(1, 'a'), (2, 'b')], [(doc.id, doc.name)
+            for doc in c.collection_set])
+        eq_(1, len(DjangoModel.objects.filter.call_args_list))
+
+        # The model instances are selected by an OR of the identifiers
+        query = DjangoModel.objects.filter.call_args[0][0]
+        eq_(set([(('id', 1), ('name', 'a')), (('id', 2), ('name', 'b')),
+            (('id', 3), ('name', 'c'))]), set(tuple(sorted(item))
+                for item in query))
+
+    def it_saves_all_documents_at_once(self):
+        DjangoModel = Mock(name='DjangoModel')
+        existing = Mock(id=2)
+        created = [Mock(name='created1'), Mock(name='created3')]
+        DjangoModel.objects.filter.return_value = [existing]
+        DjangoModel.side_effect = lambda **kwargs: created.pop(0)
+
+        class Doc(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = DjangoModel
+
+        class Col(Collection):
+            document = Doc
+
+        c = Col([Doc({'id': i, 'title': 'title %s' % i}) for i in (1, 2, 3)])
+        c.save_all(batch_size=100)
+
+        # The existing model instances are selected with one query, the new
+        # ones created and the existing ones updated in bulk
+        DjangoModel.objects.filter.assert_called_once_with(id__in=[1, 2, 3])
+        eq_([({'id': 1},), ({'id': 3},)], [call[1:]
+            for call in DjangoModel.call_args_list])
+        create_args = DjangoModel.objects.bulk_create.call_args
+        eq_(['title 1', 'title 3'], [m.title for m in create_args[0][0]])
+        eq_({'batch_size': 100}, create_args[1])
+        DjangoModel._default_manager.bulk_update.assert_called_once_with(
+                [existing], ['title'], batch_size=100)
+        eq_('title 2', existing.title)
+        eq_(False, existing.save.called)
+
+    def it_saves_nothing_if_a_document_does_not_validate(self):
+        DjangoModel = Mock(name='DjangoModel')
+
+        class Doc(Document):
+            id = fields.NumberField()
+
+            class Meta:
+                backend_type = 'django'
+                model = DjangoModel
+
+        class Col(Collection):
+            document = Doc
+
+        c = Col([Doc({'id': 1}), Doc({'id': 'two'})])
+
+        assert_raises(ValidationError, c.save_all)
+        eq_([], DjangoModel.method_calls)
+
     def it_can_append_new_documents(self):
         doc1 = Article({'id': 1, 'name': 'doc1'})
         newspaper = NewsPaper()
@@ -209,3 +313,259 @@ class when_a_collection_gets_instantiated(unittest.TestCase):
         eq_(True, isinstance(doc2, Doc))
         eq_(1, doc1.id)
         eq_(2, doc2.id)
+
+    def it_can_stream_a_queryset_in_chunks(self):
+        class Doc(Document):
+            id = fields.NumberField()
+
+            def uri(self):
+                return 'item_location'
+
+        class Col(Collection):
+            document = Doc
+
+            def uri(self):
+                return "collection_location"
+
+        models = []
+        for i in range(5):
+            model = Mock(spec_set=['id'])
+            model.id = i
+            models.append(model)
+        qs = Mock(name='queryset')
+        qs.iterator.side_effect = lambda chunk_size: iter(models)
+
+        eq_([[0, 1], [2, 3], [4]],
+                [[doc.id for doc in chunk]
+                    for chunk in Col().iter_queryset(qs, 2)])
+        qs.iterator.assert_called_with(chunk_size=2)
+        eq_([0, 1], [item['id'] for item in next(Col().iter_rendered(qs, 2))])
+
+        # Filled with a chunk size, the result cache of the queryset is not
+        # used
+        col = Col()
+        col._from_queryset(qs, chunk_size=2)
+        eq_(range(5), [doc.id for doc in col.collection_set])
+
+        # A streaming collection builds its documents when it is rendered
+        col = Col()
+        col._from_queryset(qs, chunk_size=2, stream=True)
+        eq_([], col.collection_set)
+
+        chunks = list(col.iter_json())
+        # The envelope, one chunk per chunk of documents, the size, the link
+        # and the end
+        eq_(7, len(chunks))
+        eq_(Col([Doc({'id': i}) for i in range(5)]).to_python(),
+                json.loads(''.join(chunks)))
+        eq_(json.loads(''.join(chunks)), json.loads(col.to_json()))
+        eq_(5, col.render()['size'])
+
+    def it_streams_querysets_without_chunk_sizes(self):
+        class Doc(Document):
+            id = fields.NumberField()
+
+        class Col(Collection):
+            document = Doc
+
+        qs = Mock(name='old_queryset')
+        qs.iterator.side_effect = [TypeError(), iter([])]
+
+        col = Col()
+        col._from_queryset(qs, stream=True)
+        eq_({'size': 0, 'items': []}, json.loads(''.join(col.iter_json())))
+        eq_([{'chunk_size': 2000}, {}],
+                [call[1] for call in qs.iterator.call_args_list])
+
+    def it_can_stream_itself_as_json(self):
+        class Doc(Document):
+            id = fields.NumberField()
+
+            def uri(self):
+                return 'item_location'
+
+        class Col(Collection):
+            document = Doc
+
+            def uri(self):
+                return "collection_location"
+
+        class UnlinkedCol(Collection):
+            document = Doc
+
+        collection = Col([Doc({'id': 1}), Doc({'id': 2})])
+
+        chunks = list(collection.iter_json())
+
+        # The envelope, one chunk per document and the closing chunks
+        eq_(6, len(chunks))
+        eq_(collection.to_python(), json.loads(''.join(chunks)))
+
+        fp = StringIO()
+        collection.write_json(fp)
+        eq_(json.loads(collection.to_json()), json.loads(fp.getvalue()))
+
+        # Empty collections and collections without an uri work too
+        eq_({'size': 0, 'items': []},
+                json.loads(''.join(UnlinkedCol().iter_json())))
+        eq_(UnlinkedCol([Doc({'id': 1})]).to_python(),
+                json.loads(''.join(UnlinkedCol([Doc({'id': 1})]).iter_json())))
+
+
+class when_a_collection_validates_its_documents(unittest.TestCase):
+    def setUp(self):
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+        class Article(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+            editor = fields.ForeignDocument(Editor)
+
+        class Articles(Collection):
+            document = Article
+
+        self.Article = Article
+        self.Articles = Articles
+
+    def it_returns_the_errors_of_all_invalid_documents(self):
+        articles = self.Articles([
+            self.Article({'id': 1, 'title': 'one',
+                'editor': {'id': 1, 'name': 'Editor'}}),
+            self.Article({'id': 'two', 'title': 'two',
+                'editor': {'id': 1, 'name': 'Editor'}}),
+            self.Article({'id': 3, 'editor': {'id': 1, 'name': 'Editor'}}),
+            ])
+
+        eq_({1: {'id': 'Must be an integer.'},
+            2: {'title': 'Field must be set.'}}, articles.validate_all())
+
+        articles.collection_set[1].id = 2
+        articles.collection_set[2].title = 'three'
+        eq_({}, articles.validate_all())
+
+    def it_uses_the_validate_method_of_the_documents(self):
+        class Article(self.Article):
+            def validate(self, *args, **kwargs):
+                raise ValidationError({'title': 'Not today.'})
+
+        class Articles(Collection):
+            document = Article
+
+        articles = Articles([Article({'id': 1, 'title': 'one',
+            'editor': {'id': 1, 'name': 'Editor'}})])
+
+        eq_({0: {'title': 'Not today.'}}, articles.validate_all())
+
+
+class when_a_collection_validates_columns(unittest.TestCase):
+    def setUp(self):
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+        class Article(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+            summary = fields.StringField(optional=True)
+            published = fields.BooleanField(default=False)
+            status = fields.ChoicesField(choices=['draft', 'live'])
+            editor = fields.ForeignDocument(Editor, optional=True)
+
+        class Articles(Collection):
+            document = Article
+
+        self.Article = Article
+        self.Articles = Articles
+        self.columns = {
+            'id': [1, 'two', 3, 4],
+            'title': ['one', 'two', '', 'four'],
+            'summary': [None, '', 'three', 'four'],
+            'published': [True, 'f', 'maybe', 1],
+            'status': ['draft', 'live', 'live', 'gone'],
+            }
+
+    def it_returns_the_same_errors_as_the_documents(self):
+        articles = self.Articles()
+        expected = {
+            1: {'id': 'Must be an integer.'},
+            2: {'title': 'Field must be set.',
+                'published': 'Must be either True or False'},
+            3: {'status': 'gone is not a valid choice.'},
+            }
+
+        eq_(expected, articles.validate_columns(self.columns))
+
+        rows = zip(*[self.columns[name] for name in sorted(self.columns)])
+        for row in rows:
+            articles.add(self.Article(dict(zip(sorted(self.columns), row))))
+        eq_(expected, articles.validate_all())
+
+    def it_checks_the_default_of_a_missing_column_once(self):
+        errors = self.Articles().validate_columns({
+            'id': [1, 2],
+            'title': ['one', 'two'],
+            'status': ['draft', 'live'],
+            })
+        eq_({}, errors)
+
+        errors = self.Articles().validate_columns({
+            'id': [1, 2],
+            'status': ['draft', 'live'],
+            })
+        eq_({0: {'title': 'Field must be set.'},
+            1: {'title': 'Field must be set.'}}, errors)
+
+    def it_needs_columns_of_the_same_length(self):
+        assert_raises(ValueError, self.Articles().validate_columns,
+                {'id': [1, 2], 'title': ['one']})
+
+    def it_builds_the_documents_of_the_valid_rows_on_demand(self):
+        with patch.object(self.Article, '__init__') as init:
+            init.return_value = None
+            batch = self.Articles().from_columns(self.columns)
+            eq_(False, init.called)
+
+        eq_(4, len(batch))
+        eq_([0], batch.valid_rows())
+        eq_('f', self.columns['published'][1])
+        eq_(False, batch.columns['published'][1])
+
+        articles = batch.collection()
+        eq_(1, len(articles.collection_set))
+        article = articles.collection_set[0]
+        eq_(1, article.id)
+        eq_(True, article.published)
+        eq_({}, articles.validate_all())
+
+        eq_('two', batch.document(1).title)
+        eq_([1, 3], [doc.id for doc in batch.documents([0, 2])])
+
+    def it_hands_on_the_columns_of_foreign_documents(self):
+        batch = self.Articles().from_columns({
+            'id': [1],
+            'title': ['one'],
+            'status': ['live'],
+            'editor': [{'id': 1, 'name': 'Editor'}],
+            })
+
+        eq_('Editor', batch.document(0).editor.name)
+
+    def it_converts_numpy_arrays(self):
+        if numpy is None:
+            raise SkipTest("Converting arrays requires numpy.")
+
+        columns = {
+            'id': numpy.array([1, 2, 3]),
+            'title': numpy.array(['one', 'two', 'three']),
+            'published': numpy.array([0, 1, 2]),
+            'status': numpy.array(['draft', 'live', 'gone']),
+            }
+        batch = self.Articles().from_columns(columns)
+
+        eq_({2: {'published': 'Must be either True or False',
+            'status': 'gone is not a valid choice.'}}, batch.errors)
+        eq_([1, 2, 3], batch.columns['id'])
+        eq_(int, type(batch.columns['id'][0]))
+        eq_([False, True], [doc.published for doc in batch.documents()])
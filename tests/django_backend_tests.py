@@ -1,13 +1,53 @@
+import copy
+import os
+import runpy
+import types
 import unittest
 
 from nose.tools import eq_, ok_
-from mock import patch, Mock
+from mock import patch, Mock, MagicMock
 
 from docar.backends import BackendManager, DjangoBackendManager
+from docar.backends import django as django_backend
+from docar.backends.django import query_plan
+from docar.identity import identity_map
 from docar import Document, Collection, fields
 
 
+class FakeExpression(object):
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+
+def fake_django(can_return_rows=True):
+    """Patch the django modules, that the backend imports where it uses
+    them. ``can_return_rows`` tells if the database returns the primary keys
+    of the rows created by ``bulk_create``, like PostgreSQL does."""
+    django = MagicMock(name='django')
+    db = django.db
+    db.models.Case = db.models.When = db.models.Value = FakeExpression
+    features = Mock(can_return_rows_from_bulk_insert=can_return_rows)
+    db.connections = {'default': Mock(features=features)}
+    db.router.db_for_write.return_value = 'default'
+    return patch.dict('sys.modules', {'django': django, 'django.db': db,
+        'django.db.models': db.models})
+
+
+class UnconfiguredModule(types.ModuleType):
+    """A django module that can't be used without configured settings."""
+    def __getattr__(self, name):
+        raise RuntimeError("Settings are not configured.")
+
+
 class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
+    def it_imports_django_only_where_it_uses_it(self):
+        path = os.path.splitext(django_backend.__file__)[0] + '.py'
+        with patch.dict('sys.modules', {
+                'django': UnconfiguredModule('django'),
+                'django.db': UnconfiguredModule('django.db')}):
+            runpy.run_path(path)
+
     def it_can_fetch_save_and_delete_to_the_specific_backend_manager(self):
         with patch('docar.backends.DjangoBackendManager') as mock:
             mock_manager = Mock()
@@ -105,6 +145,7 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         doc._identifier_state.return_value = {"id": 1}
         doc._save.return_value = {"id": 1}
         doc._meta.local_fields = [field]
+        doc._meta.map_hooks = {}
 
         # make sure we are working with correct expectations
         eq_(DjangoBackendManager, type(manager))
@@ -134,6 +175,7 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         doc._identifier_state.return_value = {"id": 1}
         doc._save.return_value = {"id": 1}
         doc._meta.local_fields = [field]
+        doc._meta.map_hooks = {}
 
         # the manager.save() method doesn't return on success
         manager.save(doc)
@@ -204,6 +246,8 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
 
         OtherModel.objects.get.side_effect = mock_side_effect
         DjangoModel.objects.get.return_value = mock_model
+        # The m2m relation is prefetched
+        DjangoModel.objects.prefetch_related.return_value = DjangoModel.objects
 
         # Now create a simple document setup
         class OtherDoc(Document):
@@ -242,12 +286,14 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
                 'others': [{'id': 1}, {'id': 2}]}
         eq_(expected, manager.fetch(doc))
 
+    @fake_django()
     def it_saves_collections_as_m2m_relations(self):
         # prepare the app structure
         Doc1Model = Mock(name="doc1_model")
 
         class Doc1(Document):
             id = fields.NumberField()
+            name = fields.StringField()
 
             class Meta:
                 backend_type = 'django'
@@ -272,48 +318,24 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         request = {
                 "id": 1,
                 "col": [
-                    {"id": 1},
-                    {"id": 2}
+                    {"id": 1, "name": "one"},
+                    {"id": 2, "name": "two"}
                     ]
                 }
 
-        # now mock the underlying model store
+        # now mock the underlying model store, the relation has one of the
+        # two items of the collection already
         mock_doc2 = Mock(name="mock_doc2_model")
         mock_doc1_1 = Mock(name="mock_doc1_1")
+        mock_doc1_1.id = 1
         mock_doc1_2 = Mock(name="mock_doc1_2")
 
         Doc2Model.objects.get.return_value = mock_doc2
-
-        collection_model = [mock_doc1_2, mock_doc1_1]
-
-        def se(*args, **kwargs):
-            return collection_model.pop()
-
-        # I have to mock a queryset for each collection, cause I run an exclude
-        # on it everytime I iterate through an item of the collection
-        qs_col = Mock(name="queryset")
-        qs_col.__len__ = Mock(return_value=2)
-        qs_col.__getitem__ = Mock()
-        qs_col.__iter__ = Mock(
-                return_value=iter([mock_doc1_1, mock_doc1_2]))
-
-        qs_cola = Mock(name="queryset-exclude_cola")
-        qs_cola.__len__ = Mock(return_value=1)
-        qs_cola.__getitem__ = Mock()
-        qs_cola.__iter__ = Mock(return_value=iter([mock_doc1_2]))
-
-        qs_col.exclude.return_value = qs_cola
-        qs_colb = Mock(name="queryset-exclude_colb")
-        qs_colb.__len__ = Mock(return_value=1)
-        qs_colb.__getitem__ = Mock()
-        qs_colb.__iter__ = Mock(return_value=iter([]))
-        qs_cola.exclude.return_value = qs_colb
+        Doc1Model.return_value = mock_doc1_2
 
         mock_doc2.col = Mock()
         mock_doc2.col.__dict__['model'] = Doc1Model
-        mock_doc2.col.get.side_effect = se
-        mock_doc2.col.get.return_value = True
-        mock_doc2.col.all.return_value = qs_col
+        mock_doc2.col.all.return_value = [mock_doc1_1]
 
         doc = Doc2(request)
 
@@ -321,9 +343,18 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
 
         doc.save()
 
-        eq_(True, mock_doc2.col.get.called)
-        eq_(True, Doc2Model.objects.get.called)
         Doc2Model.objects.get.assert_called_once_with(id=1)
+        # The current items are loaded once, the existing item is updated,
+        # the new one created and added to the relation
+        eq_(1, mock_doc2.col.all.call_count)
+        Doc1Model._default_manager.bulk_update.assert_called_once_with(
+                [mock_doc1_1], ['name'], batch_size=None)
+        eq_('one', mock_doc1_1.name)
+        Doc1Model.assert_called_once_with(id=2, name='two')
+        Doc1Model._default_manager.bulk_create.assert_called_once_with(
+                [mock_doc1_2])
+        mock_doc2.col.add.assert_called_once_with(mock_doc1_2)
+        eq_(False, Doc1Model._default_manager.filter.called)
 
     def it_supplies_the_foreign_model_instance_when_saving_a_foreign_key(self):
         # prepare the app structure
@@ -439,6 +470,7 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         Doc2Model.objects.get.assert_called_once_with(id=2,
                 name='hello')
 
+    @fake_django()
     def it_can_save_nested_collections_on_the_django_backend(self):
         # Prepare an environment where you have a collection nesting another
         # collection
@@ -520,47 +552,26 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         mock_doc2.doc1_map = Mock(name='doc1_map')
         mock_doc2.doc1_map.__dict__['model'] = Doc1Model
 
-        # I have to mock a queryset for each collection, cause I run an exclude
-        # on it everytime I iterate through an item of the collection
-        qs_doc2 = Mock(name="queryset2")
-        qs_doc2.__len__ = Mock(return_value=1)
-        qs_doc2.__getitem__ = Mock()
-        qs_doc2.__iter__ = Mock(
-                return_value=iter([mock_doc2]))
-        qs_doc2a = Mock(name="queryset-exclude_doc2")
-        qs_doc2a.__iter__ = Mock(return_value=iter([]))
-        qs_doc2.exclude.return_value = qs_doc2a
-
-        mock_doc3.doc2.all.return_value = qs_doc2
-        mock_doc3.doc2.create.return_value = mock_doc2
-        mock_doc3.doc2.get.return_value = mock_doc2
+        # The relation of the new doc3 is empty, the nested relation of doc2
+        # has the item already
+        Doc2Model.return_value = mock_doc2
+        mock_doc3.doc2.all.return_value = []
         mock_doc1 = Mock()
-        mock_doc1.__dict__['model'] = Doc1Model
         mock_doc1.id = 3
-
-        qs_doc1 = Mock(name="queryset1")
-        qs_doc1.__len__ = Mock(return_value=1)
-        qs_doc1.__getitem__ = Mock()
-        qs_doc1.__iter__ = Mock(
-                return_value=iter([mock_doc1]))
-
-        qs_doc1a = Mock(name="queryset-exclude_doc1")
-        qs_doc1a.__len__ = Mock(return_value=0)
-        qs_doc1a.__getitem__ = Mock()
-        qs_doc1a.__iter__ = Mock(return_value=iter([]))
-        qs_doc1.exclude.return_value = qs_doc1a
-
-        mock_doc2.doc1_map.all.return_value = qs_doc1
-        mock_doc2.doc1_map.get.return_value = mock_doc1
-        mock_doc2.doc1_map.create.return_value = mock_doc1
+        mock_doc2.doc1_map.all.return_value = [mock_doc1]
 
         # saving the model should create all nested relations too
         doc3.save()
 
         # make sure the right methods have been called.
-        ok_(mock_doc2.doc1_map.get.called)
-        ok_(mock_doc3.doc2.get.called)
         ok_(Doc3Model.called)
+        Doc2Model._default_manager.bulk_create.assert_called_once_with(
+                [mock_doc2])
+        mock_doc3.doc2.add.assert_called_once_with(mock_doc2)
+        # The nested collection is synchronized with the created instance
+        eq_(1, mock_doc2.doc1_map.all.call_count)
+        eq_(False, Doc1Model._default_manager.bulk_create.called)
+        eq_(False, Doc1Model._default_manager.filter.called)
 
     def it_calls_the_fetch_field_method_when_saving(self):
         DocModel = Mock()
@@ -633,9 +644,12 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         # and therefore creates a new model instance
         Model1.objects.get.return_value = mock_doc1
         Model2.objects.get.return_value = mock_doc2
+        # The foreign document is selected together with the model instance
+        Model2.objects.select_related.return_value = Model2.objects
 
         doc2 = Doc2({'id': 1}, context={'name1': 'name1', 'name2': 'name2'})
         doc2.fetch()
+        doc2.name2 = 'other name2'
         doc2.save()
 
         #Model1.objects.get.assert_called_with(id=1, name1="name1")
@@ -667,11 +681,11 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         # First return an existing model instance
         mock_doc1a = Mock()
         mock_doc1a.id = 1
-        mock_doc1a.__dict__['model'] = Model1
+        mock_doc1a.pk = 10
 
         mock_doc1b = Mock()
         mock_doc1b.id = 2
-        mock_doc1b.__dict__['model'] = Model1
+        mock_doc1b.pk = 20
 
         m2m_relation = Mock(name="m2m_relation")
         mock_doc2 = Mock()
@@ -679,50 +693,801 @@ class when_a_django_backend_manager_gets_instantiated(unittest.TestCase):
         mock_doc2.id = 3
         mock_doc2.col1.__dict__['model'] = Model1
 
-        # The fetch for the foreign document will raise a BackendDoesNotExist
-        # and therefore creates a new model instance
         Model2.objects.get.return_value = mock_doc2
-
-        Queryset = Mock(name="queryset")
-        Queryset.__len__ = Mock(return_value=2)
-        Queryset.__getitem__ = Mock()
-        Queryset.__iter__ = Mock(
-                return_value=iter([mock_doc1a, mock_doc1b]))
-        m2m_relation.all.return_value = Queryset
+        m2m_relation.all.return_value = [mock_doc1a, mock_doc1b]
 
         doc = Doc2({'id': 1, 'col1':[]})
         doc.save()
 
         # If the collection is empty we make sure that the backend instances
-        # are delete too
-        eq_(True, mock_doc1a.delete.called)
-        eq_(True, mock_doc1b.delete.called)
-
-        mock_doc1a.reset_mock()
-        mock_doc1b.reset_mock()
-        m2m_relation.all.reset_mock()
-
-        Queryset1 = Mock(name="queryset1")
-        Queryset1.__len__ = Mock(return_value=2)
-        Queryset1.__getitem__ = Mock()
-        Queryset1.__iter__ = Mock(
-                return_value=iter([mock_doc1a, mock_doc1b]))
-        Queryset2 = Mock(name="queryset2")
-        Queryset2.__len__ = Mock(return_value=1)
-        Queryset2.__getitem__ = Mock()
-        Queryset2.__iter__ = Mock(
-                return_value=iter([mock_doc1b]))
+        # are deleted too by their primary keys, with one query
+        Model1._default_manager.filter.assert_called_once_with(
+                pk__in=[10, 20])
+        eq_(True, Model1._default_manager.filter.return_value.delete.called)
 
-
-        m2m_relation.all.return_value = Queryset1
-        Queryset1.exclude.return_value = Queryset2
+        Model1.reset_mock()
+        m2m_relation.reset_mock()
+        m2m_relation.all.return_value = [mock_doc1a, mock_doc1b]
 
         doc = Doc2({'id': 1, 'col1':[{'id':1}]})
         doc.save()
 
-        m2m_relation.get.assert_called_once_with(id=1)
-        eq_(True, mock_doc1b.delete.called)
+        # Only the item that is not part of the collection anymore is deleted
+        Model1._default_manager.filter.assert_called_once_with(pk__in=[20])
+        eq_(False, Model1._default_manager.bulk_create.called)
 
     def it_can_supply_context_to_foreign_documents_within_nested_collections(self):
         # FIXME: Add a test for this use case
         pass
+
+
+class when_a_django_backend_saves_compact_documents(unittest.TestCase):
+    def it_maps_the_fields_of_compact_collection_items(self):
+        class Tag(Document):
+            slug = fields.StringField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = Mock(name='TagModel')
+                identifier = 'slug'
+                compact = True
+
+            def map_name_field(self):
+                return 'label'
+
+        class TagCloud(Collection):
+            document = Tag
+
+        tag = Tag({'slug': 'a', 'name': 'name'})
+        tags = TagCloud([tag])
+        tags._context = {}
+
+        manager = tag._backend_manager
+        doc_state, defered = manager._collection_item_state(tag, tags)
+
+        eq_({'slug': 'a', 'label': 'name'}, doc_state)
+        eq_([], defered)
+
+
+class QueryCounter(object):
+    """Count the queries a fake model instance tree would cost in django.
+    Relations are loaded with the fetch if they are in a select_related or
+    prefetch_related lookup, otherwise each access is a query."""
+    def __init__(self):
+        self.queries = 0
+        self.loaded = set()
+
+    def access(self, path):
+        if path not in self.loaded:
+            self.queries += 1
+
+
+class FakeRelation(object):
+    def __init__(self, counter, path, items):
+        self.counter = counter
+        self.path = path
+        self.items = items
+
+    def all(self):
+        self.counter.access(self.path)
+        return self.items
+
+
+class FakeInstance(object):
+    def __init__(self, counter, path='', related=None, **attrs):
+        self.__dict__.update(attrs)
+        self._counter = counter
+        self._path = path
+        self._related = related or {}
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._related:
+            raise AttributeError(name)
+        path = self._path + name
+        value = self._related[name]
+        if isinstance(value, list):
+            # a m2m relation, only querying it costs a query
+            for item in value:
+                item._path = path + '__'
+            return FakeRelation(self._counter, path, value)
+        self._counter.access(path)
+        value._path = path + '__'
+        return value
+
+
+class FakeQuerySet(object):
+    def __init__(self, counter, instance):
+        self.counter = counter
+        self.instance = instance
+
+    def select_related(self, *lookups):
+        self.counter.loaded.update(lookups)
+        return self
+
+    def prefetch_related(self, *lookups):
+        # django makes one query for each prefetched relation
+        self.counter.queries += len(lookups)
+        self.counter.loaded.update(lookups)
+        return self
+
+    def get(self, **kwargs):
+        self.counter.queries += 1
+        return self.instance
+
+
+class when_a_django_backend_plans_its_queries(unittest.TestCase):
+    def setUp(self):
+        self.ArticleModel = Mock(name='ArticleModel')
+        self.ArticleModel.DoesNotExist = Exception
+
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = Mock(name='EditorModel')
+
+        class Tag(Document):
+            slug = fields.StringField()
+            editor = fields.ForeignDocument(Editor)
+
+            class Meta:
+                backend_type = 'django'
+                model = Mock(name='TagModel')
+                identifier = 'slug'
+
+        class TagCloud(Collection):
+            document = Tag
+
+        class Article(Document):
+            id = fields.NumberField()
+            tags = fields.CollectionField(TagCloud)
+            author = fields.ForeignDocument(Editor)
+
+            class Meta:
+                backend_type = 'django'
+                model = self.ArticleModel
+
+            def map_author_field(self):
+                return 'editor'
+
+        self.Article = Article
+
+    def make_article(self, counter, number_of_tags):
+        tags = []
+        for i in range(number_of_tags):
+            editor = FakeInstance(counter, id=i, name='editor %s' % i)
+            tags.append(FakeInstance(counter, slug='tag%s' % i,
+                related={'editor': editor}))
+        editor = FakeInstance(counter, id=1, name='editor')
+
+        return FakeInstance(counter, id=1,
+                related={'tags': tags, 'editor': editor})
+
+    def it_plans_the_relations_of_a_document_class(self):
+        select, prefetch = query_plan(self.Article())
+
+        eq_(['editor'], select)
+        eq_(['tags', 'tags__editor'], prefetch)
+        # The plan is computed only once
+        ok_(query_plan(self.Article({'id': 2})) is query_plan(self.Article()))
+
+    def it_plans_only_the_relations_of_the_model(self):
+        class FieldDoesNotExist(Exception):
+            pass
+
+        def get_field(name):
+            if name == 'popular_tags':
+                # A property of the model
+                raise FieldDoesNotExist(name)
+            return Mock(is_relation=name != 'reviewer')
+
+        class Article(self.Article):
+            popular_tags = fields.CollectionField(
+                    self.Article._meta.field_map['tags'].Collection)
+            reviewer = fields.ForeignDocument(
+                    self.Article._meta.field_map['author'].Document)
+
+            class Meta:
+                backend_type = 'django'
+                model = Mock(name='ArticleModel')
+
+        Article._meta.model._meta.get_field.side_effect = get_field
+        select, prefetch = query_plan(Article())
+
+        eq_(['editor'], select)
+        eq_(['tags', 'tags__editor'], prefetch)
+
+    def it_fetches_a_reverse_foreign_key_in_a_constant_number_of_queries(self):
+        class FieldDoesNotExist(Exception):
+            pass
+
+        def get_field(name):
+            if name == 'comment_set':
+                # django knows the reverse relation by its query name only
+                raise FieldDoesNotExist(name)
+            return Mock(is_relation=True)
+
+        comments = Mock(name='comments')
+        comments.get_accessor_name.return_value = 'comment_set'
+        PostModel = Mock(name='PostModel')
+        PostModel._meta.get_field.side_effect = get_field
+        PostModel._meta.get_fields.return_value = [comments]
+
+        class Author(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = Mock(name='AuthorModel')
+
+        class Comment(Document):
+            id = fields.NumberField()
+            text = fields.StringField()
+            author = fields.ForeignDocument(Author)
+
+            class Meta:
+                backend_type = 'django'
+                model = Mock(name='CommentModel')
+
+        class Comments(Collection):
+            document = Comment
+
+        class Post(Document):
+            id = fields.NumberField()
+            comments = fields.CollectionField(Comments)
+
+            class Meta:
+                backend_type = 'django'
+                model = PostModel
+
+            def map_comments_field(self):
+                return 'comment_set'
+
+        queries = []
+        for number_of_comments in (1, 5, 20):
+            counter = QueryCounter()
+            post = FakeInstance(counter, id=1, related={'comment_set': [
+                FakeInstance(counter, id=i, text='comment %s' % i,
+                    related={'author': FakeInstance(counter, id=i,
+                        name='author %s' % i)})
+                for i in range(number_of_comments)]})
+            PostModel.objects = FakeQuerySet(counter, post)
+
+            doc = Post({'id': 1})
+            doc.fetch()
+
+            eq_(number_of_comments, len(doc.comments.collection_set))
+            queries.append(counter.queries)
+
+        # The post, its comments and their authors
+        eq_([3, 3, 3], queries)
+
+    def it_fetches_nested_relations_in_a_constant_number_of_queries(self):
+        queries = []
+        for number_of_tags in (1, 5, 20):
+            counter = QueryCounter()
+            article = self.make_article(counter, number_of_tags)
+            self.ArticleModel.objects = FakeQuerySet(counter, article)
+
+            doc = self.Article({'id': 1})
+            doc.fetch()
+
+            eq_(number_of_tags, len(doc.tags.collection_set))
+            eq_('editor', doc.author.name)
+            queries.append(counter.queries)
+
+        # The article with its editor, the tags and the editors of the tags
+        eq_([3, 3, 3], queries)
+
+    def it_builds_a_shared_related_document_once_per_identity_map(self):
+        counter = QueryCounter()
+        editor = FakeInstance(counter, id=7, name='shared editor')
+        tags = [FakeInstance(counter, slug='tag%s' % i,
+            related={'editor': editor}) for i in range(20)]
+        article = FakeInstance(counter, id=1, related={'tags': tags,
+            'editor': FakeInstance(counter, id=1, name='editor')})
+        self.ArticleModel.objects = FakeQuerySet(counter, article)
+
+        with identity_map() as scope:
+            doc = self.Article({'id': 1})
+            doc.fetch()
+
+        eq_(['shared editor'] * 20,
+                [tag.editor.name for tag in doc.tags.collection_set])
+        # Only the first tag builds the editor, the tags share it
+        eq_(19, scope.hits)
+        editors = [tag.editor for tag in doc.tags.collection_set]
+        ok_(all(editor is editors[0] for editor in editors))
+
+
+class when_a_django_backend_fetches_documents_in_bulk(unittest.TestCase):
+    def setUp(self):
+        self.Model = Mock(name='Model')
+        self.Model.DoesNotExist = Exception
+
+        class Article(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = self.Model
+
+        class Page(Document):
+            slug = fields.StringField()
+            title = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = self.Model
+                identifier = 'slug'
+
+            def map_slug_field(self):
+                return 'name'
+
+        self.Article = Article
+        self.Page = Page
+
+    def it_finds_the_instances_of_identifiers_given_as_strings(self):
+        row = Mock(id=1, title='first')
+        self.Model.objects.filter.return_value = [row]
+        documents = [self.Article({'id': '1'}), self.Article({'id': '2'})]
+
+        states = documents[0]._backend_manager.fetch_all(documents)
+
+        self.Model.objects.filter.assert_called_once_with(id__in=['1', '2'])
+        eq_('first', states[0]['title'])
+        eq_(None, states[1])
+
+    def it_finds_the_instances_of_each_context(self):
+        class Article(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = self.Model
+                context = ['site']
+
+        def filter(**kwargs):
+            return [Mock(id=1, title='on site %s' % kwargs['site'])]
+
+        self.Model.objects.filter.side_effect = filter
+        documents = [Article({'id': 1}, context={'site': site})
+                for site in (1, 2, 1)]
+
+        states = documents[0]._backend_manager.fetch_all(documents)
+
+        eq_(['on site 1', 'on site 2', 'on site 1'],
+                [state['title'] for state in states])
+        eq_(2, self.Model.objects.filter.call_count)
+        self.Model.objects.filter.assert_any_call(id__in=[1, 1], site=1)
+
+    def it_finds_the_instances_by_the_mapped_identifier(self):
+        row = Mock(title='first')
+        row.name = 'first-page'
+        self.Model.objects.filter.return_value = [row]
+        documents = [self.Page({'slug': 'first-page'}),
+                self.Page({'slug': 'second-page'})]
+
+        states = documents[0]._backend_manager.fetch_all(documents)
+
+        self.Model.objects.filter.assert_called_once_with(
+                name__in=['first-page', 'second-page'])
+        eq_('first', states[0]['title'])
+        eq_(None, states[1])
+
+
+class FakeRows(object):
+    """The rows of a table selected by a ``FakeManager``."""
+    def __init__(self, manager, rows):
+        self.manager = manager
+        self.rows = rows
+
+    def __iter__(self):
+        self.manager.counter.queries += 1
+        return iter(self.rows)
+
+    def update(self, **values):
+        self.manager.counter.queries += 1
+        self.manager.updates.append(values)
+
+    def delete(self):
+        self.manager.counter.queries += 1
+        for row in self.rows:
+            self.manager.rows.remove(row)
+
+
+class FakeManager(object):
+    """A model manager of a table. Like django on PostgreSQL,
+    ``bulk_create`` sets the primary keys of the instances if the database
+    ``can_return_rows``. It has no ``bulk_update``, like django before
+    2.2."""
+    def __init__(self, counter, can_return_rows=True):
+        self.counter = counter
+        self.can_return_rows = can_return_rows
+        self.rows = []
+        self.updates = []
+
+    def bulk_create(self, instances, batch_size=None):
+        self.counter.queries += 1
+        for inst in instances:
+            row = inst
+            if not self.can_return_rows:
+                row = copy.copy(inst)
+            row.pk = len(self.rows) + 1000
+            self.rows.append(row)
+
+    def filter(self, **kwargs):
+        (lookup, values), = kwargs.items()
+        name = lookup[:-len('__in')]
+        return FakeRows(self, [row for row in self.rows
+            if getattr(row, name) in values])
+
+
+class FakeField(object):
+    def __init__(self, name):
+        self.attname = name
+
+
+class FakeM2MRelation(object):
+    def __init__(self, counter, model, items):
+        self.counter = counter
+        self.items = items
+        self.__dict__['model'] = model
+
+    def all(self):
+        self.counter.queries += 1
+        return self.items
+
+    def add(self, *instances):
+        for inst in instances:
+            if inst.pk is None:
+                raise ValueError("The instance needs a primary key.")
+        # django selects the existing rows of the through table and inserts
+        # the missing ones
+        self.counter.queries += 2
+        self.items.extend(instances)
+
+    def create(self, **kwargs):
+        # django inserts the row and adds it to the relation
+        self.counter.queries += 2
+        manager = self.model._default_manager
+        inst = self.model(**kwargs)
+        inst.pk = len(manager.rows) + 1000
+        manager.rows.append(inst)
+        self.items.append(inst)
+        return inst
+
+
+class FakeReverseRelation(FakeM2MRelation):
+    """The reverse side of the foreign key ``article`` of ``model``."""
+    def __init__(self, counter, model, items, instance):
+        super(FakeReverseRelation, self).__init__(counter, model, items)
+        self.instance = instance
+        self.field = Mock()
+        self.field.name = 'article'
+
+    def add(self, *instances):
+        raise AssertionError("The items have the foreign key already.")
+
+
+class when_a_django_backend_saves_a_collection(unittest.TestCase):
+    def setUp(self):
+        self.counter = counter = QueryCounter()
+
+        class TagModel(object):
+            _default_manager = FakeManager(counter)
+            _meta = Mock()
+            _meta.get_field.side_effect = FakeField
+            pk = None
+
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+        self.TagModel = TagModel
+        patcher = fake_django()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ArticleModel = Mock(name='ArticleModel')
+        self.ArticleModel.DoesNotExist = Exception
+
+        class Tag(Document):
+            slug = fields.StringField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = TagModel
+                identifier = 'slug'
+
+        class TagCloud(Collection):
+            document = Tag
+
+        class Article(Document):
+            id = fields.NumberField()
+            tags = fields.CollectionField(TagCloud)
+
+            class Meta:
+                backend_type = 'django'
+                model = self.ArticleModel
+
+        self.TagCloud = TagCloud
+        self.Article = Article
+
+    def save_article(self, number_of_tags):
+        self.counter.queries = 0
+        # Half of the tags exist already, and one more that is removed
+        existing = [self.TagModel(slug='tag%s' % i, name='old', pk=i)
+                for i in range(-1, number_of_tags / 2)]
+        manager = self.TagModel._default_manager
+        manager.rows = list(existing)
+        manager.updates = []
+        article = Mock(name='article')
+        article.tags = FakeM2MRelation(self.counter, self.TagModel, existing)
+
+        def get(**kwargs):
+            self.counter.queries += 1
+            return article
+
+        def save(*args, **kwargs):
+            self.counter.queries += 1
+
+        self.ArticleModel.objects.get.side_effect = get
+        article.save.side_effect = save
+
+        doc = self.Article({'id': 1, 'tags': [
+            {'slug': 'tag%s' % i, 'name': 'tag %s' % i}
+            for i in range(number_of_tags)]})
+        doc.save()
+
+        eq_(['tag %s' % i for i in range(number_of_tags / 2)],
+                [tag.name for tag in existing[1:number_of_tags / 2 + 1]])
+        # The created tags are added to the relation with their primary keys
+        eq_(['tag%s' % i for i in range(number_of_tags)],
+                [tag.slug for tag in article.tags.items[1:]])
+        eq_(number_of_tags, len(manager.rows))
+
+        return self.counter.queries
+
+    def it_saves_a_collection_in_a_constant_number_of_queries(self):
+        # get and save the article, load the tags, update, create the tags,
+        # add them to the relation and delete the tags
+        eq_([8, 8, 8], [self.save_article(n) for n in (2, 50, 500)])
+
+    def save_tags(self, existing, tags):
+        article = Mock(name='article')
+        article.tags = FakeM2MRelation(self.counter, self.TagModel, existing)
+        self.ArticleModel.objects.get.return_value = article
+        self.Article({'id': 1, 'tags': tags}).save()
+
+        return article.tags.items
+
+    def it_creates_each_item_if_the_database_returns_no_primary_keys(self):
+        # A tag of another article has the identifier of the new tag
+        other = self.TagModel(slug='new', name='other', pk=1)
+        self.TagModel._default_manager.rows = [other]
+
+        with fake_django(can_return_rows=False):
+            items = self.save_tags([], [{'slug': 'new', 'name': 'new'}])
+
+        # The new tag is created through the relation
+        eq_(['new'], [tag.name for tag in items])
+        eq_([other] + items, self.TagModel._default_manager.rows)
+
+    def it_sets_the_foreign_key_of_the_items_of_a_reverse_relation(self):
+        article = Mock(name='article')
+        article.tags = FakeReverseRelation(self.counter, self.TagModel, [],
+                article)
+        self.ArticleModel.objects.get.return_value = article
+
+        self.Article({'id': 1, 'tags': [{'slug': 'tag%s' % i, 'name': 'tag'}
+            for i in range(2)]}).save()
+
+        created = self.TagModel._default_manager.rows
+        eq_(['tag0', 'tag1'], [tag.slug for tag in created])
+        eq_([article] * 2, [tag.article for tag in created])
+
+    def it_deletes_only_the_leftover_items_of_the_relation(self):
+        own = self.TagModel(slug='old', name='old', pk=1)
+        # A tag of another article has the same identifier
+        other = self.TagModel(slug='old', name='old', pk=2)
+        self.TagModel._default_manager.rows = [own, other]
+
+        self.save_tags([own], [])
+
+        eq_([other], self.TagModel._default_manager.rows)
+
+    def it_matches_the_items_by_their_converted_identifiers(self):
+        own = self.TagModel(slug=1, name='old', pk=1)
+        self.TagModel._default_manager.rows = [own]
+
+        items = self.save_tags([own], [{'slug': '1', 'name': 'new'}])
+
+        # The existing tag is updated, not replaced
+        eq_([own], items)
+        eq_([own], self.TagModel._default_manager.rows)
+
+    def it_saves_new_documents_with_their_relations_in_bulk(self):
+        counter = self.counter
+        TagModel = self.TagModel
+
+        class ArticleModel(object):
+            _default_manager = objects = FakeManager(counter)
+            pk = None
+
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+            @property
+            def tags(self):
+                if self.pk is None:
+                    raise ValueError("The instance needs a primary key.")
+                if not '_tags' in self.__dict__:
+                    self._tags = FakeM2MRelation(counter, TagModel, [])
+                return self._tags
+
+        class Article(Document):
+            id = fields.NumberField()
+            tags = fields.CollectionField(self.TagCloud)
+
+            class Meta:
+                backend_type = 'django'
+                model = ArticleModel
+
+        class Articles(Collection):
+            document = Article
+
+        documents = [Article({'id': i, 'tags': [{'slug': 'tag%s' % i,
+            'name': 'tag %s' % i}]}) for i in (1, 2)]
+        Articles(documents).save_all()
+
+        # The created articles are selected again to save their relations
+        rows = ArticleModel.objects.rows
+        eq_([1, 2], [row.id for row in rows])
+        eq_([['tag1'], ['tag2']], [[tag.slug for tag in row.tags.items]
+            for row in rows])
+        ok_(documents[0]._backend_manager.instance is rows[0])
+
+    def it_updates_the_changed_items_with_one_query(self):
+        self.save_article(4)
+
+        values, = self.TagModel._default_manager.updates
+        eq_(['name'], values.keys())
+        eq_([{'pk': i, 'then': 'tag %s' % i} for i in range(2)],
+                [dict(when.kwargs, then=when.kwargs['then'].args[0])
+                    for when in values['name'].args])
+
+    def it_saves_the_model_and_its_relations_in_a_transaction(self):
+        import django.db
+        mock_transaction = django.db.transaction
+        self.save_article(10)
+
+        eq_(1, mock_transaction.atomic.call_count)
+        ok_(mock_transaction.atomic.return_value.__exit__.called)
+
+
+class FakeObjects(object):
+    """A model manager that counts how often it gets a model instance."""
+    def __init__(self, instances):
+        self.instances = instances
+        self.gets = 0
+
+    def select_related(self, *lookups):
+        return self
+
+    def prefetch_related(self, *lookups):
+        return self
+
+    def get(self, **kwargs):
+        self.gets += 1
+        return self.instances[kwargs['id']]
+
+
+class FakeModel(object):
+    DoesNotExist = KeyError
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.pk = kwargs.get('id', kwargs.get('slug'))
+
+    def save(self, *args, **kwargs):
+        self.update_fields = kwargs.get('update_fields')
+
+
+class when_a_django_backend_saves_a_nested_document(unittest.TestCase):
+    def setUp(self):
+        counter = QueryCounter()
+
+        class EditorModel(FakeModel):
+            pass
+
+        class TagModel(FakeModel):
+            _default_manager = FakeManager(counter)
+
+        class ArticleModel(FakeModel):
+            pass
+
+        editor = EditorModel(id=1, name='editor')
+        tags = [TagModel(slug='tag%s' % i, editor=editor) for i in range(3)]
+        article = ArticleModel(id=1, title='title', editor=editor)
+        article.tags = FakeM2MRelation(counter, TagModel, tags)
+        EditorModel.objects = FakeObjects({1: editor})
+        ArticleModel.objects = FakeObjects({1: article})
+
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'django'
+                model = EditorModel
+
+        class Tag(Document):
+            slug = fields.StringField()
+            editor = fields.ForeignDocument(Editor)
+
+            class Meta:
+                backend_type = 'django'
+                model = TagModel
+                identifier = 'slug'
+
+        class TagCloud(Collection):
+            document = Tag
+
+        class Article(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+            author = fields.ForeignDocument(Editor)
+            tags = fields.CollectionField(TagCloud)
+
+            class Meta:
+                backend_type = 'django'
+                model = ArticleModel
+
+            def map_author_field(self):
+                return 'editor'
+
+        self.Article = Article
+        self.EditorModel = EditorModel
+        self.ArticleModel = ArticleModel
+        self.article = article
+
+    def it_fetches_each_resource_once_when_saving(self):
+        doc = self.Article({'id': 1, 'title': 'new title',
+            'author': {'id': 1},
+            'tags': [{'slug': 'tag%s' % i, 'editor': {'id': 1}}
+                for i in range(3)]})
+        doc.save()
+
+        eq_('new title', self.article.title)
+        # The editor is fetched to validate the article and its tags, and
+        # reused to save them
+        eq_(1, self.EditorModel.objects.gets)
+        eq_(1, self.ArticleModel.objects.gets)
+
+    def it_reuses_the_fetched_model_instances_when_updating(self):
+        doc = self.Article({'id': 1})
+        doc.update({'title': 'new title'})
+
+        eq_('new title', self.article.title)
+        # The editor is loaded together with the article
+        eq_(0, self.EditorModel.objects.gets)
+        eq_(1, self.ArticleModel.objects.gets)
+
+    def it_saves_only_the_changed_columns_when_updating(self):
+        doc = self.Article({'id': 1})
+        doc.update({'title': 'new title'})
+
+        eq_(['title'], self.article.update_fields)
+        # The fetch loads the tags, they are not loaded again to synchronize
+        # the unchanged relation
+        eq_(1, self.article.tags.counter.queries)
+
+        # The changed foreign document is saved under its mapped name
+        doc.update({'author': {'id': 2, 'name': 'other'}})
+        eq_(['editor'], self.article.update_fields)
@@ -229,6 +229,95 @@ class when_a_document_gets_instantiated(unittest.TestCase):
         eq_(1, len(d._meta.collection_fields))
         eq_(4, len(d._meta.local_fields))
 
+    def it_builds_lookup_tables_for_its_fields(self):
+        Col = Mock(name="collection", spec=Collection)
+        Relation = Mock(name="relation", spec="Document")
+
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+            foreign = fields.ForeignDocument(Relation)
+            collection = fields.CollectionField(Col)
+
+        class ChildDoc(Doc):
+            other = fields.StringField()
+
+        meta = Doc._meta
+        eq_(['collection', 'foreign', 'id', 'name'],
+                sorted(meta.field_map.keys()))
+        eq_(meta.local_fields[2], meta.field_map['foreign'])
+        eq_({'foreign': meta.local_fields[2]}, meta.related_field_map)
+        eq_({'collection': meta.local_fields[3]}, meta.collection_field_map)
+        eq_([meta.local_fields[1]], meta.fields_by_type['string'])
+        eq_([meta.local_fields[2]], meta.fields_by_type['foreign'])
+
+        # inherited fields are part of the lookup tables of the child
+        eq_(['collection', 'foreign', 'id', 'name', 'other'],
+                sorted(ChildDoc._meta.field_map.keys()))
+        eq_(2, len(ChildDoc._meta.fields_by_type['string']))
+
+    def it_builds_a_hook_table_for_its_field_methods(self):
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            def map_name_field(self):
+                return "other_name"
+
+            def render_name_field(self, value):
+                return "render"
+
+        class ChildDoc(Doc):
+            def render_name_field(self, value):
+                return "child render"
+
+            def fetch_id_field(self, value):
+                return 1
+
+        eq_(['name'], Doc._meta.map_hooks.keys())
+        eq_(['name'], Doc._meta.render_hooks.keys())
+        eq_({}, Doc._meta.save_hooks)
+        eq_({}, Doc._meta.fetch_hooks)
+        eq_(['id'], ChildDoc._meta.fetch_hooks.keys())
+
+        # The hooks are called with the document as first argument
+        doc = ChildDoc({'id': 2, 'name': 'name'})
+        eq_("other_name", doc._meta.map_hooks['name'](doc))
+        eq_("child render", doc.render()['name'])
+        eq_({'id': 1, 'name': 'name'}, doc._fetch({'id': 2, 'name': 'name'}))
+
+    def it_uses_hooks_that_are_set_on_the_class_later(self):
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                compiled = True
+
+        class ChildDoc(Doc):
+            pass
+
+        doc = ChildDoc({'id': 1, 'name': 'name'})
+        eq_('name', doc.render()['name'])
+
+        Doc.render_name_field = lambda self, value: value.upper()
+        eq_('NAME', doc.render()['name'])
+        eq_('NAME', Doc({'id': 1, 'name': 'name'}).render()['name'])
+
+        del Doc.render_name_field
+        eq_('name', doc.render()['name'])
+        eq_({}, ChildDoc._meta.render_hooks)
+
+    def it_ignores_hooks_that_are_set_on_a_document(self):
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+        doc = Doc({'id': 1, 'name': 'name'})
+        doc.render_name_field = lambda value: value.upper()
+
+        eq_('name', doc.render()['name'])
+
     def it_has_an_attribute_for_each_field(self):
         eq_(True, hasattr(self.article, 'name'))
         eq_(None, self.article.name)
@@ -954,9 +1043,11 @@ class when_a_document_is_bound(unittest.TestCase):
         instance.update({'name': 'new name'})
 
         eq_('new name', instance.name)
+        # Only the changed field is saved
         eq_([
             ('fetch', (instance,)),
-            ('save', (instance,))], instance._backend_manager.method_calls)
+            ('save', (instance,), {'update_fields': ['name']})],
+            instance._backend_manager.method_calls)
 
 
 class when_a_document_contains_a_foreign_document_relation(unittest.TestCase):
@@ -1192,3 +1283,453 @@ class when_a_document_contains_a_collection_field(unittest.TestCase):
         doc = Doc(request)
 
         eq_(request, doc._to_dict())
+
+
+def make_compiled_documents(use_compiled, use_compact=False):
+    """Declare the same set of documents, either compiled or not, and either
+    compact or not."""
+    class Tag(Document):
+        slug = fields.StringField()
+        hidden = fields.StringField(render=False)
+
+        class Meta:
+            identifier = 'slug'
+            compiled = True
+
+        def uri(self):
+            return "http://localhost/tag/%s/" % self.slug
+
+    class TagCloud(Collection):
+        document = Tag
+
+    class Editor(Document):
+        first_name = fields.StringField()
+        last_name = fields.StringField()
+
+        class Meta:
+            identifier = ['first_name', 'last_name']
+
+        def uri(self):
+            return "http://localhost/editor/"
+
+    class Article(Document):
+        id = fields.NumberField()
+        name = fields.StringField()
+        summary = fields.StringField(optional=True)
+        secret = fields.StringField(render=False)
+        kind = fields.StaticField(value="article")
+        title = fields.StringField()
+        editor = fields.ForeignDocument(Editor)
+        inline_editor = fields.ForeignDocument(Editor, inline=True)
+        optional_editor = fields.ForeignDocument(Editor, optional=True)
+        hooked_editor = fields.ForeignDocument(Editor)
+        tags = fields.CollectionField(TagCloud)
+        optional_tags = fields.CollectionField(TagCloud, optional=True)
+        hooked_tags = fields.CollectionField(TagCloud)
+
+        class Meta:
+            compiled = use_compiled
+            compact = use_compact
+
+        def uri(self):
+            return "http://localhost/article/%s/" % self.id
+
+        def render_title_field(self, value):
+            return value.upper()
+
+        def render_hooked_editor_field(self, value):
+            return value['last_name']
+
+        def render_hooked_tags_field(self, value):
+            return len(value)
+
+    return Article, Editor
+
+
+class when_a_document_is_compiled(unittest.TestCase):
+    def setUp(self):
+        data = {
+                'id': 1,
+                'name': 'name',
+                'secret': 'secret',
+                'title': 'title',
+                'editor': {'first_name': 'Christo', 'last_name': 'Buschek'},
+                'inline_editor': {'first_name': 'Inline', 'last_name': 'Ed'},
+                'hooked_editor': {'first_name': 'Hook', 'last_name': 'Ed'},
+                'tags': [{'slug': 'a', 'hidden': 'x'}, {'slug': 'b'}],
+                'hooked_tags': [{'slug': 'c'}],
+                }
+
+        self.articles = []
+        for use_compiled in (False, True):
+            Article, self.Editor = make_compiled_documents(use_compiled)
+            self.articles.append(Article(data))
+
+    def it_only_compiles_documents_with_the_compiled_option(self):
+        plain, compiled = self.articles
+
+        eq_(None, plain._meta.renderer)
+        ok_(callable(compiled._meta.renderer))
+
+    def it_renders_the_same_as_the_generic_render_path(self):
+        plain, compiled = self.articles
+
+        eq_(plain.to_python(), compiled.to_python())
+        eq_(json.loads(plain.to_json()), json.loads(compiled.to_json()))
+        eq_('TITLE', compiled.render()['title'])
+        eq_('article', compiled.render()['kind'])
+        eq_('Ed', compiled.render()['hooked_editor'])
+        eq_(1, compiled.render()['hooked_tags'])
+        ok_('secret' not in compiled.render())
+        ok_('summary' not in compiled.render())
+        ok_('optional_editor' not in compiled.render())
+        ok_('optional_tags' not in compiled.render())
+
+    def it_renders_optional_fields_once_they_are_set(self):
+        for article in self.articles:
+            article.summary = "summary"
+            article.optional_editor = self.Editor({'first_name': 'Opt',
+                'last_name': 'Ed'})
+            article.optional_tags.bound = True
+
+        plain, compiled = self.articles
+        eq_(plain.render(), compiled.render())
+        eq_('summary', compiled.render()['summary'])
+        eq_('Opt', compiled.render()['optional_editor']['first_name'])
+        eq_({'size': 0, 'items': []}, compiled.render()['optional_tags'])
+
+        # reset the shared default collection
+        for article in self.articles:
+            article.optional_tags.bound = False
+
+
+class when_a_document_is_compact(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+                'id': 1,
+                'name': 'name',
+                'title': 'title',
+                'editor': {'first_name': 'Christo', 'last_name': 'Buschek'},
+                'inline_editor': {'first_name': 'Inline', 'last_name': 'Ed'},
+                'hooked_editor': {'first_name': 'Hook', 'last_name': 'Ed'},
+                'tags': [{'slug': 'a'}, {'slug': 'b'}],
+                'hooked_tags': [{'slug': 'c'}],
+                }
+        self.Article, self.Editor = make_compiled_documents(False)
+        self.CompactArticle, _ = make_compiled_documents(False, True)
+
+    def it_stores_its_fields_in_slots(self):
+        article = self.CompactArticle(self.data)
+
+        ok_(not hasattr(article, '__dict__'))
+        ok_(hasattr(self.Article(self.data), '__dict__'))
+        eq_('title', article.title)
+        article.title = 'new'
+        eq_('new', article.title)
+
+        # Only fields can be set
+        assert_raises(AttributeError, setattr, article, 'unknown', 1)
+
+    def it_falls_back_to_the_defaults_of_its_class(self):
+        article = self.CompactArticle()
+
+        eq_(None, article.name)
+        eq_(False, article.bound)
+        eq_({}, article._context)
+        eq_(False, article.editor.bound)
+        ok_(article.tags is self.CompactArticle.tags)
+
+    def it_renders_the_same_as_a_regular_document(self):
+        data = dict(self.data, link={'rel': 'self', 'href': 'ignored'})
+        CompiledCompactArticle, _ = make_compiled_documents(True, True)
+
+        eq_(self.Article(data).render(), self.CompactArticle(data).render())
+        eq_(self.Article(data).render(),
+                CompiledCompactArticle(data).render())
+        eq_(self.Article(data)._to_dict(),
+                self.CompactArticle(data)._to_dict())
+
+    def it_can_be_inherited(self):
+        class Child(self.CompactArticle):
+            extra = fields.StringField()
+
+            class Meta:
+                compact = True
+
+        child = Child(dict(self.data, extra='extra'))
+
+        ok_(not hasattr(child, '__dict__'))
+        eq_(('_slot_extra',), Child.__slots__)
+        eq_('extra', child.extra)
+        eq_('title', child.title)
+
+    def it_builds_compact_documents_from_models(self):
+        class Articles(Collection):
+            document = self.CompactArticle
+
+        model = Mock(spec_set=['id', 'name', 'title'])
+        model.id = 1
+        model.name = 'name'
+        model.title = 'title'
+
+        articles = Articles()
+        articles._from_queryset([model])
+
+        eq_('title', articles.collection_set[0].title)
+        ok_(not hasattr(articles.collection_set[0], '__dict__'))
+
+
+class RelationModel(object):
+    """A model that records which of its relations are accessed, like django
+    makes a query for each of them."""
+    def __init__(self, id, editor, tags):
+        self.id = id
+        self.accessed = []
+        self._editor = editor
+        self._tags = tags
+
+    @property
+    def editor(self):
+        self.accessed.append('editor')
+        return self._editor
+
+    @property
+    def tags(self):
+        self.accessed.append('tags')
+        m2m = Mock(name='m2m')
+        m2m.all.return_value = self._tags
+        return m2m
+
+
+class when_a_document_is_lazy(unittest.TestCase):
+    def setUp(self):
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                identifier = 'id'
+
+        class Tag(Document):
+            slug = fields.StringField()
+
+            class Meta:
+                identifier = 'slug'
+
+        class Tags(Collection):
+            document = Tag
+
+        class Article(Document):
+            id = fields.NumberField()
+            editor = fields.ForeignDocument(Editor, render=False)
+            tags = fields.CollectionField(Tags, render=False)
+
+            class Meta:
+                lazy = True
+
+        self.Editor = Editor
+        self.Tags = Tags
+        self.Article = Article
+
+        editor = Mock(spec_set=['id', 'name'])
+        editor.id = 2
+        editor.name = 'Editor'
+        tag = Mock(spec_set=['slug'])
+        tag.slug = 'tag'
+        self.model = RelationModel(1, editor, [tag])
+
+    def it_builds_its_relations_on_first_access(self):
+        article = self.Article()
+        article._from_model(self.model)
+
+        eq_([], self.model.accessed)
+        eq_('Editor', article.editor.name)
+        ok_(article.editor is article.editor)
+        eq_(['editor'], self.model.accessed)
+        eq_(['tag'], [tag.slug for tag in article.tags.collection_set])
+        eq_(['editor', 'tags'], self.model.accessed)
+
+    def it_does_not_build_relations_that_are_not_rendered(self):
+        article = self.Article()
+        article._from_model(self.model)
+
+        eq_({'id': 1}, article.render())
+        eq_([], self.model.accessed)
+
+        # Saving needs all relations
+        eq_({'id': 1, 'editor': {'id': 2, 'name': 'Editor'},
+            'tags': [{'slug': 'tag'}]}, article._to_dict())
+
+    def it_uses_the_default_if_the_model_has_no_relation(self):
+        article = self.Article()
+        article._from_model(Mock(spec_set=['id']))
+
+        ok_(article.editor is self.Article.editor)
+        eq_(False, article.tags.bound)
+
+    def it_can_be_compact(self):
+        class Article(Document):
+            id = fields.NumberField()
+            editor = fields.ForeignDocument(self.Editor, render=False)
+            tags = fields.CollectionField(self.Tags, render=False)
+
+            class Meta:
+                lazy = True
+                compact = True
+
+        article = Article()
+        article._from_model(self.model)
+
+        ok_(not hasattr(article, '__dict__'))
+        eq_([], self.model.accessed)
+        eq_('Editor', article.editor.name)
+        eq_(['editor'], self.model.accessed)
+
+
+class when_a_document_tracks_its_changes(unittest.TestCase):
+    def setUp(self):
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+        class Tag(Document):
+            slug = fields.StringField()
+
+            class Meta:
+                identifier = 'slug'
+
+        class Tags(Collection):
+            document = Tag
+
+        class Article(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+            editor = fields.ForeignDocument(Editor)
+            tags = fields.CollectionField(Tags)
+
+            class Meta:
+                backend_type = 'http'
+
+        class CompactArticle(Document):
+            id = fields.NumberField()
+            title = fields.StringField()
+            editor = fields.ForeignDocument(Editor)
+            tags = fields.CollectionField(Tags)
+
+            class Meta:
+                backend_type = 'http'
+                compact = True
+
+        self.Tag = Tag
+        self.Article = Article
+        self.CompactArticle = CompactArticle
+        self.fetched = {'id': 1, 'title': 'title',
+                'editor': {'id': 2, 'name': 'Editor'},
+                'tags': [{'slug': 'a'}, {'slug': 'b'}]}
+
+    def fetch_article(self, Article=None):
+        article = (Article or self.Article)({'id': 1})
+        article._backend_manager = Mock()
+        article._backend_manager.fetch.return_value = self.fetched
+        article.fetch()
+
+        return article
+
+    def it_knows_no_changes_of_new_documents(self):
+        eq_(None, self.Article({'id': 1, 'title': 'title'}).changed_fields())
+
+    def it_finds_the_fields_changed_since_the_fetch(self):
+        for Article in (self.Article, self.CompactArticle):
+            article = self.fetch_article(Article)
+            eq_([], article.changed_fields())
+
+            article.title = 'new title'
+            eq_(['title'], article.changed_fields())
+
+    def it_finds_changes_of_foreign_documents_and_collections(self):
+        article = self.fetch_article()
+        article.editor.name = 'Other'
+        eq_(['editor'], article.changed_fields())
+
+        article = self.fetch_article()
+        article.tags.add(self.Tag({'slug': 'c'}))
+        eq_(['tags'], article.changed_fields())
+
+        article = self.fetch_article()
+        article.tags.collection_set[0].slug = 'c'
+        eq_(['tags'], article.changed_fields())
+
+    def it_saves_only_the_changed_fields(self):
+        article = self.fetch_article()
+        article.title = 'new title'
+        article.save()
+
+        eq_({'update_fields': ['title']},
+                article._backend_manager.save.call_args[1])
+        # The saved document has no changes anymore
+        eq_([], article.changed_fields())
+
+    def it_does_not_save_unchanged_documents(self):
+        article = self.fetch_article()
+        article.save()
+        article.update({'title': 'title'})
+
+        eq_(False, article._backend_manager.save.called)
+
+        # Unless the fields to save are chosen explicitly
+        article.save(update_fields=['title'])
+        eq_(True, article._backend_manager.save.called)
+
+
+class when_a_document_compiles_its_validator(unittest.TestCase):
+    def setUp(self):
+        def positive(value):
+            if value < 0:
+                raise ValidationError('Must be positive.')
+
+        class Doc(Document):
+            id = fields.NumberField(validators=[positive])
+            name = fields.StringField()
+            nickname = fields.StringField(optional=True)
+            count = fields.NumberField(default=0)
+            state = fields.ChoicesField(choices=['draft', 'published'])
+            flag = fields.BooleanField(validate=False)
+            kind = fields.StaticField(value='doc')
+
+        self.Doc = Doc
+
+    def it_plans_only_the_fields_that_are_validated(self):
+        from docar.compiler import validation_plan
+
+        eq_(['id', 'name', 'nickname', 'count', 'state'],
+                [step[1] for step in validation_plan(self.Doc)])
+
+    def it_reports_the_same_errors_as_the_field_validation(self):
+        doc = self.Doc({'id': 1, 'name': 'name', 'state': 'draft',
+            'nickname': '', 'flag': 'not a boolean'})
+        ok_(doc.validate())
+
+        doc = self.Doc({'id': -1, 'name': '', 'state': 'unknown',
+            'count': None})
+        try:
+            doc.validate()
+        except ValidationError, e:
+            errors = e.message
+        eq_({'id': 'Must be positive.',
+            'name': 'Field must be set.',
+            'state': 'unknown is not a valid choice.'}, errors)
+        eq_(errors, self.Doc._meta.validator(doc))
+
+    def it_uses_fields_that_validate_in_their_own_way(self):
+        class UpperField(fields.StringField):
+            def clean(self, value):
+                if value != value.upper():
+                    raise ValidationError('Must be upper case.')
+                return value
+
+        class Doc(Document):
+            code = UpperField(validate=False)
+
+        eq_({}, Doc._meta.validator(Doc({'code': 'ABC'})))
+        eq_({'code': 'Must be upper case.'},
+                Doc._meta.validator(Doc({'code': 'abc'})))
@@ -149,3 +149,73 @@ class when_a_choices_field_gets_instantiated(unittest.TestCase):
     def it_raises_a_validation_error_if_its_not_a_valid_choice(self):
         assert_raises(exceptions.ValidationError, self.choices_field.to_python,
                 'C')
+
+    def it_looks_up_the_choices_in_a_set(self):
+        eq_(frozenset(['A', 'B']), self.choices_field.choice_set)
+
+        self.choices_field.choices = ['C']
+        eq_('C', self.choices_field.to_python('C'))
+        assert_raises(exceptions.ValidationError, self.choices_field.to_python,
+                'A')
+
+    def it_can_have_labels_for_the_choices(self):
+        field = fields.ChoicesField(choices=[('draft', 'Draft'),
+            ('live', 'Published')])
+
+        eq_(['draft', 'live'], field.choices)
+        eq_('live', field.to_python('live'))
+        eq_('Published', field.get_label('live'))
+        eq_('unknown', field.get_label('unknown'))
+        eq_('A', self.choices_field.get_label('A'))
+        assert_raises(exceptions.ValidationError, field.to_python,
+                ('live', 'Published'))
+
+    def it_validates_unhashable_values(self):
+        assert_raises(exceptions.ValidationError, self.choices_field.to_python,
+                ['A'])
+        eq_(['A'], self.choices_field.get_label(['A']))
+
+        field = fields.ChoicesField(choices=[['A'], {'b': 1}])
+        eq_(None, field.choice_set)
+        eq_(['A'], field.to_python(['A']))
+        eq_({'b': 1}, field.to_python({'b': 1}))
+        assert_raises(exceptions.ValidationError, field.to_python, 'A')
+
+        field = fields.ChoicesField(choices=[(['A'], 'List'), ('B', 'B')])
+        eq_('List', field.get_label(['A']))
+        eq_('B', field.get_label('B'))
+
+
+class when_a_choices_field_has_many_choices(unittest.TestCase):
+    """A benchmark of the choice lookups. Instead of timing them, it counts
+    the comparisons, which doesn't depend on the speed of the machine."""
+    def setUp(self):
+        class Choice(object):
+            comparisons = 0
+
+            def __init__(self, value):
+                self.value = value
+
+            def __hash__(self):
+                return hash(self.value)
+
+            def __eq__(self, other):
+                Choice.comparisons += 1
+                return self.value == getattr(other, 'value', other)
+
+        self.Choice = Choice
+        self.choices = [Choice(i) for i in range(500)]
+        self.field = fields.ChoicesField(choices=self.choices)
+
+    def it_compares_each_value_with_a_single_choice(self):
+        for choice in self.choices:
+            self.field.to_python(self.Choice(choice.value))
+        lookups = self.Choice.comparisons
+
+        self.Choice.comparisons = 0
+        for choice in self.choices:
+            self.Choice(choice.value) in self.choices
+        scans = self.Choice.comparisons
+
+        eq_(500, lookups)
+        eq_(125250, scans)
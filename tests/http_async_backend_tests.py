@@ -0,0 +1,368 @@
+import unittest
+import json
+
+from functools import partial
+from nose.tools import eq_, ok_, assert_raises
+from nose.plugins.skip import SkipTest
+
+from docar import Document, Collection, fields
+from docar.backends import BackendManager
+from docar.cache import LRUCache
+from docar.identity import identity_map
+from docar.exceptions import (BackendDoesNotExist, HttpBackendError,
+        ValidationError)
+
+try:
+    import asyncio
+    import aiohttp
+    from docar.backends.http_async import (HttpAsyncBackendManager,
+            gather_concurrently)
+except (ImportError, SyntaxError):
+    # The asynchronous backend requires python 3 and aiohttp
+    aiohttp = None
+
+
+class StubProtocol(object):
+    """Answer a single http request with the response the stub server has for
+    its method and path."""
+    def __init__(self, server):
+        self.server = server
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if b'\r\n\r\n' not in self.buffer:
+            return
+        head, body = self.buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        headers = dict(line.lower().split(': ', 1) for line in lines[1:])
+        if len(body) < int(headers.get('content-length', 0)):
+            return
+        method, path = lines[0].split(' ')[:2]
+        self.server.handle(self, method, path, body.decode('utf-8'), headers)
+
+    def respond(self, status, body, headers=None):
+        if body is None:
+            content = b''
+        else:
+            content = json.dumps(body).encode('utf-8')
+        extra = ''.join('%s: %s\r\n' % header
+                for header in (headers or {}).items())
+        self.transport.write(('HTTP/1.1 %s Status\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %s\r\n%s'
+                'Connection: close\r\n\r\n' % (status, len(content), extra)
+                ).encode('latin-1') + content)
+        self.transport.close()
+
+    def eof_received(self):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class StubServer(object):
+    """A minimal http server on the event loop. ``responses`` maps
+    ``(method, path)`` to ``(status, body)`` or ``(status, body, headers)``,
+    every response is delayed a little to let requests overlap."""
+    def __init__(self, loop, responses, delay=0.01):
+        self.loop = loop
+        self.responses = responses
+        self.delay = delay
+        self.requests = []
+        self.headers = []
+        self.active = 0
+        self.peak = 0
+        self.server = loop.run_until_complete(loop.create_server(
+            lambda: StubProtocol(self), '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.port, path)
+
+    def handle(self, protocol, method, path, body, headers):
+        self.requests.append((method, path, body))
+        self.headers.append(headers)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        response = self.responses.get((method, path), (404, None))
+
+        def respond():
+            self.active -= 1
+            protocol.respond(*response)
+
+        self.loop.call_later(self.delay, respond)
+
+    def close(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+
+class when_an_async_http_backend_is_used(unittest.TestCase):
+    def setUp(self):
+        if aiohttp is None:
+            raise SkipTest("The async http backend requires aiohttp.")
+
+        self.loop = asyncio.new_event_loop()
+        self.server = server = StubServer(self.loop, {})
+
+        class Item(Document):
+            id = fields.NumberField()
+            name = fields.StringField(optional=True)
+
+            class Meta:
+                backend_type = 'http_async'
+
+            def uri(self):
+                return server.url('/items/%s/' % self.id)
+
+        class Items(Collection):
+            document = Item
+
+        class Doc(Document):
+            id = fields.NumberField()
+            items = fields.CollectionField(Items)
+            first = fields.ForeignDocument(Item)
+
+            class Meta:
+                backend_type = 'http_async'
+                max_workers = 4
+
+            def uri(self):
+                return server.url('/docs/%s/' % self.id)
+
+        self.Item = Item
+        self.Items = Items
+        self.Doc = Doc
+
+    def tearDown(self):
+        if aiohttp is None:
+            return
+        self.server.close()
+        self.loop.close()
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def add_item(self, id):
+        self.server.responses[('GET', '/items/%s/' % id)] = (200,
+                {'id': id, 'name': 'item %s' % id})
+
+    def it_is_created_by_the_backend_manager(self):
+        ok_(isinstance(BackendManager('http_async'), HttpAsyncBackendManager))
+
+    def it_gathers_coroutines_in_order(self):
+        # The first coroutines finish last
+        jobs = [partial(asyncio.sleep, 0.01 * (5 - i), i) for i in range(5)]
+
+        eq_(list(range(5)), self.wait(gather_concurrently(jobs, 5)))
+
+    def it_fetches_related_documents_concurrently(self):
+        item_ids = list(range(2, 12))
+        for id in item_ids:
+            self.add_item(id)
+        self.server.responses[('GET', '/docs/1/')] = (200, {
+            'id': 1,
+            'items': [{'id': id} for id in item_ids],
+            'first': {'id': 2}})
+
+        doc = self.Doc({'id': 1})
+        self.wait(doc.afetch())
+
+        eq_(item_ids, [item.id for item in doc.items.collection_set])
+        eq_('item 5', doc.items.collection_set[3].name)
+        eq_('item 2', doc.first.name)
+        eq_(12, len(self.server.requests))
+        # At most max_workers related documents are fetched at the same time
+        ok_(1 < self.server.peak <= 4)
+
+    def it_fetches_shared_documents_once_in_an_identity_map(self):
+        for id in (2, 3):
+            self.add_item(id)
+        self.server.responses[('GET', '/docs/1/')] = (200, {
+            'id': 1,
+            'items': [{'id': 2}, {'id': 3}],
+            'first': {'id': 2}})
+
+        with identity_map():
+            doc = self.Doc({'id': 1})
+            self.wait(doc.afetch())
+
+        eq_('item 2', doc.first.name)
+        eq_(['item 2', 'item 3'],
+                [item.name for item in doc.items.collection_set])
+        # The first item is fetched only once
+        eq_(3, len(self.server.requests))
+
+    def it_raises_the_error_of_the_first_failing_item(self):
+        self.add_item(2)
+        self.server.responses[('GET', '/items/3/')] = (500, None)
+        self.server.responses[('GET', '/docs/1/')] = (200, {
+            'id': 1,
+            'items': [{'id': 2}, {'id': 3}, {'id': 4}],
+            'first': {'id': 2}})
+
+        assert_raises(HttpBackendError, self.wait,
+                self.Doc({'id': 1}).afetch())
+
+        assert_raises(BackendDoesNotExist, self.wait,
+                self.Item({'id': 1}).afetch())
+
+    def it_can_fetch_a_collection_of_documents(self):
+        for id in range(1, 6):
+            self.add_item(id)
+
+        items = self.Items()
+        self.wait(items.afetch_all([{'id': id} for id in range(1, 6)]))
+
+        eq_(['item %s' % id for id in range(1, 6)],
+                [item.name for item in items.collection_set])
+
+        # The collection stays empty if a document can't be fetched
+        items = self.Items()
+        assert_raises(BackendDoesNotExist, self.wait,
+                items.afetch_all([{'id': 1}, {'id': 7}]))
+        eq_([], items.collection_set)
+
+    def it_creates_new_documents_when_saving(self):
+        self.server.responses[('POST', '/items/1/')] = (201, None)
+
+        item = self.Item({'id': 1, 'name': 'new'})
+        self.wait(item.asave())
+
+        eq_(['GET', 'POST'], [r[0] for r in self.server.requests])
+        eq_({'id': 1, 'name': 'new'}, json.loads(self.server.requests[1][2]))
+
+    def it_updates_and_deletes_existing_documents(self):
+        self.add_item(2)
+        self.server.responses[('PUT', '/items/2/')] = (200, None)
+        self.server.responses[('DELETE', '/items/2/')] = (204, None)
+
+        item = self.Item({'id': 2, 'name': 'item 2'})
+        self.wait(item.asave())
+        self.wait(item.adelete())
+
+        eq_(['GET', 'PUT', 'DELETE'], [r[0] for r in self.server.requests])
+
+        assert_raises(HttpBackendError, self.wait,
+                self.Item({'id': 3}).adelete())
+
+    def it_patches_the_changed_fields_of_existing_documents(self):
+        self.add_item(1)
+        self.server.responses[('PATCH', '/items/1/')] = (200, None)
+        self.Item._meta.partial_updates = True
+
+        item = self.Item({'id': 1})
+        self.wait(item.afetch())
+        item.name = 'changed'
+        self.wait(item.asave())
+        # Without changes nothing is sent
+        self.wait(item.asave())
+
+        eq_(['GET', 'PATCH'], [r[0] for r in self.server.requests])
+        eq_({'name': 'changed'}, json.loads(self.server.requests[1][2]))
+
+    def make_article_documents(self):
+        server = self.server
+
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'http_async'
+
+            def uri(self):
+                return server.url('/editors/%s/' % self.id)
+
+            def fetch(self, *args, **kwargs):
+                raise AssertionError("The editor is fetched blocking.")
+
+        class Article(Document):
+            id = fields.NumberField()
+            editor = fields.ForeignDocument(Editor)
+
+            class Meta:
+                backend_type = 'http_async'
+
+            def uri(self):
+                return server.url('/articles/%s/' % self.id)
+
+        return Article
+
+    def it_fetches_referenced_documents_with_coroutines_to_validate(self):
+        Article = self.make_article_documents()
+        self.server.responses[('GET', '/editors/1/')] = (200,
+                {'id': 1, 'name': 'editor'})
+        self.server.responses[('POST', '/articles/1/')] = (201, None)
+
+        article = Article({'id': 1, 'editor': {'id': 1}})
+        self.wait(article.asave())
+
+        eq_('editor', article.editor.name)
+        eq_([('GET', '/editors/1/'), ('GET', '/articles/1/'),
+            ('POST', '/articles/1/')],
+            [r[:2] for r in self.server.requests])
+
+    def it_does_not_save_documents_that_reference_missing_documents(self):
+        Article = self.make_article_documents()
+
+        article = Article({'id': 1, 'editor': {'id': 2}})
+        try:
+            self.wait(article.asave())
+        except ValidationError as e:
+            eq_(['editor'], list(e.message))
+        else:
+            raise AssertionError("The document was saved.")
+
+        eq_([('GET', '/editors/2/')], [r[:2] for r in self.server.requests])
+
+    def it_saves_with_the_write_strategy_of_the_document(self):
+        self.server.responses[('HEAD', '/items/1/')] = (200, None)
+        self.server.responses[('PUT', '/items/1/')] = (200, None)
+        self.server.responses[('POST', '/items/2/')] = (201, None)
+
+        self.Item._meta.write_strategy = 'head'
+        self.wait(self.Item({'id': 2, 'name': 'two'}).asave())
+        self.wait(self.Item({'id': 1, 'name': 'one'}).asave())
+
+        eq_([('HEAD', '/items/2/'), ('POST', '/items/2/'),
+            ('HEAD', '/items/1/'), ('PUT', '/items/1/')],
+            [r[:2] for r in self.server.requests])
+
+    def it_revalidates_cached_resources(self):
+        self.server.responses[('GET', '/items/1/')] = (200,
+                {'id': 1, 'name': 'cached'}, {'ETag': '"v1"'})
+        self.Item._meta.cache = LRUCache()
+        self.wait(self.Item({'id': 1}).afetch())
+
+        self.server.responses[('GET', '/items/1/')] = (304, None)
+        item = self.Item({'id': 1})
+        self.wait(item.afetch())
+
+        eq_('cached', item.name)
+        eq_('"v1"', self.server.headers[1]['if-none-match'])
+
+    def it_can_use_a_session(self):
+        self.add_item(1)
+        session = self.wait(self.make_session())
+        HttpAsyncBackendManager.SESSION = session
+        try:
+            item = self.Item({'id': 1})
+            self.wait(item.afetch())
+        finally:
+            HttpAsyncBackendManager.SESSION = None
+            self.wait(session.close())
+
+        eq_('item 1', item.name)
+
+    def make_session(self):
+        # The session has to be created on the event loop
+        future = self.loop.create_future()
+        self.loop.call_soon(lambda: future.set_result(
+            aiohttp.ClientSession()))
+        return future
@@ -1,12 +1,19 @@
 import unittest
 import json
+import threading
+import time
 
-from nose.tools import eq_, ok_
+from functools import partial
+from nose.tools import eq_, ok_, assert_raises
 from mock import patch, Mock
 from requests.auth import HTTPBasicAuth
 
 from docar.backends import BackendManager, HttpBackendManager
+from docar.backends.http import create_session, run_concurrently
 from docar import Document, Collection, fields
+from docar.cache import LRUCache
+from docar.identity import identity_map
+from docar.exceptions import BackendDoesNotExist, HttpBackendError
 
 
 class when_a_http_backend_manager_gets_instantiated(unittest.TestCase):
@@ -158,6 +165,39 @@ class when_a_http_backend_manager_gets_instantiated(unittest.TestCase):
             self.mock_request.method_calls)
 
 
+    def it_maps_the_fields_of_compact_documents_when_saving(self):
+        class Tag(Document):
+            slug = fields.StringField()
+
+            class Meta:
+                identifier = 'slug'
+                compact = True
+
+        class Tags(Collection):
+            document = Tag
+
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+            tags = fields.CollectionField(Tags)
+
+            class Meta:
+                backend_type = 'http'
+                compact = True
+
+            def map_name_field(self):
+                return 'title'
+
+            def map_tags_field(self):
+                return 'labels'
+
+        doc = Doc({'id': 1, 'name': 'name', 'tags': [{'slug': 'a'}]})
+        state = doc._backend_manager._save_state(doc)
+
+        eq_('name', state['title'])
+        eq_([{'slug': 'a'}], state['labels'])
+
+
 class when_a_http_client_document_is_instantiated(unittest.TestCase):
     def setUp(self):
         self.request_patcher = patch('docar.backends.http.requests')
@@ -291,12 +331,16 @@ class when_a_http_client_document_is_instantiated(unittest.TestCase):
                 'name': 'other',
                 }
 
+        fetched = Mock(name='mock_http_fetch_response')
+        fetched.content = json.dumps({'id': 1, 'name': 'name'})
+        fetched.status_code = 200
+
         response = Mock(name='mock_http_response')
         response.content = json.dumps(expected)
         response.status_code = 200
 
         # set the return value of the GET request
-        self.mock_request.get.return_value = response
+        self.mock_request.get.return_value = fetched
         self.mock_request.put.return_value = response
 
         doc.update({'name': 'other'})
@@ -482,3 +526,656 @@ class when_a_http_backend_talks_to_an_api_endpoint(unittest.TestCase):
         # we should have made one GET and one PUT request
         eq_([('delete', {'url': 'delete'})],
                 self.mock_request.method_calls)
+
+
+class when_a_http_backend_uses_a_session(unittest.TestCase):
+    def setUp(self):
+        self.request_patcher = patch('docar.backends.http.requests')
+        self.mock_request = self.request_patcher.start()
+
+        class Item(Document):
+            id = fields.NumberField()
+
+            class Meta:
+                backend_type = 'http'
+
+            def uri(self):
+                return 'http://location/item/%s/' % self.id
+
+        class Items(Collection):
+            document = Item
+
+        class Doc(Document):
+            id = fields.NumberField()
+            items = fields.CollectionField(Items)
+
+            class Meta:
+                backend_type = 'http'
+
+            def uri(self):
+                return 'http://location/'
+
+        self.Doc = Doc
+        self.Item = Item
+
+    def tearDown(self):
+        self.request_patcher.stop()
+        HttpBackendManager.SESSION = None
+
+    def mock_response(self, content):
+        response = Mock(name='mock_http_response')
+        response.status_code = 200
+        response.content = json.dumps(content)
+        return response
+
+    def it_makes_all_requests_with_the_global_session(self):
+        session = Mock(name='session')
+        responses = [
+                self.mock_response({'id': 3}),
+                self.mock_response({'id': 2}),
+                self.mock_response({'id': 1, 'items': [{'id': 2}, {'id': 3}]})
+                ]
+        session.get.side_effect = lambda *args, **kwargs: responses.pop()
+        HttpBackendManager.SESSION = session
+
+        doc = self.Doc({'id': 1})
+        doc.fetch()
+
+        eq_([2, 3], [item.id for item in doc.items.collection_set])
+        eq_([('get', {'url': 'http://location/'}),
+            ('get', {'url': 'http://location/item/2/'}),
+            ('get', {'url': 'http://location/item/3/'})],
+            session.method_calls)
+        eq_([], self.mock_request.method_calls)
+
+    def it_can_use_a_session_per_document_class(self):
+        session = Mock(name='session')
+        session.put.return_value = self.mock_response({'id': 1})
+        session.delete.return_value = self.mock_response({'id': 1})
+
+        self.Item._meta.session = session
+        item = self.Item({'id': 1})
+        # the document was fetched already, so the save makes a PUT request
+        item._backend_manager.response = Mock()
+        item.save()
+        item.delete()
+
+        eq_([('put', {'url': 'http://location/item/1/',
+                'data': json.dumps({'id': 1})}),
+            ('delete', {'url': 'http://location/item/1/'})],
+            session.method_calls)
+        eq_([], self.mock_request.method_calls)
+
+    def it_falls_back_to_the_module_level_requests_functions(self):
+        self.mock_request.get.return_value = self.mock_response({'id': 2})
+
+        item = self.Item({'id': 2})
+        item.fetch()
+
+        eq_([('get', {'url': 'http://location/item/2/'})],
+                self.mock_request.method_calls)
+
+
+class when_a_http_session_is_created(unittest.TestCase):
+    def it_keeps_a_connection_pool_per_host(self):
+        session = create_session(pool_connections=2, pool_maxsize=20,
+                max_retries=3, backoff_factor=0.5)
+
+        for prefix in ('http://', 'https://'):
+            adapter = session.get_adapter(prefix + 'example.org')
+            eq_(20, adapter._pool_maxsize)
+            eq_(2, adapter._pool_connections)
+            eq_(3, adapter.max_retries.total)
+            eq_(0.5, adapter.max_retries.backoff_factor)
+
+
+class when_a_http_backend_fetches_concurrently(unittest.TestCase):
+    def setUp(self):
+        self.request_patcher = patch('docar.backends.http.requests')
+        self.mock_request = self.request_patcher.start()
+
+    def tearDown(self):
+        self.request_patcher.stop()
+
+    def it_returns_the_results_in_the_order_of_the_jobs(self):
+        def job(i):
+            # let the first jobs finish last
+            time.sleep(0.01 * (5 - i))
+            return i
+
+        jobs = [partial(job, i) for i in range(5)]
+
+        eq_(range(5), run_concurrently(jobs, max_workers=5))
+        eq_(range(5), run_concurrently(jobs, max_workers=1))
+
+    def it_raises_the_exception_of_the_first_failing_job(self):
+        def slow_error():
+            time.sleep(0.05)
+            raise HttpBackendError(500, '')
+
+        def fast_error():
+            raise BackendDoesNotExist(404, '')
+
+        jobs = [lambda: 1, slow_error, fast_error]
+
+        assert_raises(HttpBackendError, run_concurrently, jobs, 3)
+        assert_raises(HttpBackendError, run_concurrently, jobs, 1)
+
+    def it_runs_at_most_max_workers_jobs_at_the_same_time(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def job():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        run_concurrently([job] * 12, max_workers=3)
+
+        ok_(peak[0] <= 3)
+        ok_(peak[0] > 1)
+
+    def it_fetches_collection_items_and_foreign_documents_concurrently(self):
+        class Item(Document):
+            id = fields.NumberField()
+
+            class Meta:
+                backend_type = 'http'
+
+            def uri(self):
+                return 'http://location/item/%s/' % self.id
+
+        class Items(Collection):
+            document = Item
+
+        class Doc(Document):
+            id = fields.NumberField()
+            items = fields.CollectionField(Items)
+            first = fields.ForeignDocument(Item)
+
+            class Meta:
+                backend_type = 'http'
+                max_workers = 4
+
+            def uri(self):
+                return 'http://location/'
+
+        item_ids = range(2, 12)
+        bodies = {'http://location/': {
+            'id': 1,
+            'items': [{'id': i} for i in item_ids],
+            'first': {'id': 2}}}
+        for i in item_ids:
+            bodies['http://location/item/%s/' % i] = {'id': i}
+
+        threads = set()
+
+        def get(url, **kwargs):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            response = Mock(name='mock_http_response')
+            response.status_code = 200
+            response.content = json.dumps(bodies[url])
+            return response
+
+        self.mock_request.get.side_effect = get
+
+        doc = Doc({'id': 1})
+        doc.fetch()
+
+        eq_(item_ids, [item.id for item in doc.items.collection_set])
+        eq_(2, doc.first.id)
+        eq_(12, len(self.mock_request.get.call_args_list))
+        ok_(len(threads) > 1)
+
+        # A missing item fails the whole fetch
+        del bodies['http://location/item/5/']
+        bodies['http://location/item/5/'] = None
+
+        def get_missing(url, **kwargs):
+            response = get(url, **kwargs)
+            if bodies[url] is None:
+                response.status_code = 404
+            return response
+
+        self.mock_request.get.side_effect = get_missing
+
+        assert_raises(BackendDoesNotExist, Doc({'id': 1}).fetch)
+
+    def it_fetches_all_documents_of_a_collection(self):
+        class Item(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'http'
+                max_workers = 3
+
+            def uri(self):
+                return 'http://location/item/%s/' % self.id
+
+        class Items(Collection):
+            document = Item
+
+        missing = []
+
+        def get(url, **kwargs):
+            response = Mock(name='mock_http_response')
+            id = int(url.split('/')[-2])
+            if id in missing:
+                response.status_code = 404
+            else:
+                response.status_code = 200
+            response.content = json.dumps({'id': id, 'name': 'item %s' % id})
+            return response
+
+        self.mock_request.get.side_effect = get
+
+        items = Items()
+        items.fetch_all([{'id': i} for i in range(1, 7)])
+        eq_(['item %s' % i for i in range(1, 7)],
+                [item.name for item in items.collection_set])
+
+        # Missing documents are reported, the others are added
+        missing.append(4)
+        items = Items()
+        assert_raises(BackendDoesNotExist, items.fetch_all,
+                [{'id': i} for i in range(1, 7)])
+        eq_([1, 2, 3, 5, 6], [item.id for item in items.collection_set])
+
+    def it_saves_all_documents_of_a_collection(self):
+        class Item(Document):
+            id = fields.NumberField()
+
+            class Meta:
+                backend_type = 'http'
+                max_workers = 3
+
+            def uri(self):
+                return 'http://location/item/%s/' % self.id
+
+        class Items(Collection):
+            document = Item
+
+        def respond(method, url, **kwargs):
+            response = Mock(name='mock_http_response')
+            id = int(url.split('/')[-2])
+            if method == 'get' and id % 2:
+                response.status_code = 404
+            else:
+                response.status_code = 200
+            response.content = json.dumps({'id': id})
+            return response
+
+        self.mock_request.get.side_effect = partial(respond, 'get')
+        self.mock_request.post.side_effect = partial(respond, 'post')
+        self.mock_request.put.side_effect = partial(respond, 'put')
+
+        items = Items([Item({'id': i}) for i in range(1, 6)])
+        items.save_all(batch_size=2)
+
+        def ids(mock):
+            return sorted(int(call[1]['url'].split('/')[-2])
+                    for call in mock.call_args_list)
+
+        # Every document is looked up, missing ones are created
+        eq_([1, 2, 3, 4, 5], ids(self.mock_request.get))
+        eq_([1, 3, 5], ids(self.mock_request.post))
+        eq_([2, 4], ids(self.mock_request.put))
+
+    def it_updates_fetched_documents_without_looking_them_up(self):
+        class Item(Document):
+            id = fields.NumberField()
+
+            class Meta:
+                backend_type = 'http'
+
+            def uri(self):
+                return 'http://location/item/%s/' % self.id
+
+        class Items(Collection):
+            document = Item
+
+        def respond(url, **kwargs):
+            response = Mock(name='mock_http_response')
+            response.status_code = 200
+            response.content = json.dumps({'id': int(url.split('/')[-2])})
+            return response
+
+        self.mock_request.get.side_effect = respond
+        self.mock_request.put.side_effect = respond
+
+        items = Items()
+        items.fetch_all([{'id': i} for i in range(1, 4)])
+        self.mock_request.get.reset_mock()
+        items.save_all()
+
+        eq_(0, self.mock_request.get.call_count)
+        eq_(3, self.mock_request.put.call_count)
+
+
+class when_a_http_backend_saves_with_a_write_strategy(unittest.TestCase):
+    def setUp(self):
+        self.request_patcher = patch('docar.backends.http.requests')
+        self.mock_request = self.request_patcher.start()
+
+        class Doc(Document):
+            id = fields.NumberField()
+
+            class Meta:
+                backend_type = 'http'
+
+            def uri(self):
+                return 'http://location/'
+
+        self.Doc = Doc
+
+    def tearDown(self):
+        self.request_patcher.stop()
+        HttpBackendManager.WRITE_STRATEGY = 'probe'
+
+    def respond(self, method, status_code, etag=None):
+        response = Mock(name='mock_http_response')
+        response.status_code = status_code
+        response.content = json.dumps({'id': 1})
+        response.headers = {'ETag': etag}
+        getattr(self.mock_request, method).return_value = response
+
+    def methods(self):
+        return [call[0] for call in self.mock_request.method_calls]
+
+    def it_probes_with_a_fetch_by_default(self):
+        self.respond('get', 200)
+        self.respond('put', 200)
+
+        self.Doc({'id': 1}).save()
+
+        eq_(['get', 'put'], self.methods())
+
+    def it_can_always_put_or_post_without_a_probe(self):
+        self.respond('put', 200)
+        self.respond('post', 201)
+
+        self.Doc._meta.write_strategy = 'put'
+        self.Doc({'id': 1}).save()
+        self.Doc._meta.write_strategy = 'post'
+        self.Doc({'id': 1}).save()
+
+        eq_(['put', 'post'], self.methods())
+        eq_({'url': 'http://location/', 'data': '{"id": 1}'},
+                self.mock_request.method_calls[0][2])
+
+    def it_can_probe_with_a_head_request(self):
+        HttpBackendManager.WRITE_STRATEGY = 'head'
+        self.respond('head', 404)
+        self.respond('post', 201)
+        self.respond('put', 200)
+
+        self.Doc({'id': 1}).save()
+        self.Doc({'id': 2}).save()
+        self.respond('head', 200)
+        self.Doc({'id': 3}).save()
+
+        eq_(['head', 'post', 'head', 'post', 'head', 'put'], self.methods())
+
+    def it_can_save_conditionally(self):
+        self.Doc._meta.write_strategy = 'conditional'
+        self.respond('get', 200, etag='"v1"')
+        self.respond('put', 200, etag='"v2"')
+        self.respond('head', 404)
+        self.respond('post', 201)
+
+        # A fetched document is updated if it didn't change in the meantime
+        doc = self.Doc({'id': 1})
+        doc.fetch()
+        # Save the unchanged document anyway
+        doc.save(update_fields=['id'])
+        eq_({'If-Match': '"v1"'}, self.mock_request.put.call_args[1]['headers'])
+
+        # The next save expects the version of the last save
+        doc.save(update_fields=['id'])
+        eq_({'If-Match': '"v2"'}, self.mock_request.put.call_args[1]['headers'])
+        eq_(['get', 'put', 'put'], self.methods())
+
+        # A new document is only created if it doesn't exist yet
+        self.Doc({'id': 2}).save()
+        eq_({'If-None-Match': '*'},
+                self.mock_request.post.call_args[1]['headers'])
+        eq_(['get', 'put', 'put', 'head', 'post'], self.methods())
+
+        # A failed precondition raises an error
+        self.respond('put', 412)
+        assert_raises(HttpBackendError, doc.save, update_fields=['id'])
+
+    def it_raises_an_error_for_unknown_strategies(self):
+        self.Doc._meta.write_strategy = 'unknown'
+
+        assert_raises(ValueError, self.Doc({'id': 1}).save)
+
+
+class when_a_http_backend_updates_documents_partially(unittest.TestCase):
+    def setUp(self):
+        self.request_patcher = patch('docar.backends.http.requests')
+        self.mock_request = self.request_patcher.start()
+
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+            title = fields.StringField()
+
+            class Meta:
+                backend_type = 'http'
+                partial_updates = True
+
+            def uri(self):
+                return 'http://location/'
+
+        self.Doc = Doc
+        fetched = Mock(name='mock_http_response')
+        fetched.status_code = 200
+        fetched.content = json.dumps({'id': 1, 'name': 'name',
+            'title': 'title'})
+        self.mock_request.get.return_value = fetched
+        self.mock_request.patch.return_value.status_code = 200
+        self.mock_request.put.return_value.status_code = 200
+
+    def tearDown(self):
+        self.request_patcher.stop()
+
+    def it_sends_only_the_changed_fields_with_a_patch_request(self):
+        doc = self.Doc({'id': 1})
+        doc.update({'title': 'new title'})
+
+        eq_(['get', 'patch'],
+                [call[0] for call in self.mock_request.method_calls])
+        eq_({'title': 'new title'},
+                json.loads(self.mock_request.patch.call_args[1]['data']))
+
+        # Without changes nothing is sent
+        doc.save()
+        eq_(1, self.mock_request.patch.call_count)
+
+    def it_sends_the_whole_document_if_the_changes_are_unknown(self):
+        self.Doc({'id': 1, 'name': 'name', 'title': 'title'}).save()
+
+        eq_(['get', 'put'],
+                [call[0] for call in self.mock_request.method_calls])
+
+
+class when_a_http_backend_caches_responses(unittest.TestCase):
+    def setUp(self):
+        self.request_patcher = patch('docar.backends.http.requests')
+        self.mock_request = self.request_patcher.start()
+
+        class Doc(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'http'
+                cache = LRUCache()
+
+            def uri(self):
+                return 'http://location/'
+
+        self.Doc = Doc
+
+    def tearDown(self):
+        self.request_patcher.stop()
+
+    def respond(self, method, status_code, content='', headers={}):
+        response = Mock(name='mock_http_response')
+        response.status_code = status_code
+        response.content = content
+        response.headers = headers
+        getattr(self.mock_request, method).return_value = response
+
+    def it_fetches_unchanged_resources_from_the_cache(self):
+        self.respond('get', 200, '{"id": 1, "name": "cached"}',
+                {'ETag': '"v1"', 'Last-Modified': 'Sat, 01 Jan 2011'})
+        self.Doc({'id': 1}).fetch()
+
+        # The endpoint answers with 304 Not Modified and no message
+        self.respond('get', 304)
+        with patch('docar.backends.http.codec') as mock_codec:
+            doc = self.Doc({'id': 1})
+            doc.fetch()
+
+        eq_('cached', doc.name)
+        eq_(False, mock_codec.loads.called)
+        eq_({'If-None-Match': '"v1"', 'If-Modified-Since': 'Sat, 01 Jan 2011'},
+                self.mock_request.get.call_args[1]['headers'])
+
+    def it_does_not_cache_responses_without_validators(self):
+        self.respond('get', 200, '{"id": 1, "name": "name"}')
+        self.Doc({'id': 1}).fetch()
+        self.Doc({'id': 1}).fetch()
+
+        eq_(None, self.Doc._meta.cache.get('http://location/'))
+        eq_({'url': 'http://location/'},
+                self.mock_request.get.call_args[1])
+
+    def it_invalidates_the_cache_when_saving_or_deleting(self):
+        self.respond('get', 200, '{"id": 1, "name": "cached"}',
+                {'ETag': '"v1"'})
+        self.respond('put', 200)
+        self.respond('delete', 204)
+
+        doc = self.Doc({'id': 1})
+        doc.fetch()
+        ok_(self.Doc._meta.cache.get('http://location/') is not None)
+        doc.name = 'changed'
+        doc.save()
+        eq_(None, self.Doc._meta.cache.get('http://location/'))
+
+        doc.fetch()
+        doc.delete()
+        eq_(None, self.Doc._meta.cache.get('http://location/'))
+
+
+class when_a_http_backend_fetches_in_an_identity_map(unittest.TestCase):
+    def setUp(self):
+        self.request_patcher = patch('docar.backends.http.requests')
+        self.mock_request = self.request_patcher.start()
+
+        class Editor(Document):
+            id = fields.NumberField()
+            name = fields.StringField()
+
+            class Meta:
+                backend_type = 'http'
+
+            def uri(self):
+                return 'http://location/editor/%s/' % self.id
+
+        class Article(Document):
+            id = fields.NumberField()
+            editor = fields.ForeignDocument(Editor)
+
+            class Meta:
+                backend_type = 'http'
+                max_workers = 4
+
+            def uri(self):
+                return 'http://location/article/%s/' % self.id
+
+        class Articles(Collection):
+            document = Article
+
+        self.Article = Article
+        self.Articles = Articles
+
+        def get(url, **kwargs):
+            time.sleep(0.001)
+            response = Mock(name='mock_http_response')
+            response.status_code = 200
+            id = int(url.split('/')[-2])
+            if '/editor/' in url:
+                response.content = json.dumps({'id': id, 'name': 'editor'})
+            else:
+                response.content = json.dumps({'id': id,
+                    'editor': {'id': 1}})
+            return response
+
+        self.mock_request.get.side_effect = get
+
+    def tearDown(self):
+        self.request_patcher.stop()
+
+    def editor_requests(self):
+        return [call for call in self.mock_request.get.call_args_list
+                if '/editor/' in call[1]['url']]
+
+    def it_fetches_a_shared_related_document_once(self):
+        with identity_map() as scope:
+            articles = self.Articles()
+            articles.fetch_all([{'id': i} for i in range(20)])
+
+        eq_(['editor'] * 20,
+                [article.editor.name for article in articles.collection_set])
+        eq_(1, len(self.editor_requests()))
+        eq_(19, scope.hits)
+
+        # Without a scope every article fetches its editor
+        self.Articles().fetch_all([{'id': i} for i in range(20)])
+        eq_(21, len(self.editor_requests()))
+
+    def it_builds_a_shared_related_document_once(self):
+        Editor = self.Article._meta.field_map['editor'].Document
+        names = []
+
+        def fetch_name_field(editor, name):
+            names.append(name)
+            return name
+
+        Editor.fetch_name_field = fetch_name_field
+
+        with identity_map():
+            articles = self.Articles()
+            articles.fetch_all([{'id': i} for i in range(20)])
+
+        editors = [article.editor for article in articles.collection_set]
+        eq_(20, len(editors))
+        ok_(all(editor is editors[0] for editor in editors))
+        eq_(['editor'], names)
+
+    def it_fetches_saved_documents_again(self):
+        self.mock_request.put.return_value.status_code = 200
+
+        with identity_map():
+            article = self.Article({'id': 1})
+            article.fetch()
+            self.Article({'id': 1}).fetch()
+            eq_(2, len(self.mock_request.get.call_args_list))
+
+            article.editor.name = 'changed'
+            article.save()
+            self.Article({'id': 1}).fetch()
+
+        eq_(1, len(self.mock_request.put.call_args_list))
+        eq_(2, len([call for call in self.mock_request.get.call_args_list
+            if '/article/' in call[1]['url']]))
@@ -0,0 +1,108 @@
+import unittest
+import threading
+import time
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, ok_, assert_raises
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+from docar import Document, fields
+from docar.identity import (IdentityMap, identity_map, current_map,
+        fetch_state, forget)
+
+
+class Doc(Document):
+    id = fields.NumberField()
+
+
+class when_an_identity_map_is_used(unittest.TestCase):
+    def it_fetches_each_resource_once_per_scope(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {'id': 1}
+
+        with identity_map() as scope:
+            eq_({'id': 1}, fetch_state(Doc({'id': 1}), fetch))
+            eq_({'id': 1}, fetch_state(Doc({'id': 1}), fetch))
+            fetch_state(Doc({'id': 2}), fetch)
+            # Other users fetch the resource on their own
+            fetch_state(Doc({'id': 1}), fetch, credentials='user')
+
+        eq_(3, len(calls))
+        eq_(1, scope.hits)
+        eq_(None, current_map())
+
+        # Outside of a scope every fetch goes to the backend
+        fetch_state(Doc({'id': 1}), fetch)
+        eq_(4, len(calls))
+
+    def it_shares_the_map_of_an_outer_scope(self):
+        with identity_map() as outer:
+            with identity_map() as inner:
+                ok_(inner is outer)
+            ok_(current_map() is outer)
+
+    def it_forgets_documents(self):
+        with identity_map() as scope:
+            fetch_state(Doc({'id': 1}), lambda: {'id': 1})
+            fetch_state(Doc({'id': 1}), lambda: {'id': 1},
+                    credentials='user')
+            forget(Doc({'id': 1}))
+
+            eq_(0, len(scope))
+
+    def it_does_not_remember_failed_fetches(self):
+        def fail():
+            raise ValueError()
+
+        with identity_map():
+            assert_raises(ValueError, fetch_state, Doc({'id': 1}), fail)
+            eq_({'id': 1}, fetch_state(Doc({'id': 1}), lambda: {'id': 1}))
+
+    def it_lets_threads_wait_for_a_pending_fetch(self):
+        identity = IdentityMap()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.02)
+            return 'state'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(identity.fetch('key', fetch)))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        eq_(['state'] * 5, results)
+        eq_(1, len(calls))
+
+    def it_keeps_the_scope_of_each_task(self):
+        if contextvars is None:
+            raise SkipTest("Task scopes require contextvars.")
+
+        # asyncio runs every task in its own copy of the context, the scopes
+        # are entered and left interleaved like two concurrent coroutines do
+        first, second = identity_map(), identity_map()
+        first_context = contextvars.copy_context()
+        second_context = contextvars.copy_context()
+        first_map = first_context.run(first.__enter__)
+        second_map = second_context.run(second.__enter__)
+        ok_(first_map is not second_map)
+
+        first_context.run(first.__exit__, None, None, None)
+        eq_(second_map, second_context.run(current_map))
+        eq_(None, first_context.run(current_map))
+
+        second_context.run(second.__exit__, None, None, None)
+        eq_(None, second_context.run(current_map))
+        eq_(None, current_map())